@@ -123,7 +123,7 @@ class JacoDraw():
                 goal = [np.round(x,2), np.round(y,2), np.round(z,2)]+draw_orientation
                 print('goal', goal)
                 goals.append(goal)
-                ss = self.service_step('POSE', False, 'mq', goal)
+                ss = self.service_step('POSE', False, 'mq', goal, 0, False)
                 n_states.append(ss.n_states)
                 joint_pos.append(list(ss.joint_pos))
                 joint_vel.append(list(ss.joint_vel))
@@ -6,7 +6,8 @@ import sys
 import matplotlib.pyplot as plt
 from IPython import embed
 import rospy
-from ros_interface.srv import reset, step, home, get_state, initialize
+from ros_interface.srv import reset, step, home, get_state, initialize, step_batch
+from ros_interface.interfaces.protocol import split_batch_states
 
 class JacoJointTest():
     def __init__(self):
@@ -31,6 +32,9 @@ class JacoJointTest():
         rospy.wait_for_service('/step')
         self.service_step = rospy.ServiceProxy('/step', step)
         print('setup service: step')
+        rospy.wait_for_service('/step_batch')
+        self.service_step_batch = rospy.ServiceProxy('/step_batch', step_batch)
+        print('setup service: step_batch')
         self.service_init()
         self.reset_data()
  
@@ -50,17 +54,40 @@ class JacoJointTest():
 
     def move_joint(self, joint, offset_degrees):
         print('starting', offset_degrees)
+        actions = []
         while np.abs(offset_degrees) > 0:
             step = np.sign(offset_degrees) * np.min([np.abs(self.max_joint_step), np.abs(offset_degrees)])
             offset_degrees = np.sign(offset_degrees) * (np.abs(offset_degrees)-np.abs(step))
             print(step, offset_degrees)
             joints = np.zeros(8)
             joints[joint] = step
-            ss = self.service_step('ANGLE', True, 'mdeg', joints)
-            self.joint_pos.append(ss.joint_pos)
-            self.eef_pos.append(ss.tool_pos)
-            self.actions.append(joints)
-            print(ss.success, ss.joint_pos[joint])
+            actions.append(joints)
+        if not len(actions):
+            return
+        # send every sub step in one service call
+        actions = np.array(actions)
+        ss = self.service_step_batch('ANGLE', True, 'mdeg', len(actions), actions.ravel())
+        states = split_batch_states(np.array(ss.states).reshape(ss.n_actions, -1), ss.n_joint_states)
+        for i in range(ss.n_actions):
+            self.joint_pos.append(states['joint_pos'][i])
+            self.eef_pos.append(states['tool_pos'][i])
+            self.actions.append(actions[i])
+        print(ss.success, states['joint_pos'][-1, joint])
+
+    def move_joint_trajectory(self, joint, offset_degrees, degrees_per_sec=20.0):
+        """ same motion as move_joint as one smooth trajectory step """
+        duration = max(abs(offset_degrees) / degrees_per_sec, .1)
+        waypoint = np.zeros(8)
+        waypoint[0] = duration
+        waypoint[1 + joint] = offset_degrees
+        ss = self.service_step('TRAJECTORY', True, 'mdeg', waypoint, 0, False)
+        self.joint_pos.append(ss.joint_pos)
+        self.eef_pos.append(ss.tool_pos)
+        self.actions.append(waypoint[1:])
+        error = np.array(ss.tracking_error).reshape(-1, 7)
+        if len(error):
+            print('max tracking error', np.abs(error).max(axis=0))
+        print(ss.success, ss.msg)
 
  
 def joint_0_full_revolution():
@@ -0,0 +1,254 @@
+"""
+End to end latency benchmark of the binary protocol.
+
+Drives a scripted mix of VEL, ANGLE, TOOL, GET_STATE and RENDER requests
+through the robot server and reports, for every command, percentiles of the
+time spent in each hop a request passes through:
+
+    send        client packing the request and writing it to the socket
+    round_trip  submit until the reply has been read by the client
+    network     round_trip minus handle: sockets, the server loop and the
+                wait for a free worker
+    handle      RobotServer handling the request, unpacking to packing
+    service     the ROS service call made by the server
+    ros         service minus command and state: ROS (de)serialisation and
+                transport between robot_server and JacoInterface
+    command     JacoInterface running the command, including the actionlib
+                goal for ANGLE and TOOL
+    state       JacoInterface collecting the state of the reply
+
+The server hops come from the TIMING trailer the server adds to replies of
+requests sent with FLAG_TIMING. Every combination of client count and trace
+decimation is one run. The first client sends the whole mix, the others only
+the read requests (GET_STATE and RENDER) as a robot only has one controller.
+Larger trace decimations return more state samples, request_bytes and
+reply_bytes of the report hold the payload sizes that were actually sent.
+
+Run it against the stand-in driver:
+
+    roslaunch ros_interface fake_jaco.launch
+    python -m ros_interface.interfaces.benchmark --clients 1,4 --trace 0,10,1 --out bench.json
+
+The report is json with sorted keys so reports of two versions can be diffed.
+The ros hop depends on how the server reaches JacoInterface, compare the
+deployments with one report each:
+
+    roslaunch ros_interface fake_jaco.launch persistent_services:=false
+    python -m ros_interface.interfaces.benchmark --label proxy --out proxy.json
+    roslaunch ros_interface fake_jaco.launch
+    python -m ros_interface.interfaces.benchmark --label persistent --out persistent.json
+    roslaunch ros_interface fake_jaco.launch in_process:=true
+    python -m ros_interface.interfaces.benchmark --label in_process --out in_process.json
+"""
+import argparse
+import json
+import sys
+import threading
+import time
+
+import numpy as np
+
+from ros_interface.interfaces.protocol import FLAG_TIMING, PROTOCOL_VERSION
+from ros_interface.interfaces.protocol import GET_STATE_REQUEST, pack_step
+from ros_interface.interfaces.robot_client import PipelinedRobotCommunicator
+from ros_interface.interfaces.robot_client import make_read_image, read_state
+
+# command name and how many of every len(mix) requests of the controlling
+# client it makes up
+DEFAULT_MIX = 'VEL:4,ANGLE:1,TOOL:1,GET_STATE:4,RENDER:1'
+READ_COMMANDS = ('GET_STATE', 'RENDER')
+PERCENTILES = (50, 95, 99)
+# a fence which does not get in the way of the benchmark moves
+FENCE = [-2, 2, -2, 2, -2, 2]
+
+
+def parse_mix(text):
+    """ 'VEL:4,GET_STATE:1' -> ['VEL', 'VEL', 'VEL', 'VEL', 'GET_STATE'] """
+    script = []
+    for item in text.split(','):
+        name, _, count = item.partition(':')
+        script += [name.strip().upper()] * int(count or 1)
+    return script
+
+
+def parse_ints(text):
+    return [int(x) for x in text.split(',')]
+
+
+def make_request(name, i, trace_decimation):
+    """
+    fn, payload and reply reader of the i-th request of command name. Moves
+    are small and alternate in sign so the arm stays where it started
+    """
+    sign = 1.0 if i % 2 == 0 else -1.0
+    if name == 'VEL':
+        # 5 ticks of 5 deg/s on the last joint
+        data = [5, 0, 0, 0, 0, 0, 0, 5 * sign]
+        return 'STEP', pack_step('VEL', False, 'deg', data, trace_decimation), read_state
+    if name == 'ANGLE':
+        data = [0, 0, 0, 0, 0, 0, 1 * sign]
+        return 'STEP', pack_step('ANGLE', True, 'deg', data, trace_decimation), read_state
+    if name == 'TOOL':
+        data = [0, 0, 0.01 * sign, 0, 0, 0]
+        return 'STEP', pack_step('TOOL', True, 'mdeg', data, trace_decimation), read_state
+    if name == 'GET_STATE':
+        return 'GET_STATE', GET_STATE_REQUEST.pack(trace_decimation), read_state
+    if name == 'RENDER':
+        return 'RENDER', b'', make_read_image()
+    raise ValueError('unknown benchmark command {}'.format(name))
+
+
+def timed_reader(read_reply, record):
+    """ wraps a reply reader to note the reply size and when it was read """
+    def read(reader, length):
+        record['reply_bytes'] = length
+        result = read_reply(reader, length)
+        record['done'] = time.perf_counter()
+        return result
+    return read
+
+
+def run_client(rc, script, n_requests, trace_decimation, records):
+    """ send n_requests of script one after the other and time each of them """
+    for i in range(n_requests):
+        name = script[i % len(script)]
+        fn, payload, read_reply = make_request(name, i, trace_decimation)
+        record = {'name': name, 'request_bytes': len(payload)}
+        start = time.perf_counter()
+        future = rc.submit(fn, payload, timed_reader(read_reply, record),
+                           flags=FLAG_TIMING)
+        record['send'] = time.perf_counter() - start
+        try:
+            future.result()
+        except Exception as e:
+            record['error'] = str(e)
+            records.append(record)
+            continue
+        record['round_trip'] = record.pop('done') - start
+        record.update(future.timing)
+        records.append(record)
+
+
+def hop_times(records):
+    """ seconds of every hop of successful records, derived hops included """
+    hops = {}
+    for record in records:
+        if 'error' in record:
+            continue
+        times = dict((name, record[name]) for name in
+                     ('send', 'round_trip', 'handle', 'service', 'command', 'state'))
+        times['network'] = record['round_trip'] - record['handle']
+        if record['service']:
+            times['ros'] = record['service'] - record['command'] - record['state']
+        else:
+            # answered on the server loop without a service call
+            del times['service'], times['command'], times['state']
+        if record['name'] == 'GET_STATE':
+            del times['command'], times['state']
+        for name, seconds in times.items():
+            hops.setdefault(name, []).append(seconds)
+    return hops
+
+
+def summarize(seconds):
+    """ percentiles, mean and max in ms, and the rate one hop at a time could sustain """
+    ms = np.asarray(seconds) * 1000.0
+    summary = dict(('p%d_ms' % p, float(v)) for p, v in
+                   zip(PERCENTILES, np.percentile(ms, PERCENTILES)))
+    summary['mean_ms'] = float(ms.mean())
+    summary['max_ms'] = float(ms.max())
+    summary['rate_hz'] = float(1000.0 / ms.mean()) if ms.mean() > 0 else None
+    return summary
+
+
+def report_run(records, elapsed):
+    commands = {}
+    for name in sorted(set(r['name'] for r in records)):
+        runs = [r for r in records if r['name'] == name]
+        ok = [r for r in runs if 'error' not in r]
+        commands[name] = {
+            'count': len(runs),
+            'errors': len(runs) - len(ok),
+            'throughput_hz': len(ok) / elapsed,
+            'request_bytes': int(np.mean([r['request_bytes'] for r in runs])),
+            'reply_bytes': int(np.mean([r['reply_bytes'] for r in ok])) if ok else 0,
+            'hops': dict((hop, summarize(times)) for hop, times in hop_times(ok).items()),
+        }
+        if len(ok) < len(runs):
+            commands[name]['first_error'] = [r['error'] for r in runs if 'error' in r][0]
+    n_ok = sum(c['count'] - c['errors'] for c in commands.values())
+    return {'seconds': elapsed, 'throughput_hz': n_ok / elapsed, 'commands': commands}
+
+
+def run(robot_ip, port, n_clients, trace_decimation, script, n_requests):
+    clients = [PipelinedRobotCommunicator(robot_ip=robot_ip, port=port)
+               for i in range(n_clients)]
+    try:
+        clients[0].initialize(FENCE)
+        read_script = [name for name in script if name in READ_COMMANDS]
+        records = [[] for c in clients]
+        threads = []
+        for i, rc in enumerate(clients):
+            client_script = script if i == 0 else read_script
+            if not client_script:
+                continue
+            threads.append(threading.Thread(target=run_client, args=(
+                rc, client_script, n_requests, trace_decimation, records[i])))
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        for rc in clients:
+            rc.disconnect()
+    result = report_run(sum(records, []), elapsed)
+    result.update({'clients': n_clients, 'trace_decimation': trace_decimation})
+    return result
+
+
+def print_run(result, out=sys.stdout):
+    out.write('clients {clients} trace {trace_decimation}: {throughput_hz:.1f} req/s\n'.format(**result))
+    for name, command in sorted(result['commands'].items()):
+        out.write('  {} x{} ({} errors) {:.1f}/s, {}B -> {}B\n'.format(
+            name, command['count'], command['errors'], command['throughput_hz'],
+            command['request_bytes'], command['reply_bytes']))
+        for hop, summary in sorted(command['hops'].items()):
+            out.write('    {:<10} p50 {p50_ms:8.3f} p95 {p95_ms:8.3f} p99 {p99_ms:8.3f} ms\n'.format(
+                hop, **summary))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9030)
+    parser.add_argument('--clients', default='1', help='comma separated client counts')
+    parser.add_argument('--trace', default='0',
+                        help='comma separated trace decimations, each is one reply size')
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help='command:count pairs of the controlling client')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests of each client in every run')
+    parser.add_argument('--label', default='', help='stored in the report, e.g. a version')
+    parser.add_argument('--out', default='benchmark.json', help='json report file')
+    args = parser.parse_args(argv)
+
+    script = parse_mix(args.mix)
+    runs = []
+    for n_clients in parse_ints(args.clients):
+        for trace_decimation in parse_ints(args.trace):
+            result = run(args.host, args.port, n_clients, trace_decimation,
+                         script, args.requests)
+            print_run(result, sys.stderr)
+            runs.append(result)
+    report = {'label': args.label, 'protocol_version': PROTOCOL_VERSION,
+              'mix': args.mix, 'requests': args.requests, 'runs': runs}
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+        f.write('\n')
+    print('wrote {}'.format(args.out))
+
+
+if __name__ == '__main__':
+    main()
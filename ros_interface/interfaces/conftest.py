@@ -0,0 +1,117 @@
+"""
+Fixtures of the interface tests.
+
+The tests run without a ROS installation: when rospy or the generated
+services are missing, the robot_server fixture puts minimal stand-ins for
+them in sys.modules for the duration of a test. The stand-in services are
+read from srv/*.srv, and their requests, like genpy messages, take either
+positional or keyword arguments but not both.
+"""
+import os
+import sys
+import types
+
+import pytest
+
+SRV_DIR = os.path.join(os.path.dirname(__file__), '..', '..', 'srv')
+
+
+class FakeMessage(object):
+    """ genpy.Message as far as the server uses it """
+    __slots__ = ()
+
+    def __init__(self, *args, **kwds):
+        if args and kwds:
+            raise TypeError('{} takes arguments or keywords, but not both'.format(
+                type(self).__name__))
+        if args and len(args) != len(self.__slots__):
+            raise TypeError('{} takes {} arguments, {} given'.format(
+                type(self).__name__, len(self.__slots__), len(args)))
+        for name in self.__slots__:
+            setattr(self, name, [] if '[]' in self._types[name] else 0)
+        for name, value in zip(self.__slots__, args):
+            setattr(self, name, value)
+        for name, value in kwds.items():
+            if name not in self.__slots__:
+                raise AttributeError('{} has no field {}'.format(type(self).__name__, name))
+            setattr(self, name, value)
+
+
+def message_class(name, lines):
+    fields = [line.split('#')[0].split() for line in lines]
+    fields = [field for field in fields if field]
+    types_ = dict((field[1], field[0]) for field in fields)
+    return type(name, (FakeMessage,), {'__slots__': tuple(field[1] for field in fields),
+                                       '_types': types_})
+
+
+def fake_services():
+    srv = types.ModuleType('ros_interface.srv')
+    for filename in sorted(os.listdir(SRV_DIR)):
+        name = filename[:-len('.srv')]
+        with open(os.path.join(SRV_DIR, filename)) as f:
+            request, response = f.read().split('---')
+        setattr(srv, name, type(name, (object,), {
+            '_request_class': message_class(name + 'Request', request.splitlines()),
+            '_response_class': message_class(name + 'Response', response.splitlines())}))
+    return srv
+
+
+def convert_return_to_response(response, response_class):
+    """ rospy.impl.tcpros_service.convert_return_to_response """
+    if isinstance(response, response_class):
+        return response
+    if isinstance(response, (tuple, list)):
+        return response_class(*response)
+    if isinstance(response, dict):
+        return response_class(**response)
+    return response_class(response)
+
+
+class FakeSubscriber(object):
+    def __init__(self, *args, **kwargs):
+        pass
+
+
+def fake_ros_modules():
+    rospy = types.ModuleType('rospy')
+    rospy.loginfo = rospy.logwarn = rospy.logerr = lambda *args: None
+    rospy.get_param = lambda name, default=None: default
+    rospy.get_namespace = lambda: '/'
+    rospy.init_node = lambda *args, **kwargs: None
+    rospy.is_shutdown = lambda: False
+    rospy.wait_for_service = lambda *args, **kwargs: None
+    rospy.Subscriber = FakeSubscriber
+    rospy.ServiceProxy = None
+    impl = types.ModuleType('rospy.impl')
+    tcpros_service = types.ModuleType('rospy.impl.tcpros_service')
+    tcpros_service.convert_return_to_response = convert_return_to_response
+    rospy.impl = impl
+    impl.tcpros_service = tcpros_service
+    sensor_msgs = types.ModuleType('sensor_msgs.msg')
+    sensor_msgs.Image = object
+    std_msgs = types.ModuleType('std_msgs.msg')
+    std_msgs.Float64MultiArray = object
+    return {'rospy': rospy, 'rospy.impl': impl, 'rospy.impl.tcpros_service': tcpros_service,
+            'sensor_msgs': types.ModuleType('sensor_msgs'), 'sensor_msgs.msg': sensor_msgs,
+            'std_msgs': types.ModuleType('std_msgs'), 'std_msgs.msg': std_msgs,
+            'ros_interface.srv': fake_services()}
+
+
+@pytest.fixture
+def robot_server(monkeypatch):
+    """ the robot_server module, importable with or without ROS """
+    faked = False
+    try:
+        import rospy.impl.tcpros_service
+        import ros_interface.srv
+    except ImportError:
+        faked = True
+        for name, module in fake_ros_modules().items():
+            monkeypatch.setitem(sys.modules, name, module)
+        sys.modules.pop('ros_interface.interfaces.robot_server', None)
+    import ros_interface.interfaces.robot_server as module
+    yield module
+    if faked:
+        # imported against the stand-ins, which go away with this test
+        sys.modules.pop('ros_interface.interfaces.robot_server', None)
@@ -0,0 +1,157 @@
+"""
+Binary in memory event log.
+
+Printing on every command costs CPU and adds terminal dependent jitter to the
+control path, so hot paths record events instead. An event is one fixed size
+record in a preallocated ring buffer: time, event id, number of values and up
+to MAX_FIELDS float64 values. Nothing is formatted until the log is read.
+
+Events are declared once, with the names of their values and optional
+tables for values which are an index into a tuple of names:
+
+    STEP_EVENT = EVENT_LOG.event('step', ('type', 'relative', 'n_data'),
+                                 type=STEP_TYPES)
+    ...
+    STEP_EVENT(STEP_TYPES.index(ctype), relative, len(data))
+
+The log is read with records (numpy structured array, oldest first), lines
+(formatted text), dump (text to a file), or on a signal once
+install_dump_signal was called:
+
+    kill -USR1 <pid>
+
+Every process has one log, EVENT_LOG.
+"""
+import itertools
+import os
+import signal
+import sys
+import time
+
+import numpy as np
+
+MAX_FIELDS = 8
+RECORD = np.dtype([('time', '<f8'), ('seq', '<u8'), ('event', '<u2'),
+                   ('n_values', '<u2'), ('pad', '<u4'),
+                   ('values', '<f8', (MAX_FIELDS,))])
+
+
+class Event(object):
+    """ callable which records one event, see EventLog.event """
+    def __init__(self, log, event_id, name, fields, enums):
+        self.log = log
+        self.id = event_id
+        self.name = name
+        self.fields = tuple(fields)
+        self.enums = enums
+
+    def __call__(self, *values):
+        self.log.write(self.id, values)
+
+    def format(self, values):
+        parts = [self.name]
+        for i, value in enumerate(values):
+            name = self.fields[i] if i < len(self.fields) else str(i)
+            names = self.enums.get(name)
+            if names is not None and float(value).is_integer() and 0 <= value < len(names):
+                parts.append('{}={}'.format(name, names[int(value)]))
+            else:
+                parts.append('{}={:g}'.format(name, value))
+        return ' '.join(parts)
+
+
+class EventLog(object):
+    def __init__(self, capacity=1 << 16):
+        """ capacity: number of records kept, older ones are overwritten """
+        self.capacity = capacity
+        self.buffer = np.zeros(capacity, dtype=RECORD)
+        self.times = self.buffer['time']
+        self.seqs = self.buffer['seq']
+        self.ids = self.buffer['event']
+        self.n_values = self.buffer['n_values']
+        self.values = self.buffer['values']
+        # next() on a count is atomic in CPython, so writers from several
+        # threads each get their own slot without a lock
+        self.counter = itertools.count()
+        self.events = []
+        self.by_name = {}
+
+    def event(self, name, fields=(), **enums):
+        """
+        declare an event. Declaring the same name again returns the first
+        declaration.
+        fields: names of the values of the event, at most MAX_FIELDS
+        enums: field name -> tuple of names the value of that field indexes
+        """
+        if name in self.by_name:
+            return self.by_name[name]
+        if len(fields) > MAX_FIELDS:
+            raise ValueError('event {} has more than {} fields'.format(name, MAX_FIELDS))
+        event = Event(self, len(self.events), name, fields, enums)
+        self.events.append(event)
+        self.by_name[name] = event
+        return event
+
+    def write(self, event_id, values):
+        seq = next(self.counter)
+        i = seq % self.capacity
+        n = min(len(values), MAX_FIELDS)
+        self.seqs[i] = 0
+        self.times[i] = time.time()
+        self.ids[i] = event_id
+        self.n_values[i] = n
+        self.values[i, :n] = values[:n]
+        # written last, a reader skips the slot until it is complete
+        self.seqs[i] = seq + 1
+
+    def records(self, last=None):
+        """ copy of the records in the order they were written, oldest first """
+        buf = self.buffer.copy()
+        buf = buf[buf['seq'] > 0]
+        buf = buf[np.argsort(buf['seq'])]
+        if last is not None:
+            buf = buf[-last:]
+        return buf
+
+    def lines(self, last=None):
+        lines = []
+        for record in self.records(last):
+            event = self.events[record['event']]
+            values = record['values'][:record['n_values']].tolist()
+            lines.append('{:.6f} {}'.format(record['time'], event.format(values)))
+        return lines
+
+    def text(self, last=None):
+        return '\n'.join(self.lines(last)) + '\n'
+
+    def dump(self, out=None, last=None):
+        """ write the formatted log to out, a path or file object, default stderr """
+        if out is None:
+            out = sys.stderr
+        if hasattr(out, 'write'):
+            out.write(self.text(last))
+            out.flush()
+            return
+        with open(out, 'w') as f:
+            f.write(self.text(last))
+
+    def install_dump_signal(self, path=None, signum=signal.SIGUSR1):
+        """
+        dump the log to path (default event_log.<pid>.txt in the working
+        directory) whenever the process receives signum. Returns the path, or
+        None when not called from the main thread, where signal handlers can
+        not be installed
+        """
+        if path is None:
+            path = 'event_log.{}.txt'.format(os.getpid())
+
+        def on_signal(signum, frame):
+            self.dump(path)
+        try:
+            signal.signal(signum, on_signal)
+        except ValueError:
+            return None
+        return path
+
+
+EVENT_LOG = EventLog()
@@ -0,0 +1,173 @@
+"""
+Server side preprocessing of RENDER frames.
+
+A RENDER request with a RENDER_REQUEST payload asks for the frame cropped,
+resized, in grayscale or another channel order and compressed, rather than
+the raw camera frame. A policy which takes 84x84 inputs then receives and
+decodes about 84x84 bytes instead of a full 640x480x3 frame:
+
+    image, info = rc.render(spec={'size': (84, 84), 'gray': True,
+                                  'compression': 'zlib'})
+
+The frame is cropped, then resized, then converted, and finally compressed.
+RenderCache keeps the reply of every spec until the next camera frame, so
+any number of clients asking for the same spec share one encode.
+
+Resizing uses cv2 (area interpolation) and jpeg and png need it, when it is
+installed. Without it frames are resized by nearest neighbour and only raw
+and zlib compression are available.
+"""
+import collections
+import threading
+import zlib
+
+import numpy as np
+
+from ros_interface.interfaces.protocol import IMAGE_ENCODINGS, RENDER_COMPRESSIONS
+from ros_interface.interfaces.protocol import RENDER_GRAY, RENDER_BGR
+from ros_interface.interfaces.protocol import pack_image_header
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+# luma weights of r, g and b
+GRAY_WEIGHTS = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+
+def resize(image, height, width):
+    """ (height, width, channels) uint8 image resized to height x width """
+    if cv2 is not None:
+        out = cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+        return out.reshape(height, width, image.shape[2])
+    rows = ((np.arange(height) + 0.5) * image.shape[0] / height).astype(np.intp)
+    cols = ((np.arange(width) + 0.5) * image.shape[1] / width).astype(np.intp)
+    return image[rows][:, cols]
+
+
+def preprocess(data, height, width, encoding, spec):
+    """
+    apply the crop, resize and color conversion of spec (see
+    unpack_render_request) to the raw pixels in data. Returns the
+    contiguous (height, width, channels) uint8 output and its encoding
+    """
+    x, y, crop_width, crop_height, out_height, out_width, flags = spec[:7]
+    dtype, channels = IMAGE_ENCODINGS.get(encoding, ('u1', None))
+    if dtype != 'u1' or channels not in (1, 3, 4):
+        raise ValueError('can not preprocess {} frames'.format(encoding))
+    image = np.frombuffer(data, dtype=np.uint8,
+                          count=height * width * channels).reshape(height, width, channels)
+    if crop_width and crop_height:
+        image = image[y:y + crop_height, x:x + crop_width]
+        if not image.size:
+            raise ValueError('crop {} is outside of the {}x{} frame'.format(
+                spec[:4], width, height))
+    if out_height and out_width:
+        image = resize(image, out_height, out_width)
+    if channels == 1:
+        return np.ascontiguousarray(image), 'mono8'
+    source_bgr = encoding.startswith('bgr')
+    image = image[..., :3]
+    if flags & RENDER_GRAY:
+        weights = GRAY_WEIGHTS[::-1] if source_bgr else GRAY_WEIGHTS
+        gray = np.dot(image, weights) + 0.5
+        return gray.astype(np.uint8)[..., np.newaxis], 'mono8'
+    bgr = bool(flags & RENDER_BGR)
+    if bgr != source_bgr:
+        image = image[..., ::-1]
+    return np.ascontiguousarray(image), 'bgr8' if bgr else 'rgb8'
+
+
+def encode_image(image, encoding, compression, quality=0):
+    """ compressed bytes of a preprocessed image and the encoding of the reply """
+    if compression == 'raw':
+        return image.tobytes(), encoding
+    if compression == 'zlib':
+        data = zlib.compress(image.tobytes(), quality or 1)
+    else:
+        if cv2 is None:
+            raise ValueError('{} compression needs opencv (cv2)'.format(compression))
+        if encoding == 'rgb8':
+            # opencv expects bgr
+            image = image[..., ::-1]
+        if compression == 'jpeg':
+            params = [cv2.IMWRITE_JPEG_QUALITY, quality or 90]
+        else:
+            params = [cv2.IMWRITE_PNG_COMPRESSION, quality or 1]
+        ok, data = cv2.imencode('.jpg' if compression == 'jpeg' else '.png', image, params)
+        if not ok:
+            raise ValueError('{} encoding failed'.format(compression))
+        data = data.tobytes()
+    return data, '{}/{}'.format(encoding, compression)
+
+
+def decode_image(data, info):
+    """
+    (height, width, channels) array of a RENDER reply with info (see
+    unpack_image_header) whose encoding carries a compression
+    """
+    encoding, compression = info['encoding'].split('/')
+    channels = 1 if encoding == 'mono8' else 3
+    if compression == 'zlib':
+        image = np.frombuffer(zlib.decompress(bytes(data)), dtype=np.uint8)
+    elif compression in ('jpeg', 'png'):
+        if cv2 is None:
+            raise ValueError('{} frames need opencv (cv2) to decode'.format(compression))
+        image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+        if encoding == 'rgb8':
+            image = image[..., ::-1]
+    else:
+        raise ValueError('unknown compression {}'.format(compression))
+    return np.ascontiguousarray(image).reshape(info['height'], info['width'], channels)
+
+
+def render_image(image, spec):
+    """
+    reply parts - render header and encoded pixels - of a frame in the
+    latest_image format preprocessed and compressed as spec asks
+    """
+    seq, stamp, height, width, encoding, data = image
+    out, out_encoding = preprocess(data, height, width, encoding, spec)
+    payload, reply_encoding = encode_image(out, out_encoding, RENDER_COMPRESSIONS[spec[7]],
+                                           spec[8])
+    return [pack_image_header(seq, stamp, out.shape[0], out.shape[1], reply_encoding,
+                              len(payload)), payload]
+
+
+class RenderCache(object):
+    """
+    replies to RENDER requests with a spec for one camera. The reply of
+    each spec is kept until a newer frame arrives. Requests for a spec
+    which is being encoded wait for that encode instead of starting their
+    own
+    """
+    def __init__(self, max_specs=16):
+        """ max_specs: number of specs kept, the least recently used is dropped """
+        self.max_specs = max_specs
+        self.lock = threading.Lock()
+        # spec -> [lock, frame seq, reply parts]
+        self.entries = collections.OrderedDict()
+        self.encodes = 0
+        self.hits = 0
+
+    def render(self, image, spec):
+        """
+        image: the frame as returned by latest_image. Returns the reply
+        parts - render header and encoded pixels - and whether they were
+        cached
+        """
+        seq = image[0]
+        with self.lock:
+            entry = self.entries.pop(spec, None) or [threading.Lock(), None, None]
+            self.entries[spec] = entry
+            while len(self.entries) > self.max_specs:
+                self.entries.popitem(last=False)
+        with entry[0]:
+            if entry[1] == seq:
+                self.hits += 1
+                return entry[2], True
+            entry[2] = render_image(image, spec)
+            entry[1] = seq
+            self.encodes += 1
+            return entry[2], False
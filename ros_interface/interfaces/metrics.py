@@ -0,0 +1,298 @@
+"""
+In process counters, gauges and latency histograms.
+
+RobotServer and JacoInterface each keep a MetricsRegistry. Recording a value
+is a dict lookup and an integer update under a lock, so it is cheap enough for
+every request and every state callback. The registry is read as a dict
+(snapshot, returned by the STATS command) or in the Prometheus text format
+(prometheus_text, optionally served over http by serve_metrics).
+
+Metrics are identified by name and labels:
+
+    metrics.counter('server_requests_total', 'requests received', fn='STEP').inc()
+    metrics.histogram('jaco_step_seconds', 'step duration', type='VEL').observe(0.05)
+
+Callers on hot paths may keep the returned metric instead of looking it up
+every time.
+"""
+import bisect
+import threading
+import time
+
+# seconds, 50us doubling up to about 52s
+LATENCY_BUCKETS = tuple(0.00005 * 2 ** i for i in range(21))
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Counter(object):
+    kind = 'counter'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, n=1):
+        with self.lock:
+            self.value += n
+
+    def get(self):
+        return self.value
+
+    def sample(self):
+        return {'value': self.value}
+
+
+class Gauge(object):
+    kind = 'gauge'
+
+    def __init__(self, fn=None):
+        """ fn: optional callable returning the value when the gauge is read """
+        self.value = 0.0
+        self.fn = fn
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        if self.fn is not None:
+            return self.fn()
+        return self.value
+
+    def sample(self):
+        return {'value': self.get()}
+
+
+class Histogram(object):
+    kind = 'histogram'
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        """ bounds: increasing upper bounds of the buckets, +Inf is added """
+        self.lock = threading.Lock()
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+            if value > self.max:
+                self.max = value
+
+    def quantile(self, q):
+        """ upper bound of the bucket holding the q quantile, max for the last one """
+        with self.lock:
+            counts = list(self.counts)
+            count = self.count
+        if not count:
+            return 0.0
+        rank = q * count
+        seen = 0
+        for i, n in enumerate(counts):
+            seen += n
+            if seen >= rank:
+                return self.bounds[i] if i < len(self.bounds) else self.max
+        return self.max
+
+    def sample(self):
+        sample = {'count': self.count, 'sum': self.sum, 'max': self.max,
+                  'buckets': list(self.counts)}
+        for q in QUANTILES:
+            sample['p%d' % int(q * 100)] = self.quantile(q)
+        return sample
+
+
+class RateMeter(object):
+    """
+    rate and inter-arrival jitter of a stream of events such as topic
+    callbacks. Every tick observes the interval since the previous one, and
+    how far it is from the running mean interval as jitter
+    """
+    def __init__(self, metrics, name, smoothing=0.01, **labels):
+        self.count = metrics.counter(name + '_total', 'messages received', **labels)
+        self.interval = metrics.histogram(name + '_interval_seconds',
+                                          'seconds between messages', **labels)
+        self.jitter = metrics.histogram(name + '_jitter_seconds',
+                                        'distance of an interval from the mean interval',
+                                        **labels)
+        self.rate = metrics.gauge(name + '_rate_hz', 'messages per second, smoothed',
+                                  **labels)
+        self.smoothing = smoothing
+        self.last = None
+        self.mean_interval = None
+
+    def tick(self, now=None):
+        if now is None:
+            now = time.time()
+        self.count.inc()
+        last, self.last = self.last, now
+        if last is None:
+            return
+        interval = now - last
+        self.interval.observe(interval)
+        if self.mean_interval is None:
+            self.mean_interval = interval
+        self.jitter.observe(abs(interval - self.mean_interval))
+        self.mean_interval += self.smoothing * (interval - self.mean_interval)
+        if self.mean_interval > 0:
+            self.rate.set(1.0 / self.mean_interval)
+
+
+class MetricsRegistry(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        # name -> (kind, help, {label items: metric})
+        self.families = {}
+
+    def get(self, cls, name, help, labels, **kwargs):
+        key = tuple(sorted(labels.items()))
+        family = self.families.get(name)
+        if family is not None:
+            metric = family[2].get(key)
+            if metric is not None:
+                return metric
+        with self.lock:
+            family = self.families.setdefault(name, (cls.kind, help, {}))
+            if family[0] != cls.kind:
+                raise ValueError('{} is a {}, not a {}'.format(name, family[0], cls.kind))
+            metric = family[2].get(key)
+            if metric is None:
+                metric = family[2][key] = cls(**kwargs)
+            return metric
+
+    def counter(self, name, help='', **labels):
+        return self.get(Counter, name, help, labels)
+
+    def gauge(self, name, help='', fn=None, **labels):
+        return self.get(Gauge, name, help, labels, fn=fn)
+
+    def histogram(self, name, help='', buckets=LATENCY_BUCKETS, **labels):
+        return self.get(Histogram, name, help, labels, bounds=buckets)
+
+    def items(self):
+        with self.lock:
+            return [(name, kind, help, list(metrics.items()))
+                    for name, (kind, help, metrics) in sorted(self.families.items())]
+
+    def snapshot(self):
+        """
+        {name: {'type', 'help', 'samples': [{'labels', values...}]}} of every
+        metric. Histogram samples have count, sum, max, bucket counts and
+        the p50, p95 and p99 bucket bounds
+        """
+        snapshot = {}
+        for name, kind, help, metrics in self.items():
+            samples = []
+            for key, metric in metrics:
+                sample = metric.sample()
+                sample['labels'] = dict(key)
+                samples.append(sample)
+            snapshot[name] = {'type': kind, 'help': help, 'samples': samples}
+            if kind == 'histogram' and metrics:
+                snapshot[name]['bounds'] = list(metrics[0][1].bounds)
+        return snapshot
+
+    def prometheus_text(self):
+        lines = []
+        for name, kind, help, metrics in self.items():
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for key, metric in metrics:
+                if kind != 'histogram':
+                    lines.append('{}{} {!r}'.format(name, format_labels(key),
+                                                    float(metric.get())))
+                    continue
+                cumulative = 0
+                for bound, n in zip(metric.bounds + ('+Inf',), metric.counts):
+                    cumulative += n
+                    le = bound if bound == '+Inf' else repr(float(bound))
+                    lines.append('{}_bucket{} {}'.format(
+                        name, format_labels(key + (('le', le),)), cumulative))
+                lines.append('{}_sum{} {!r}'.format(name, format_labels(key), metric.sum))
+                lines.append('{}_count{} {}'.format(name, format_labels(key), metric.count))
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(items):
+    if not items:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                          for k, v in items) + '}'
+
+
+def merge_prometheus_texts(texts):
+    """
+    one Prometheus text of the texts of several registries, with the labels
+    given with each text added to all of its samples. The samples of a
+    metric which is in more than one text are kept together under one
+    HELP and TYPE. texts: list of (labels dict, text)
+    """
+    names = []
+    families = {}
+    for labels, text in texts:
+        extra = format_labels(sorted(labels.items()))[1:-1]
+        family = None
+        for line in text.splitlines():
+            if not line:
+                continue
+            if line.startswith('# '):
+                kind, name = line.split(' ', 3)[1:3]
+                if name not in families:
+                    families[name] = ({}, [])
+                    names.append(name)
+                family = families[name]
+                family[0].setdefault(kind, line)
+                continue
+            sample, value = line.rsplit(' ', 1)
+            if not extra:
+                family[1].append(line)
+            elif sample.endswith('}'):
+                family[1].append('{},{}}} {}'.format(sample[:-1], extra, value))
+            else:
+                family[1].append('{}{{{}}} {}'.format(sample, extra, value))
+    lines = []
+    for name in names:
+        headers, samples = families[name]
+        lines += [headers[kind] for kind in ('HELP', 'TYPE') if kind in headers]
+        lines += samples
+    return '\n'.join(lines) + '\n'
+
+
+def serve_metrics(port, collect, host='127.0.0.1'):
+    """
+    serve collect() as Prometheus text on http://host:port/metrics from a
+    daemon thread. Returns the http server
+    """
+    try:
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+    except ImportError:
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            try:
+                body = collect().encode('utf-8')
+            except Exception as e:
+                self.send_error(500, str(e))
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = HTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics_http')
+    thread.daemon = True
+    thread.start()
+    return server
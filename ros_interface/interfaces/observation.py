@@ -0,0 +1,86 @@
+"""
+Time aligned observations: robot state and camera frame of the same moment.
+
+The server keeps the last frames of every camera and the last state stream
+rows of every robot in StampRings, indexed by their ROS header stamps. An
+OBSERVE request names a time - the stamp of the latest state by default -
+and gets the state nearest to it together with the frame nearest to it, or
+the two frames around it blended, plus how far apart the stamps of state
+and frame are:
+
+    obs = rc.observe(spec={'size': (84, 84)})
+    obs['state']['joint_pos'], obs['image'], obs['skew']
+
+so a vision policy can tell how stale its image is relative to the joint
+state, and need not wait for a later frame to get a consistent pair.
+"""
+import collections
+import threading
+
+import numpy as np
+
+from ros_interface.interfaces.protocol import IMAGE_ENCODINGS
+
+
+class StampRing(object):
+    """
+    the last capacity items of a sensor and their stamps. Appended to from
+    the subscriber thread of the sensor and read from any other
+    """
+    def __init__(self, capacity):
+        self.lock = threading.Lock()
+        # (stamp, item) in the order they arrived
+        self.items = collections.deque(maxlen=capacity)
+
+    def __len__(self):
+        return len(self.items)
+
+    def append(self, stamp, item):
+        with self.lock:
+            self.items.append((stamp, item))
+
+    def latest(self):
+        """ (stamp, item) of the newest item, None while empty """
+        with self.lock:
+            return self.items[-1] if self.items else None
+
+    def nearest(self, stamp):
+        """ (stamp, item) of the item whose stamp is nearest to stamp, None while empty """
+        with self.lock:
+            items = list(self.items)
+        if not items:
+            return None
+        return min(items, key=lambda entry: abs(entry[0] - stamp))
+
+    def around(self, stamp):
+        """
+        the newest (stamp, item) at or before stamp and the oldest after
+        it, None when stamp is not between two items
+        """
+        with self.lock:
+            items = list(self.items)
+        before = [entry for entry in items if entry[0] <= stamp]
+        after = [entry for entry in items if entry[0] > stamp]
+        if not before or not after:
+            return None
+        return (max(before, key=lambda entry: entry[0]),
+                min(after, key=lambda entry: entry[0]))
+
+
+def blend_frames(first, second, stamp):
+    """
+    frame at stamp linearly interpolated between two frames in the
+    latest_image format (seq, stamp, height, width, encoding, data). Returns
+    None when they can not be blended, for instance after a change of
+    resolution
+    """
+    if first[2:5] != second[2:5] or len(first[5]) != len(second[5]):
+        return None
+    if IMAGE_ENCODINGS.get(first[4], ('u1', None))[0] != 'u1':
+        return None
+    weight = (stamp - first[1]) / (second[1] - first[1])
+    a = np.frombuffer(first[5], dtype=np.uint8).astype(np.float32)
+    b = np.frombuffer(second[5], dtype=np.uint8).astype(np.float32)
+    data = (a + (b - a) * weight + 0.5).astype(np.uint8).tobytes()
+    seq = first[0] if weight < 0.5 else second[0]
+    return (seq, stamp) + tuple(first[2:5]) + (data,)
@@ -0,0 +1,502 @@
+"""
+Binary wire protocol shared by RobotServer and RobotCommunicator.
+
+Every binary message is a fixed header followed by a payload of `length` bytes:
+
+    magic (2s) 'RI' | version (B) | fn (B) | flags (B) | robot (B) | request_id (I) | length (I)
+
+robot selects which of the arms of a multi-robot server a request is for,
+and replies carry the robot of their request. Version 1 had a pad byte in
+its place, so version 1 requests address robot 0. They are still accepted
+and answered with version 1 headers and version 1 states, which end before
+tracking_error.
+
+All numbers are little endian. Commands and states are sent as float64 arrays
+so neither side has to format or parse strings. A connection whose first bytes
+are the text start sequence '<|' keeps using the original text protocol.
+"""
+import struct
+import numpy as np
+
+PROTOCOL_VERSION = 2
+SUPPORTED_VERSIONS = (1, 2)
+MAGIC = b'RI'
+TEXT_START = b'<|'
+
+HEADER = struct.Struct('<2sBBBBII')
+
+FN_CODES = {
+    'INIT': 1,
+    'RESET': 2,
+    'STEP': 3,
+    'GET_STATE': 4,
+    'HOME': 5,
+    'RENDER': 6,
+    'END': 7,
+    'STEP_BATCH': 8,
+    'SUBSCRIBE': 9,
+    'UNSUBSCRIBE': 10,
+    'STATS': 11,
+    'SYNC_STEP': 12,
+    'ROBOTS': 13,
+    'SHM_OPEN': 14,
+    'OBSERVE': 15,
+}
+FN_NAMES = dict((code, name) for name, code in FN_CODES.items())
+# names indexed by fn code, '' for unused codes
+FN_NAME_TABLE = tuple(FN_NAMES.get(code, '') for code in range(max(FN_NAMES) + 1))
+
+# reply flags
+FLAG_REPLY = 0x01
+FLAG_ERROR = 0x02
+# frame pushed by the server for a subscription. Its request_id is the id of
+# the SUBSCRIBE request
+FLAG_PUSH = 0x04
+# set on a request to have the server time its hops. The reply then also has
+# FLAG_TIMING set and ends with a TIMING trailer after the normal payload
+FLAG_TIMING = 0x08
+# seconds the server spent in its handler, in the ROS service call, and, for
+# steps, in JacoInterface running the command and collecting the state
+TIMING_FIELDS = ('handle', 'service', 'command', 'state')
+TIMING = struct.Struct('<%dd' % len(TIMING_FIELDS))
+
+# step payload header: type, unit, flags, trace decimation (see srv/step.srv),
+# n_rows, followed by float64 data
+STEP_HEADER = struct.Struct('<BBBBI')
+STEP_RELATIVE = 0x01
+# reply as soon as the command started instead of when it finished
+STEP_NOWAIT = 0x02
+STEP_TYPES = ('VEL', 'ANGLE', 'TOOL', 'TRAJECTORY')
+STEP_UNITS = ('deg', 'rad', 'mdeg', 'mrad', 'mq')
+
+# state payload header: success, msg length, n_states, length of each state
+# field, followed by the msg bytes and the float64 data of each field.
+# tracking_error is only filled in by TRAJECTORY steps
+STATE_FIELDS = ('time_offset', 'joint_pos', 'joint_vel', 'joint_effort',
+                'tool_pos', 'finger_pos', 'tracking_error')
+# fields with one row per sample of a state trace
+STATE_TRACE_FIELDS = STATE_FIELDS[1:6]
+STATE_HEADER = struct.Struct('<?xHq%dI' % len(STATE_FIELDS))
+# fields and header of the state payload per protocol version
+STATE_LAYOUTS = {
+    1: (STATE_FIELDS[:6], struct.Struct('<?xHq6I')),
+    2: (STATE_FIELDS, STATE_HEADER),
+}
+
+# step batch reply header: success, msg length, n_actions, n_joint_states,
+# followed by the msg bytes and n_actions rows of float64 states laid out as
+# described in srv/step_batch.srv
+BATCH_HEADER = struct.Struct('<?xHII')
+BATCH_STATE_FIELDS = (('success', 1), ('n_states', 1), ('time_offset', 1),
+                      ('joint_pos', None), ('joint_vel', None),
+                      ('joint_effort', None), ('tool_pos', 7), ('finger_pos', 3))
+
+HOME_REPLY = struct.Struct('<?')
+# init payload: number of keep-in and keep-out boxes followed by the boxes as
+# float64 [min_x, max_x, min_y, max_y, min_z, max_z] rows, keep-in first. A
+# payload of just the 6 floats of one keep-in box is also accepted
+FENCE_HEADER = struct.Struct('<II')
+FENCE_BOX_SIZE = 6
+# optional get state payload: trace decimation
+GET_STATE_REQUEST = struct.Struct('<I')
+
+# stats payload: optional format, b'json' (default), b'prometheus' or
+# b'events'. The reply is the utf-8 text of the metrics, or of the event logs,
+# of the server and JacoInterface
+STATS_FORMATS = ('json', 'prometheus', 'events')
+
+# sync step payload: number of steps, then for each a SYNC_ENTRY of the robot
+# and the length of its step payload (see pack_step), followed by that
+# payload. The server starts every step at once and replies when all are
+# done, with a SYNC_ENTRY and a state payload (see pack_state) per robot in
+# the same order. The robot of the header is not used
+SYNC_HEADER = struct.Struct('<I')
+SYNC_ENTRY = struct.Struct('<BxxxI')
+
+# robots reply: utf-8 json list of the names of the robots of the server,
+# indexed by robot selector
+
+# subscribe payload: max rate in Hz (0 for every update), decimation (push
+# every nth update) and a bit mask of the STREAM_FIELDS to send
+SUBSCRIBE_REQUEST = struct.Struct('<dII')
+# unsubscribe payload: request_id of the SUBSCRIBE request
+UNSUBSCRIBE_REQUEST = struct.Struct('<I')
+STREAM_FIELDS = ('joint_pos', 'joint_vel', 'joint_effort', 'tool_pos',
+                 'finger_pos')
+ALL_STREAM_FIELDS = (1 << len(STREAM_FIELDS)) - 1
+# pushed state header: stamp, n_states, n_joint_states, field mask, followed
+# by the float64 values of the fields in the mask
+STREAM_HEADER = struct.Struct('<dqII')
+
+# render payload header: sequence number, stamp, height, width, encoding and
+# number of bytes of the raw pixel buffer which directly follows the header
+IMAGE_HEADER = struct.Struct('<IdII16sI')
+# dtype and number of channels for the sensor_msgs/Image encodings we expect
+IMAGE_ENCODINGS = {
+    'rgb8': ('u1', 3),
+    'bgr8': ('u1', 3),
+    'rgba8': ('u1', 4),
+    'bgra8': ('u1', 4),
+    'mono8': ('u1', 1),
+    '8UC1': ('u1', 1),
+    '8UC3': ('u1', 3),
+    'mono16': ('<u2', 1),
+    '16UC1': ('<u2', 1),
+    '32FC1': ('<f4', 1),
+}
+# optional render payload, the output wanted instead of the raw frame: crop
+# x, y, width and height (width 0: no crop), output height and width (0: no
+# resize), RENDER_* flags, index into RENDER_COMPRESSIONS and quality (jpeg
+# quality, zlib and png compression level, 0: default). The reply header has
+# the output height and width and encoding, e.g. 'mono8', followed by
+# '/<compression>' unless raw, and nbytes of the compressed pixels
+RENDER_REQUEST = struct.Struct('<HHHHHHBBB')
+RENDER_GRAY = 0x01
+# channel order of color output, rgb unless set
+RENDER_BGR = 0x02
+RENDER_COMPRESSIONS = ('raw', 'zlib', 'jpeg', 'png')
+
+# observe payload: time (0 for the stamp of the latest state) and OBSERVE_*
+# flags, optionally followed by a RENDER_REQUEST for the frame. The reply
+# header has the stamps of the state and of the frame, the skew (frame stamp
+# minus state stamp) and the length of the state, which follows in the
+# pushed state format (see pack_state_push) with every STREAM_FIELD. Then
+# comes the frame as in RENDER replies
+OBSERVE_REQUEST = struct.Struct('<dB')
+# blend the frames before and after the time rather than taking the nearest
+OBSERVE_INTERPOLATE = 0x01
+OBSERVE_REPLY = struct.Struct('<dddI')
+
+FLOAT64 = np.dtype('<f8')
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def pack_header(fn, length, flags=0, request_id=0, robot=0, version=PROTOCOL_VERSION):
+    """ version: the server replies in the version of the request """
+    return HEADER.pack(MAGIC, version, fn, flags, robot, request_id, length)
+
+
+def unpack_header(buf):
+    """ returns fn, flags, request_id, length, robot of a received header """
+    magic, version, fn, flags, robot, request_id, length = HEADER.unpack_from(buf)
+    if magic != MAGIC:
+        raise ProtocolError('bad magic {!r}'.format(magic))
+    if version not in SUPPORTED_VERSIONS:
+        raise ProtocolError('unsupported protocol version {}'.format(version))
+    return fn, flags, request_id, length, robot
+
+
+def pack_timing(timing):
+    """ TIMING trailer of a dict with some of TIMING_FIELDS, missing ones are 0 """
+    return TIMING.pack(*[timing.get(name, 0.0) for name in TIMING_FIELDS])
+
+
+def unpack_timing(buf):
+    return dict(zip(TIMING_FIELDS, TIMING.unpack_from(buf)))
+
+
+def pack_floats(values):
+    return np.ascontiguousarray(values, dtype=FLOAT64).tobytes()
+
+
+def unpack_floats(buf, length, offset=0):
+    return np.frombuffer(buf, dtype=FLOAT64, count=(length - offset) // 8,
+                         offset=offset)
+
+
+def pack_fence(keep_in, keep_out=None):
+    keep_in = np.ascontiguousarray(keep_in, dtype=FLOAT64).reshape(-1, FENCE_BOX_SIZE)
+    if keep_out is None:
+        keep_out = np.zeros((0, FENCE_BOX_SIZE))
+    keep_out = np.ascontiguousarray(keep_out, dtype=FLOAT64).reshape(-1, FENCE_BOX_SIZE)
+    if len(keep_in) == 1 and not len(keep_out):
+        return keep_in.tobytes()
+    header = FENCE_HEADER.pack(len(keep_in), len(keep_out))
+    return header + keep_in.tobytes() + keep_out.tobytes()
+
+
+def unpack_fence(buf, length):
+    """ returns the keep-in and keep-out boxes as (n,6) float64 arrays """
+    if length == FENCE_BOX_SIZE * 8:
+        return unpack_floats(buf, length).reshape(1, FENCE_BOX_SIZE), np.zeros((0, FENCE_BOX_SIZE))
+    n_keep_in, n_keep_out = FENCE_HEADER.unpack_from(buf)
+    boxes = unpack_floats(buf, length, FENCE_HEADER.size).reshape(-1, FENCE_BOX_SIZE)
+    if len(boxes) != n_keep_in + n_keep_out:
+        raise ProtocolError('fence of {} boxes does not match its header of {} + {}'.format(
+            len(boxes), n_keep_in, n_keep_out))
+    return boxes[:n_keep_in], boxes[n_keep_in:]
+
+
+def pack_step(ctype, relative, unit, data, trace_decimation=0, nowait=False):
+    """
+    ctype: one of STEP_TYPES
+    relative: bool
+    unit: one of STEP_UNITS
+    data: float values of the command, as described in srv/step.srv
+    trace_decimation: 0 for the latest state only, n for every nth state
+        sample received during the step
+    nowait: reply once the command started rather than finished
+    """
+    data = np.ascontiguousarray(data, dtype=FLOAT64)
+    flags = (STEP_RELATIVE if relative else 0) | (STEP_NOWAIT if nowait else 0)
+    header = STEP_HEADER.pack(STEP_TYPES.index(ctype), STEP_UNITS.index(unit),
+                              flags, trace_decimation, 1)
+    return header + data.tobytes()
+
+
+def unpack_step(buf, length):
+    """
+    returns ctype, relative, unit, data, trace_decimation, nowait from a step
+    payload
+    """
+    ctype, unit, flags, trace_decimation, n_rows = STEP_HEADER.unpack_from(buf)
+    data = unpack_floats(buf, length, STEP_HEADER.size)
+    return (STEP_TYPES[ctype], bool(flags & STEP_RELATIVE), STEP_UNITS[unit],
+            data, trace_decimation, bool(flags & STEP_NOWAIT))
+
+
+def pack_step_batch(ctype, relative, unit, actions):
+    """ actions: (n_actions, action_len) array of step data of the same type """
+    actions = np.ascontiguousarray(actions, dtype=FLOAT64)
+    if actions.ndim != 2:
+        raise ValueError('actions must be (n_actions, action_len), got {}'.format(
+            actions.shape))
+    flags = STEP_RELATIVE if relative else 0
+    header = STEP_HEADER.pack(STEP_TYPES.index(ctype), STEP_UNITS.index(unit),
+                              flags, 0, actions.shape[0])
+    return header + actions.tobytes()
+
+
+def unpack_step_batch(buf, length):
+    """ returns ctype, relative, unit, n_actions, flat data from a step batch payload """
+    ctype, unit, flags, trace_decimation, n_rows = STEP_HEADER.unpack_from(buf)
+    data = unpack_floats(buf, length, STEP_HEADER.size)
+    return (STEP_TYPES[ctype], bool(flags & STEP_RELATIVE), STEP_UNITS[unit],
+            n_rows, data)
+
+
+def pack_sync(entries):
+    """
+    entries: list of (robot, payload) - the step payloads of a SYNC_STEP
+    request, or the state payloads of its reply
+    """
+    parts = [SYNC_HEADER.pack(len(entries))]
+    for robot, payload in entries:
+        parts.append(SYNC_ENTRY.pack(robot, len(payload)))
+        parts.append(payload)
+    return b''.join(parts)
+
+
+def unpack_sync(buf, length):
+    """ list of (robot, payload) of a SYNC_STEP request or reply """
+    n, = SYNC_HEADER.unpack_from(buf)
+    offset = SYNC_HEADER.size
+    entries = []
+    for i in range(n):
+        robot, size = SYNC_ENTRY.unpack_from(buf, offset)
+        offset += SYNC_ENTRY.size
+        if offset + size > length:
+            raise ProtocolError('sync entry {} of {} bytes does not fit in {}'.format(
+                i, size, length))
+        entries.append((robot, buf[offset:offset + size]))
+        offset += size
+    return entries
+
+
+def pack_batch_states(response):
+    """ pack a step_batch service response """
+    msg = response.msg.encode('utf-8')
+    header = BATCH_HEADER.pack(response.success, len(msg), response.n_actions,
+                               response.n_joint_states)
+    states = np.ascontiguousarray(response.states, dtype=FLOAT64)
+    return b''.join([header, msg, states.tobytes()])
+
+
+def unpack_batch_states(buf, length):
+    """
+    returns a dict with success, msg and the (n_actions, width) states array
+    along with a view of each state field (see split_batch_states)
+    """
+    success, msg_len, n_actions, n_joint_states = BATCH_HEADER.unpack_from(buf)
+    offset = BATCH_HEADER.size
+    batch = {'success': success,
+             'msg': bytes(buf[offset:offset + msg_len]).decode('utf-8'),
+             'n_actions': n_actions}
+    states = unpack_floats(buf, length, offset + msg_len)
+    batch.update(split_batch_states(states.reshape(n_actions, -1), n_joint_states))
+    return batch
+
+
+def split_batch_states(states, n_joint_states):
+    """ name the columns of (n_actions, width) batch states without copying """
+    fields = {'states': states}
+    col = 0
+    for name, width in BATCH_STATE_FIELDS:
+        if width is None:
+            width = n_joint_states
+        if width == 1:
+            fields[name] = states[:, col]
+        else:
+            fields[name] = states[:, col:col + width]
+        col += width
+    return fields
+
+
+def pack_state(response, version=PROTOCOL_VERSION):
+    """
+    pack a get_state/reset/step/initialize service response in the state
+    layout of version
+    """
+    names, state_header = STATE_LAYOUTS[version]
+    msg = response.msg.encode('utf-8')
+    fields = [np.ascontiguousarray(getattr(response, name, ()), dtype=FLOAT64)
+              for name in names]
+    header = state_header.pack(response.success, len(msg), response.n_states,
+                               *[f.size for f in fields])
+    return b''.join([header, msg] + [f.tobytes() for f in fields])
+
+
+def unpack_state(buf, length=None, version=PROTOCOL_VERSION):
+    """
+    returns a dict of the state fields of version as float64 arrays. A state
+    trace with several samples has one row per sample
+    """
+    names, state_header = STATE_LAYOUTS[version]
+    values = state_header.unpack_from(buf)
+    success, msg_len, n_states = values[:3]
+    offset = state_header.size
+    state = {'success': success,
+             'msg': bytes(buf[offset:offset + msg_len]).decode('utf-8'),
+             'n_states': n_states}
+    offset += msg_len
+    for name, count in zip(names, values[3:]):
+        state[name] = np.frombuffer(buf, dtype=FLOAT64, count=count,
+                                    offset=offset)
+        offset += count * 8
+    n_samples = len(state['time_offset'])
+    if n_samples > 1:
+        for name in STATE_TRACE_FIELDS:
+            state[name] = state[name].reshape(n_samples, -1)
+    return state
+
+
+def stream_field_mask(fields):
+    mask = 0
+    for name in fields:
+        mask |= 1 << STREAM_FIELDS.index(name)
+    return mask
+
+
+def stream_field_sizes(n_joint_states):
+    return (n_joint_states, n_joint_states, n_joint_states, 7, 3)
+
+
+def pack_state_push(stamp, n_states, n_joint_states, mask, values):
+    """ values: list of the float64 arrays of every STREAM_FIELD """
+    header = STREAM_HEADER.pack(stamp, n_states, n_joint_states, mask)
+    return b''.join([header] + [np.ascontiguousarray(v, dtype=FLOAT64).tobytes()
+                                for i, v in enumerate(values) if mask & (1 << i)])
+
+
+def unpack_state_push(buf, length):
+    stamp, n_states, n_joint_states, mask = STREAM_HEADER.unpack_from(buf)
+    state = {'stamp': stamp, 'n_states': n_states}
+    offset = STREAM_HEADER.size
+    for i, count in enumerate(stream_field_sizes(n_joint_states)):
+        if mask & (1 << i):
+            state[STREAM_FIELDS[i]] = np.frombuffer(buf, dtype=FLOAT64,
+                                                    count=count, offset=offset)
+            offset += count * 8
+    return state
+
+
+def pack_image_header(seq, stamp, height, width, encoding, nbytes):
+    return IMAGE_HEADER.pack(seq, stamp, height, width,
+                             encoding.encode('utf-8'), nbytes)
+
+
+def unpack_image_header(buf):
+    seq, stamp, height, width, encoding, nbytes = IMAGE_HEADER.unpack_from(buf)
+    return {'seq': seq, 'stamp': stamp, 'height': height, 'width': width,
+            'encoding': encoding.rstrip(b'\0').decode('utf-8'),
+            'nbytes': nbytes}
+
+
+def pack_render_request(crop=None, size=None, gray=False, bgr=False, compression='raw',
+                        quality=0):
+    """
+    crop: (x, y, width, height) of the frame to keep
+    size: (height, width) to resize the frame, after cropping, to
+    """
+    x, y, crop_width, crop_height = crop or (0, 0, 0, 0)
+    height, width = size or (0, 0)
+    flags = (RENDER_GRAY if gray else 0) | (RENDER_BGR if bgr else 0)
+    return RENDER_REQUEST.pack(x, y, crop_width, crop_height, height, width, flags,
+                               RENDER_COMPRESSIONS.index(compression), quality)
+
+
+def unpack_render_request(buf, length):
+    """ the render spec as a tuple, usable as a cache key, None for the raw frame """
+    if length < RENDER_REQUEST.size:
+        return None
+    spec = RENDER_REQUEST.unpack_from(buf)
+    if spec[7] >= len(RENDER_COMPRESSIONS):
+        raise ProtocolError('unknown render compression {}'.format(spec[7]))
+    return spec
+
+
+def image_array(buf, info):
+    """
+    view the raw pixel bytes in buf (uint8 array) as (height, width, channels)
+    without copying
+    """
+    dtype, channels = IMAGE_ENCODINGS.get(info['encoding'], ('u1', None))
+    if channels is None:
+        channels = info['nbytes'] // (info['height'] * info['width'])
+    count = info['height'] * info['width'] * channels
+    return buf[:info['nbytes']].view(dtype)[:count].reshape(
+        info['height'], info['width'], channels)
+
+
+class FrameReader():
+    """
+    Reads binary frames from a socket with recv_into so each message lands in
+    a preallocated buffer instead of a new string.
+    """
+    def __init__(self, sock, size=1 << 16):
+        self.sock = sock
+        self.header = bytearray(HEADER.size)
+        self.header_view = memoryview(self.header)
+        self.payload = bytearray(size)
+        self.payload_view = memoryview(self.payload)
+
+    def recv_exact(self, view, n):
+        got = 0
+        while got < n:
+            nbytes = self.sock.recv_into(view[got:n], n - got)
+            if not nbytes:
+                raise EOFError('connection closed')
+            got += nbytes
+
+    def read_header(self):
+        """ returns fn, flags, request_id, length, robot and leaves the payload unread """
+        self.recv_exact(self.header_view, HEADER.size)
+        return unpack_header(self.header)
+
+    def read_frame(self):
+        """
+        returns fn, flags, request_id, length, robot. The payload is in
+        self.payload[:length] until the next call.
+        """
+        fn, flags, request_id, length, robot = self.read_header()
+        self.read_payload(length)
+        return fn, flags, request_id, length, robot
+
+    def read_payload(self, length):
+        if length > len(self.payload):
+            self.payload = bytearray(length)
+            self.payload_view = memoryview(self.payload)
+        self.recv_exact(self.payload_view, length)
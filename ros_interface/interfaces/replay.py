@@ -0,0 +1,347 @@
+#! /usr/bin/env python
+"""
+Serve recorded episodes through the robot server instead of the robot.
+
+ReplayBackend stands in for JacoInterface behind RobotServer: INIT, RESET,
+HOME, STEP, STEP_BATCH and GET_STATE are answered from episodes recorded with
+the ~record_dir param of the jaco interface (robots/episode_store.py), so
+clients can be regression tested and profiled without the robot, a ROS
+master or the driver:
+
+    python -m ros_interface.interfaces.replay ~/episodes --speed 0
+
+Every RESET moves on to the next recorded episode, wrapping around after the
+last one, and every STEP replays the next recorded command of the episode.
+The reply is built from the state samples recorded while that command ran,
+so a client which sends the same commands as the recording gets the same
+replies. Commands which differ from the recorded ones are counted as
+mismatches in the replay_mismatches_total metric, or fail with --strict.
+
+--speed 0 replies as fast as possible, 1 takes as long as every command took
+when it was recorded, 2 half as long. Images are not recorded, RENDER returns
+a black frame of --image-shape.
+"""
+import argparse
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+from ros_interface.interfaces.event_log import EVENT_LOG
+from ros_interface.interfaces.metrics import MetricsRegistry
+from ros_interface.interfaces.protocol import STEP_TYPES, STEP_UNITS
+from ros_interface.robots.episode_store import COMMANDS, EpisodeReader, list_episodes
+
+REPLAY_EVENT = EVENT_LOG.event('replay', ('command', 'episode', 'row', 'mismatch'),
+                               command=COMMANDS)
+
+
+class Response(object):
+    """ stands in for a ROS service response """
+    def __init__(self, **fields):
+        self.fields = sorted(fields)
+        self.__dict__.update(fields)
+
+    def __str__(self):
+        # the yaml like format of ROS messages, which text clients parse
+        return '\n'.join('{}: {}'.format(name, format_value(getattr(self, name)))
+                         for name in self.fields)
+
+
+def format_value(value):
+    if isinstance(value, str):
+        return json.dumps(value)
+    return str(value)
+
+
+class ReplayEpisode(object):
+    """ every table of one recorded episode, read into memory once """
+    def __init__(self, path):
+        reader = EpisodeReader(path)
+        self.path = path
+        self.commands = reader.commands.read()
+        self.data = reader.command_data.column('value')
+        self.messages = reader.messages.column('byte').tobytes()
+        self.states = reader.read_states()
+        self.counts = self.states.get('count', np.zeros(0, dtype='<i8'))
+        # None for an episode without states. Recordings from before it was
+        # stored in episode.json tell it by the width of their joint_pos
+        self.n_joint_states = reader.info.get('n_joint_states')
+        if self.n_joint_states is None and 'joint_pos' in self.states:
+            self.n_joint_states = self.states['joint_pos'].shape[1]
+
+    def __len__(self):
+        return len(self.commands['command'])
+
+    def command(self, row):
+        return COMMANDS[self.commands['command'][row]]
+
+    def step(self, row):
+        """ type, relative, unit and data of a recorded step command """
+        c = self.commands
+        cmd_type = c['type'][row]
+        unit = c['unit'][row]
+        start = c['data_start'][row]
+        return (STEP_TYPES[cmd_type] if cmd_type >= 0 else None, bool(c['relative'][row]),
+                STEP_UNITS[unit] if unit >= 0 else None,
+                self.data[start:start + c['data_len'][row]])
+
+    def msg(self, row):
+        start = self.commands['msg_start'][row]
+        return self.messages[start:start + self.commands['msg_len'][row]].decode('utf-8')
+
+    def window(self, row):
+        """
+        count_start, count_end and start time of a command, the window its
+        reply is built from
+        """
+        c = self.commands
+        return (int(c['count_start'][row]), int(c['count_end'][row]),
+                float(c['time'][row] - c['seconds'][row]))
+
+    def state(self, window, trace_decimation=0):
+        """
+        n_states, time_offset and the state fields at the end of window, or
+        of every trace_decimation-th sample in it
+        """
+        count_start, count_end, start = window
+        if not len(self.counts):
+            empty = np.zeros(0)
+            return 0, dict((name, empty) for name in ('time_offset', 'joint_pos', 'joint_vel',
+                                                     'joint_effort', 'tool_pose',
+                                                     'finger_pose'))
+        # samples are only recorded once an episode started, so the first
+        # command of an episode may end before the first sample
+        stop = max(1, int(np.searchsorted(self.counts, count_end, side='right')))
+        first = int(np.searchsorted(self.counts, count_start, side='right'))
+        if trace_decimation > 0 and first < stop:
+            # every nth counting back from the latest, like StateRingBuffer.trace
+            rows = np.arange(stop - 1, first - 1, -trace_decimation)[::-1]
+        else:
+            rows = np.array([stop - 1])
+        s = self.states
+        values = {'time_offset': s['received'][rows] - start}
+        for name in ('joint_pos', 'joint_vel', 'joint_effort', 'tool_pose', 'finger_pose'):
+            values[name] = s[name][rows]
+        return max(count_end - count_start, 1), values
+
+
+class ReplayBackend(object):
+    """ RobotServer backend answering from recorded episodes, see the module docstring """
+    image_source = 'replay'
+
+    def __init__(self, paths, speed=0.0, strict=False, image_shape=(480, 640, 3)):
+        """
+        paths: episode directories, or directories holding episode_* directories
+        speed: 0 to reply as fast as possible, otherwise how much faster
+            than recorded to replay
+        strict: fail commands which differ from the recorded ones
+        """
+        episodes = []
+        for path in paths:
+            episodes += list_episodes(path) or [path]
+        self.episodes = [ReplayEpisode(path) for path in episodes
+                         if os.path.exists(os.path.join(path, 'commands', 'rows'))]
+        if not self.episodes:
+            raise ValueError('no recorded episodes in {}'.format(', '.join(paths)))
+        self.speed = speed
+        self.strict = strict
+        self.metrics = MetricsRegistry()
+        self.lock = threading.Lock()
+        self.image = bytearray(int(np.prod(image_shape)))
+        self.image_shape = image_shape
+        self.n_replayed = 0
+        # RESET tries the episodes from here on
+        self.next_index = 0
+        self.select_episode(0)
+
+    def select_episode(self, index):
+        self.index = index % len(self.episodes)
+        self.episode = self.episodes[self.index]
+        self.row = 0
+        # replies start from the state before the first command
+        if len(self.episode):
+            count_start, count_end, start = self.episode.window(0)
+        else:
+            counts = self.episode.counts
+            count_start, start = (int(counts[-1]) if len(counts) else 0), 0.0
+        self.window = (count_start - 1, count_start, start)
+
+    def next_row(self, commands):
+        """
+        the next row of the episode if it is one of commands, else None. The
+        row is consumed and becomes the window of the following replies
+        """
+        episode = self.episode
+        if self.row >= len(episode) or episode.command(self.row) not in commands:
+            return None
+        row = self.row
+        self.row += 1
+        self.window = episode.window(row)
+        self.n_replayed += 1
+        return row
+
+    def pace(self, row):
+        """ take as long as the recorded command did, divided by speed """
+        if self.speed > 0 and row is not None:
+            time.sleep(self.episode.commands['seconds'][row] / self.speed)
+
+    def mismatch(self, command, row, why):
+        self.metrics.counter('replay_mismatches_total',
+                             'commands which differ from the recorded ones',
+                             command=command).inc()
+        if self.strict:
+            raise ValueError('{} does not match row {} of {}: {}'.format(
+                command, row, self.episode.path, why))
+
+    def check_step(self, command, row, cmd_type, relative, unit, data):
+        rec_type, rec_relative, rec_unit, rec_data = self.episode.step(row)
+        if (cmd_type, bool(relative), unit) != (rec_type, rec_relative, rec_unit):
+            self.mismatch(command, row, '{} {} {} instead of {} {} {}'.format(
+                cmd_type, relative, unit, rec_type, rec_relative, rec_unit))
+            return True
+        if len(data) != len(rec_data) or not np.allclose(data, rec_data):
+            self.mismatch(command, row, 'data differs')
+            return True
+        return False
+
+    def count(self, command, row, mismatched=False):
+        self.metrics.counter('replay_commands_total', 'commands replayed',
+                             command=command).inc()
+        REPLAY_EVENT(COMMANDS.index(command), self.index, -1 if row is None else row,
+                     mismatched)
+
+    def state_response(self, success=True, msg='', trace_decimation=0, **extra):
+        n_states, values = self.episode.state(self.window, trace_decimation)
+        return Response(success=bool(success), msg=msg, name=[], n_states=n_states,
+                        time_offset=values['time_offset'].tolist(),
+                        joint_pos=values['joint_pos'].ravel().tolist(),
+                        joint_vel=values['joint_vel'].ravel().tolist(),
+                        joint_effort=values['joint_effort'].ravel().tolist(),
+                        tool_pos=values['tool_pose'].ravel().tolist(),
+                        finger_pos=values['finger_pose'].ravel().tolist(), **extra)
+
+    def initialize(self, *fence, **boxes):
+        with self.lock:
+            row = self.next_row(('INIT',))
+            self.count('INIT', row)
+            return self.state_response(msg='successfully initialized')
+
+    def reset(self):
+        with self.lock:
+            # episodes start with their RESET. An episode without one, such as
+            # the one holding INIT, is skipped
+            for i in range(len(self.episodes)):
+                self.select_episode(self.next_index + i)
+                row = self.next_row(('RESET',))
+                if row is not None:
+                    break
+            self.next_index = self.index + 1
+            self.count('RESET', row)
+            self.pace(row)
+            return self.state_response()
+
+    def home(self):
+        with self.lock:
+            row = self.next_row(('HOME',))
+            self.count('HOME', row)
+            self.pace(row)
+            return Response(success=True)
+
+    def get_state(self, trace_decimation=0):
+        with self.lock:
+            return self.state_response(trace_decimation=trace_decimation)
+
+    def step(self, cmd_type, relative, unit, data, trace_decimation=0, nowait=False):
+        with self.lock:
+            row = self.next_row(('STEP', 'STEP_BATCH'))
+            if row is None:
+                raise ValueError('no more recorded steps in {}, RESET to replay the next '
+                                 'episode'.format(self.episode.path))
+            mismatched = self.check_step('STEP', row, cmd_type, relative, unit, data)
+            self.count('STEP', row, mismatched)
+            self.pace(row)
+            seconds = float(self.episode.commands['seconds'][row])
+            return self.state_response(
+                success=self.episode.commands['success'][row], msg=self.episode.msg(row),
+                trace_decimation=trace_decimation, tracking_error=[],
+                step_timing=[seconds, 0.0])
+
+    def step_batch(self, cmd_type, relative, unit, n_actions, data):
+        with self.lock:
+            n_joint_states = self.episode.n_joint_states
+            if n_joint_states is None:
+                raise ValueError('{} has no recorded states to build STEP_BATCH replies '
+                                 'from'.format(self.episode.path))
+            actions = np.asarray(data).reshape(n_actions, -1)
+            rows = []
+            msgs = []
+            success = True
+            for action in actions:
+                row = self.next_row(('STEP', 'STEP_BATCH'))
+                if row is None:
+                    if not rows:
+                        raise ValueError('no more recorded steps in {}'.format(
+                            self.episode.path))
+                    break
+                mismatched = self.check_step('STEP_BATCH', row, cmd_type, relative,
+                                             unit, action)
+                self.count('STEP_BATCH', row, mismatched)
+                self.pace(row)
+                success = bool(self.episode.commands['success'][row])
+                msgs.append(self.episode.msg(row))
+                n_states, values = self.episode.state(self.window)
+                rows.append(np.hstack([success, n_states] + [
+                    values[name].ravel() for name in ('time_offset', 'joint_pos', 'joint_vel',
+                                                      'joint_effort', 'tool_pose',
+                                                      'finger_pose')]))
+                if not success:
+                    break
+            return Response(success=success, msg=''.join(msgs), name=[], n_actions=len(rows),
+                            n_joint_states=n_joint_states,
+                            states=np.hstack(rows).tolist())
+
+    def stats(self, fmt):
+        if fmt == 'prometheus':
+            return Response(text=self.metrics.prometheus_text())
+        if fmt == 'events':
+            # the server and the replay share one process and event log
+            return Response(text='')
+        return Response(text=json.dumps(self.metrics.snapshot()))
+
+    def latest_image(self):
+        height, width, channels = self.image_shape
+        encoding = {1: 'mono8', 3: 'rgb8', 4: 'rgba8'}[channels]
+        return (self.n_replayed, self.window[2], height, width, encoding, self.image)
+
+    def should_stop(self):
+        return False
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('paths', nargs='+',
+                        help='episode directories or directories holding episodes')
+    parser.add_argument('--port', type=int, default=9030)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--speed', type=float, default=0.0,
+                        help='0 as fast as possible, 1 at the recorded timing')
+    parser.add_argument('--strict', action='store_true',
+                        help='fail commands which differ from the recorded ones')
+    parser.add_argument('--image-shape', default='480,640,3',
+                        help='height,width,channels of the frame RENDER returns')
+    parser.add_argument('--metrics-port', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    from ros_interface.interfaces.robot_server import RobotServer
+    backend = ReplayBackend(args.paths, speed=args.speed, strict=args.strict,
+                            image_shape=tuple(int(x) for x in args.image_shape.split(',')))
+    print('replaying {} episodes'.format(len(backend.episodes)))
+    RobotServer(port=args.port, n_workers=args.workers, metrics_port=args.metrics_port,
+                backend=backend)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,52 @@
+import json
 import socket
+import threading
 import time
+import traceback
 import numpy as np
+from concurrent.futures import Future
 from IPython import embed
+from ros_interface.interfaces.protocol import FrameReader, FN_CODES, FLAG_ERROR
+from ros_interface.interfaces.protocol import HOME_REPLY, pack_header, pack_fence
+from ros_interface.interfaces.protocol import pack_step, unpack_state
+from ros_interface.interfaces.protocol import IMAGE_HEADER, unpack_image_header
+from ros_interface.interfaces.protocol import image_array, pack_step_batch
+from ros_interface.interfaces.protocol import unpack_batch_states
+from ros_interface.interfaces.protocol import FLAG_PUSH, STREAM_FIELDS, SUBSCRIBE_REQUEST
+from ros_interface.interfaces.protocol import UNSUBSCRIBE_REQUEST, stream_field_mask
+from ros_interface.interfaces.protocol import unpack_state_push, GET_STATE_REQUEST
+from ros_interface.interfaces.protocol import FLAG_TIMING, TIMING, unpack_timing
+from ros_interface.interfaces.protocol import FN_NAME_TABLE, pack_sync, unpack_sync
+from ros_interface.interfaces.event_log import EVENT_LOG
+from ros_interface.interfaces.protocol import pack_render_request
+from ros_interface.interfaces.protocol import OBSERVE_REQUEST, OBSERVE_REPLY, OBSERVE_INTERPOLATE
+from ros_interface.interfaces.shm_transport import SharedMemoryObserver
+from ros_interface.interfaces.image_pipeline import decode_image
+
+TEXT_REQUEST_EVENT = EVENT_LOG.event('text_request', ('fn', 'sent_bytes', 'reply_bytes', 'seconds'),
+                                     fn=FN_NAME_TABLE)
 
 class RobotCommunicator():
-    def __init__(self, robot_ip="127.0.0.1", port=9100):
+    def __init__(self, robot_ip="127.0.0.1", port=9100, binary=False, robot=0):
+        """
+        binary: use the length-prefixed binary protocol. Replies are returned
+        as dicts of float64 arrays instead of the text of the service response
+        robot: index or name of the arm of a multi-robot server the requests
+        are for. The text protocol always addresses the first one
+        """
         self.robot_ip = robot_ip
         self.port = port
+        self.binary = binary
+        self.endseq = '|>'
+        self.request_id = 0
+        self.robot = 0
         self.connected = False
         self.connect()
+        if robot and not binary:
+            raise ValueError('the text protocol can only address robot 0')
+        if isinstance(robot, str):
+            robot = self.robots().index(robot)
+        self.robot = robot
 
     def connect(self):
         while not self.connected:
@@ -16,6 +54,8 @@ class RobotCommunicator():
             self.tcp_socket = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
             # connect to computer
             self.tcp_socket.connect((self.robot_ip, self.port))
+            self.tcp_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.reader = FrameReader(self.tcp_socket)
             print('connected')
             self.connected = True
             if not self.connected:
@@ -23,14 +63,510 @@ class RobotCommunicator():
 
     def send(self, fn, cmd):
         data = '<|{}**{}|>'.format(fn,cmd)
-        print('sending', data)
-        self.tcp_socket.send(data.encode())
-        ret_msg = self.tcp_socket.recv(1024).decode()
-        print('rx', ret_msg)
+        start = time.time()
+        self.tcp_socket.sendall(data.encode())
+        # keep reading until the whole reply has arrived. The end sequence
+        # may be split across two chunks, so look for it in the reply so far
+        endseq = self.endseq.encode()
+        reply = bytearray()
+        while not reply.endswith(endseq):
+            chunk = self.tcp_socket.recv(65536)
+            if not chunk:
+                raise EOFError('connection closed by {}'.format(self.robot_ip))
+            reply += chunk
+        ret_msg = reply.decode()
+        TEXT_REQUEST_EVENT(FN_CODES.get(fn.upper(), 0), len(data), len(ret_msg),
+                           time.time() - start)
         return ret_msg
 
+    def send_request(self, fn, payload=b''):
+        """ send a binary request and read the header of its reply """
+        self.request_id += 1
+        self.tcp_socket.sendall(pack_header(FN_CODES[fn], len(payload), 0,
+                                            self.request_id, self.robot) + payload)
+        rfn, flags, request_id, length, robot = self.reader.read_header()
+        if flags & FLAG_ERROR:
+            self.reader.read_payload(length)
+            raise RuntimeError('{} failed: {}'.format(
+                fn, bytes(self.reader.payload[:length]).decode('utf-8')))
+        return length
+
+    def request(self, fn, payload=b''):
+        """
+        send a binary request and wait for its reply. Returns the reply
+        payload length; the payload is in self.reader.payload until the next
+        request.
+        """
+        length = self.send_request(fn, payload)
+        self.reader.read_payload(length)
+        return length
+
+    def request_state(self, fn, payload=b''):
+        length = self.request(fn, payload)
+        # copy out of the receive buffer so the state outlives the next request
+        return unpack_state(bytes(self.reader.payload[:length]))
+
+    def initialize(self, fence, keep_out=None):
+        """
+        fence is min/max for x,y,z, or several such boxes the end effector
+        may be in. keep_out holds boxes in the same format it must not enter
+        """
+        return self.request_state('INIT', pack_fence(fence, keep_out))
+
+    def step(self, ctype, relative, unit, data, trace_decimation=0, nowait=False):
+        """
+        trace_decimation: 0 returns the latest state only, n returns every nth
+        state sample received during the step with one row per sample
+        nowait: reply as soon as the command started. The next ANGLE or TOOL
+            step preempts it
+        """
+        return self.request_state('STEP', pack_step(ctype, relative, unit, data,
+                                                    trace_decimation, nowait))
+
+    def trajectory(self, times, positions, unit='mdeg', relative=False, nowait=False):
+        """
+        follow a smooth spline through joint waypoints. times are seconds
+        from now, positions is (n_waypoints, n_joints). The reply has the
+        per tick position error in tracking_error
+        """
+        data = np.hstack([np.asarray(times, dtype=np.float64)[:, None],
+                          np.asarray(positions, dtype=np.float64)])
+        return self.step('TRAJECTORY', relative, unit, data.ravel(), nowait=nowait)
+
+    def step_batch(self, ctype, relative, unit, actions):
+        """
+        run the rows of actions (n_actions, action_len) back to back on the
+        robot in one round trip. Returns the state after each action as arrays
+        with n_actions rows.
+        """
+        length = self.request('STEP_BATCH', pack_step_batch(ctype, relative, unit, actions))
+        return unpack_batch_states(bytes(self.reader.payload[:length]), length)
+
+    def sync_step(self, ctype, relative, unit, actions, robots=None, trace_decimation=0,
+                  nowait=False):
+        """
+        step several arms of a multi-robot server at once, row i of actions
+        on robots[i] (default robot i). The server starts all steps together
+        and replies when every one is done. Returns the state of each robot,
+        in the order of robots
+        """
+        length = self.request('SYNC_STEP', pack_sync_step(ctype, relative, unit, actions,
+                                                          robots, trace_decimation, nowait))
+        return unpack_sync_states(bytes(self.reader.payload[:length]), length)
+
+    def robots(self):
+        """ names of the arms of the server, indexed by robot """
+        length = self.request('ROBOTS')
+        return json.loads(bytes(self.reader.payload[:length]).decode('utf-8'))
+
+    def open_shared_memory(self):
+        """
+        SharedMemoryObserver reading the latest state and camera frame of the
+        robot from shared memory, see shm_transport. Only for clients on the
+        host of the server
+        """
+        length = self.request('SHM_OPEN')
+        return SharedMemoryObserver(json.loads(bytes(self.reader.payload[:length]).decode('utf-8')))
+
+    def get_state(self, trace_decimation=0):
+        return self.request_state('GET_STATE', GET_STATE_REQUEST.pack(trace_decimation))
+
+    def reset(self):
+        return self.request_state('RESET')
+
+    def home(self):
+        self.request('HOME')
+        return HOME_REPLY.unpack_from(self.reader.payload)[0]
+
+    def render(self, out=None, spec=None):
+        """
+        fetch the latest camera frame. The pixels are received directly into
+        out (a contiguous array which is reused if it is large enough) and
+        returned as a (height, width, channels) view along with the frame info
+        (seq, stamp, height, width, encoding, nbytes)
+        spec: keyword arguments of pack_render_request, to have the server
+        crop, resize, convert or compress the frame. Compressed frames are
+        decoded into a new array rather than out
+        """
+        self.send_request('RENDER', pack_render_request(**spec) if spec else b'')
+        return make_read_image(out)(self.reader, None)
+
+    def observe(self, stamp=0.0, interpolate=False, spec=None, out=None):
+        """
+        state and camera frame of one moment, see interfaces/observation.py.
+        stamp: ROS time to observe, default the stamp of the latest state
+        interpolate: blend the frames around stamp instead of taking the
+        nearest one
+        spec, out: as for render
+        Returns {'state', 'image', 'image_info', 'state_stamp',
+        'frame_stamp', 'skew'}, skew being frame_stamp - state_stamp
+        """
+        self.send_request('OBSERVE', pack_observe(stamp, interpolate, spec))
+        return make_read_observation(out)(self.reader, None)
+
+    def stats(self, fmt='json'):
+        """
+        counters and latency histograms of the server and the jaco interface.
+        fmt 'json' returns {'server': metrics, 'jaco': metrics} as described
+        in interfaces/metrics.py, 'prometheus' the Prometheus text
+        """
+        if self.binary:
+            length = self.request('STATS', fmt.encode('utf-8'))
+            text = bytes(self.reader.payload[:length]).decode('utf-8')
+        else:
+            reply = self.send('STATS', fmt)
+            text = reply[reply.index('**') + 2:-len(self.endseq)]
+        return json.loads(text) if fmt == 'json' else text
+
+    def disconnect(self):
+        if self.binary:
+            self.request('END')
+        else:
+            self.send('END', '')
+        print('disconnected from {}'.format(self.robot_ip))
+        self.tcp_socket.close()
+        self.connected = False
+
+def pack_sync_step(ctype, relative, unit, actions, robots=None, trace_decimation=0,
+                   nowait=False):
+    if robots is None:
+        robots = range(len(actions))
+    return pack_sync([(robot, pack_step(ctype, relative, unit, action, trace_decimation,
+                                        nowait))
+                      for robot, action in zip(robots, actions)])
+
+
+def unpack_sync_states(buf, length):
+    """ state dicts of a SYNC_STEP reply, each with the robot it is of """
+    states = []
+    for robot, payload in unpack_sync(buf, length):
+        state = unpack_state(payload)
+        state['robot'] = robot
+        states.append(state)
+    return states
+
+
+def read_sync_states(reader, length):
+    reader.read_payload(length)
+    return unpack_sync_states(bytes(reader.payload[:length]), length)
+
+
+def read_json(reader, length):
+    reader.read_payload(length)
+    return json.loads(bytes(reader.payload[:length]).decode('utf-8'))
+
+
+def read_state(reader, length):
+    reader.read_payload(length)
+    return unpack_state(bytes(reader.payload[:length]))
+
+
+def read_batch_states(reader, length):
+    reader.read_payload(length)
+    return unpack_batch_states(bytes(reader.payload[:length]), length)
+
+
+def read_home(reader, length):
+    reader.read_payload(length)
+    return HOME_REPLY.unpack_from(reader.payload)[0]
+
+
+def make_read_stats(fmt='json'):
+    def read_stats(reader, length):
+        reader.read_payload(length)
+        text = bytes(reader.payload[:length]).decode('utf-8')
+        return json.loads(text) if fmt == 'json' else text
+    return read_stats
+
+
+def read_nothing(reader, length):
+    reader.read_payload(length)
+
+
+def pack_observe(stamp=0.0, interpolate=False, spec=None):
+    return OBSERVE_REQUEST.pack(stamp, OBSERVE_INTERPOLATE if interpolate else 0) + \
+        (pack_render_request(**spec) if spec else b'')
+
+
+def make_read_observation(out=None):
+    """ reader for an OBSERVE reply, out as for make_read_image """
+    read_image = make_read_image(out)
+
+    def read_observation(reader, length):
+        reader.recv_exact(reader.payload_view, OBSERVE_REPLY.size)
+        state_stamp, frame_stamp, skew, state_length = OBSERVE_REPLY.unpack_from(reader.payload)
+        reader.read_payload(state_length)
+        state = unpack_state_push(bytes(reader.payload[:state_length]), state_length)
+        image, info = read_image(reader, None)
+        return {'state': state, 'image': image, 'image_info': info,
+                'state_stamp': state_stamp, 'frame_stamp': frame_stamp, 'skew': skew}
+    return read_observation
+
+
+def make_read_image(out=None):
+    """ reader for a RENDER reply which receives the pixels straight into out """
+    def read_image(reader, length):
+        reader.recv_exact(reader.payload_view, IMAGE_HEADER.size)
+        info = unpack_image_header(reader.payload)
+        if '/' in info['encoding']:
+            reader.read_payload(info['nbytes'])
+            return decode_image(reader.payload_view[:info['nbytes']], info), info
+        frame = out
+        if frame is None or frame.nbytes < info['nbytes']:
+            frame = np.empty(info['nbytes'], dtype=np.uint8)
+        flat = frame.reshape(-1).view(np.uint8)
+        reader.recv_exact(memoryview(flat), info['nbytes'])
+        return image_array(flat, info), info
+    return read_image
+
+
+class PipelinedRobotCommunicator(RobotCommunicator):
+    """
+    binary client which keeps several requests in flight at once, for
+    instance a STEP and a RENDER. Every request carries an id and the
+    submit_* methods return a concurrent.futures.Future which a reader thread
+    resolves when the reply with that id arrives. The *_async methods wrap
+    the same futures for use from asyncio. The blocking methods of
+    RobotCommunicator still work and simply wait on their future.
+
+    The server runs robot commands (INIT, RESET, HOME, STEP, STEP_BATCH) one
+    after the other in the order they were submitted. Other requests run
+    alongside the command in flight, but nothing overtakes a command which is
+    still waiting for the previous one.
+    """
+    def __init__(self, robot_ip="127.0.0.1", port=9100, robot=0):
+        self.pending = {}
+        self.subscriptions = {}
+        self.send_lock = threading.Lock()
+        self.timing_buffer = bytearray(TIMING.size)
+        self.reader_thread = None
+        # why the reader thread stopped, after which no request can be answered
+        self.error = None
+        super(PipelinedRobotCommunicator, self).__init__(robot_ip=robot_ip,
+                                                         port=port,
+                                                         binary=True,
+                                                         robot=robot)
+
+    def connect(self):
+        super(PipelinedRobotCommunicator, self).connect()
+        self.reader_thread = threading.Thread(target=self.read_replies,
+                                              name='robot_client_reader')
+        self.reader_thread.daemon = True
+        self.reader_thread.start()
+
+    def submit(self, fn, payload=b'', read_reply=read_nothing, on_push=None, flags=0,
+               robot=None):
+        """
+        send a request without waiting for the reply.
+        read_reply(reader, length) is called on the reader thread to read the
+        reply payload and its return value becomes the result of the future.
+        on_push(state) is called on the reader thread for each frame the server
+        pushes for this request. An exception it raises is printed and
+        the reader carries on.
+        flags: FLAG_TIMING has the server time the request. The dict of
+        seconds per TIMING_FIELDS is stored in future.timing
+        The id of the request is stored in future.request_id
+        robot: arm the request is for, by default the one of the client
+        Raises RuntimeError once the reply stream broke, see read_replies
+        """
+        if robot is None:
+            robot = self.robot
+        future = Future()
+        future.timing = None
+        # sent requests are answered, cancelling could only lose the reply
+        future.set_running_or_notify_cancel()
+        with self.send_lock:
+            if self.error is not None:
+                raise RuntimeError('the connection to {} is broken: {!r}'.format(
+                    self.robot_ip, self.error))
+            self.request_id = (self.request_id + 1) & 0xffffffff
+            request_id = self.request_id
+            future.request_id = request_id
+            self.pending[request_id] = (fn, future, read_reply)
+            if on_push is not None:
+                self.subscriptions[request_id] = on_push
+            try:
+                self.tcp_socket.sendall(pack_header(FN_CODES[fn], len(payload),
+                                                    flags, request_id, robot) + payload)
+            except Exception as e:
+                self.pending.pop(request_id, None)
+                future.set_exception(e)
+        return future
+
+    def read_replies(self):
+        """
+        reader thread: resolves the future of every reply. Errors of on_push
+        callbacks and replies to unknown ids are skipped, anything else
+        leaves the stream out of step, so the communicator is marked broken
+        and every request still waiting fails with the error
+        """
+        future = None
+        try:
+            while True:
+                future = None
+                rfn, flags, request_id, length, robot = self.reader.read_header()
+                if flags & FLAG_PUSH:
+                    self.reader.read_payload(length)
+                    on_push = self.subscriptions.get(request_id)
+                    if on_push is not None:
+                        try:
+                            on_push(unpack_state_push(bytes(self.reader.payload[:length]),
+                                                      length))
+                        except Exception:
+                            traceback.print_exc()
+                    continue
+                entry = self.pending.pop(request_id, None)
+                if entry is None:
+                    self.reader.read_payload(length)
+                    print('skipped a reply to unknown request {}'.format(request_id))
+                    continue
+                fn, future, read_reply = entry
+                if flags & FLAG_ERROR:
+                    self.reader.read_payload(length)
+                    future.set_exception(RuntimeError('{} failed: {}'.format(
+                        fn, bytes(self.reader.payload[:length]).decode('utf-8'))))
+                elif flags & FLAG_TIMING:
+                    result = read_reply(self.reader, length - TIMING.size)
+                    self.reader.recv_exact(memoryview(self.timing_buffer), TIMING.size)
+                    future.timing = unpack_timing(self.timing_buffer)
+                    future.set_result(result)
+                else:
+                    future.set_result(read_reply(self.reader, length))
+        except Exception as e:
+            # the stream can not be resynchronised - fail everything waiting
+            # and refuse new requests
+            with self.send_lock:
+                self.error = e
+                waiting = [entry[1] for entry in self.pending.values()]
+                self.pending.clear()
+            if future is not None and not future.done():
+                waiting.append(future)
+            for future in waiting:
+                future.set_exception(e)
+
+    def submit_initialize(self, fence, keep_out=None):
+        return self.submit('INIT', pack_fence(fence, keep_out), read_state)
+
+    def submit_step(self, ctype, relative, unit, data, trace_decimation=0, nowait=False):
+        return self.submit('STEP', pack_step(ctype, relative, unit, data, trace_decimation,
+                                             nowait), read_state)
+
+    def submit_step_batch(self, ctype, relative, unit, actions):
+        return self.submit('STEP_BATCH', pack_step_batch(ctype, relative, unit, actions),
+                           read_batch_states)
+
+    def submit_sync_step(self, ctype, relative, unit, actions, robots=None,
+                         trace_decimation=0, nowait=False):
+        return self.submit('SYNC_STEP', pack_sync_step(ctype, relative, unit, actions, robots,
+                                                       trace_decimation, nowait),
+                           read_sync_states)
+
+    def submit_robots(self):
+        return self.submit('ROBOTS', b'', read_json)
+
+    def submit_shm_open(self):
+        return self.submit('SHM_OPEN', b'', read_json)
+
+    def submit_get_state(self, trace_decimation=0):
+        return self.submit('GET_STATE', GET_STATE_REQUEST.pack(trace_decimation), read_state)
+
+    def submit_reset(self):
+        return self.submit('RESET', b'', read_state)
+
+    def submit_home(self):
+        return self.submit('HOME', b'', read_home)
+
+    def submit_render(self, out=None, spec=None):
+        """ out must not be reused until the future is done """
+        return self.submit('RENDER', pack_render_request(**spec) if spec else b'',
+                           make_read_image(out))
+
+    def submit_observe(self, stamp=0.0, interpolate=False, spec=None, out=None):
+        return self.submit('OBSERVE', pack_observe(stamp, interpolate, spec),
+                           make_read_observation(out))
+
+    def submit_stats(self, fmt='json'):
+        return self.submit('STATS', fmt.encode('utf-8'), make_read_stats(fmt))
+
+    def subscribe(self, callback, rate=0, decimation=1, fields=STREAM_FIELDS):
+        """
+        have the server push the robot state to callback(state) on the reader
+        thread. The server sends every decimation-th joint state update, at
+        most rate times per second (0 for no limit), with only the requested
+        fields. callback must return quickly as it holds up all replies.
+        Returns the subscription id to pass to unsubscribe.
+        """
+        payload = SUBSCRIBE_REQUEST.pack(rate, decimation, stream_field_mask(fields))
+        future = self.submit('SUBSCRIBE', payload, on_push=callback)
+        try:
+            future.result()
+        except Exception:
+            self.subscriptions.pop(future.request_id, None)
+            raise
+        return future.request_id
+
+    def unsubscribe(self, subscription_id):
+        self.submit('UNSUBSCRIBE', UNSUBSCRIBE_REQUEST.pack(subscription_id)).result()
+        self.subscriptions.pop(subscription_id, None)
+
+    def initialize(self, fence, keep_out=None):
+        return self.submit_initialize(fence, keep_out).result()
+
+    def step(self, ctype, relative, unit, data, trace_decimation=0, nowait=False):
+        return self.submit_step(ctype, relative, unit, data, trace_decimation,
+                                nowait).result()
+
+    def step_batch(self, ctype, relative, unit, actions):
+        return self.submit_step_batch(ctype, relative, unit, actions).result()
+
+    def sync_step(self, ctype, relative, unit, actions, robots=None, trace_decimation=0,
+                  nowait=False):
+        return self.submit_sync_step(ctype, relative, unit, actions, robots,
+                                     trace_decimation, nowait).result()
+
+    def robots(self):
+        return self.submit_robots().result()
+
+    def open_shared_memory(self):
+        return SharedMemoryObserver(self.submit_shm_open().result())
+
+    def get_state(self, trace_decimation=0):
+        return self.submit_get_state(trace_decimation).result()
+
+    def reset(self):
+        return self.submit_reset().result()
+
+    def home(self):
+        return self.submit_home().result()
+
+    def render(self, out=None, spec=None):
+        return self.submit_render(out, spec).result()
+
+    def observe(self, stamp=0.0, interpolate=False, spec=None, out=None):
+        return self.submit_observe(stamp, interpolate, spec, out).result()
+
+    def stats(self, fmt='json'):
+        return self.submit_stats(fmt).result()
+
+    def step_async(self, ctype, relative, unit, data, trace_decimation=0, nowait=False):
+        import asyncio
+        return asyncio.wrap_future(self.submit_step(ctype, relative, unit, data,
+                                                    trace_decimation, nowait))
+
+    def step_batch_async(self, ctype, relative, unit, actions):
+        import asyncio
+        return asyncio.wrap_future(self.submit_step_batch(ctype, relative, unit, actions))
+
+    def get_state_async(self, trace_decimation=0):
+        import asyncio
+        return asyncio.wrap_future(self.submit_get_state(trace_decimation))
+
+    def render_async(self, out=None, spec=None):
+        import asyncio
+        return asyncio.wrap_future(self.submit_render(out, spec))
+
     def disconnect(self):
-        self.send('END', '')
+        self.submit('END').result()
         print('disconnected from {}'.format(self.robot_ip))
         self.tcp_socket.close()
         self.connected = False
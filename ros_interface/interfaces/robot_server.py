@@ -1,168 +1,738 @@
 #! /usr/bin/env python
 import os
 import sys
-import thread
-import socket
 import rospy
+from rospy.impl.tcpros_service import convert_return_to_response
 from sensor_msgs.msg import Image
-from ros_interface.srv import initialize, reset, step, home, get_state
+from std_msgs.msg import Float64MultiArray
+from ros_interface.srv import initialize, reset, step, home, get_state, step_batch, stats
+from ros_interface.interfaces.protocol import FN_CODES, FN_NAMES, FN_NAME_TABLE, STEP_TYPES
+from ros_interface.interfaces.protocol import PROTOCOL_VERSION
+from ros_interface.interfaces.protocol import FLAG_REPLY, FLAG_ERROR, FLAG_TIMING
+from ros_interface.interfaces.protocol import HOME_REPLY, pack_header, pack_state
+from ros_interface.interfaces.protocol import unpack_fence, unpack_step
+from ros_interface.interfaces.protocol import pack_image_header, pack_timing
+from ros_interface.interfaces.protocol import pack_batch_states, unpack_step_batch
+from ros_interface.interfaces.protocol import UNSUBSCRIBE_REQUEST, GET_STATE_REQUEST
+from ros_interface.interfaces.protocol import STEP_RELATIVE, STEP_NOWAIT, STATS_FORMATS
+from ros_interface.interfaces.protocol import pack_sync, unpack_sync, unpack_render_request
+from ros_interface.interfaces.protocol import OBSERVE_REQUEST, OBSERVE_REPLY, OBSERVE_INTERPOLATE
+from ros_interface.interfaces.protocol import ALL_STREAM_FIELDS, pack_state_push
+from ros_interface.interfaces.metrics import MetricsRegistry, serve_metrics
+from ros_interface.interfaces.metrics import merge_prometheus_texts
+from ros_interface.interfaces.event_log import EVENT_LOG
+from ros_interface.interfaces.server_loop import ServerLoop, BoundedExecutor
+from ros_interface.interfaces.state_stream import StateStream, STATE_STREAM_TOPIC
+from ros_interface.interfaces.state_stream import split_state_row
+from ros_interface.interfaces.shm_transport import SharedMemoryPublisher
+from ros_interface.interfaces.image_pipeline import RenderCache, render_image
+from ros_interface.interfaces.observation import StampRing, blend_frames
 import time
 import numpy as np
 import threading 
 import json
-import zlib
+import atexit
+
+REQUEST_EVENT = EVENT_LOG.event('request', ('fn', 'binary', 'seconds'), fn=FN_NAME_TABLE)
+TEXT_STEP_EVENT = EVENT_LOG.event('text_step', ('type', 'relative', 'nowait', 'n_data'),
+                                  type=STEP_TYPES)
+FENCE_EVENT = EVENT_LOG.event('fence', ('n_keep_in', 'n_keep_out'))
+# fields of the first keep-in box of an initialize request
+FENCE_FIELDS = ('fence_min_x', 'fence_max_x', 'fence_min_y', 'fence_max_y',
+                'fence_min_z', 'fence_max_z')
+SYNC_STEP_EVENT = EVENT_LOG.event('sync_step', ('n_robots', 'seconds', 'skew'))
+
+
+def resolve(namespace, name):
+    """ global name of name in namespace, '' being the root namespace """
+    return '/' + '/'.join(part for part in (namespace.strip('/'), name) if part)
+
+
+class RosBackend(object):
+    """
+    JacoInterface through its ROS services, and the latest camera image.
+
+    RobotServer calls the initialize, reset, home, get_state, step,
+    step_batch and stats attributes of its backend like the service proxies
+    they are here, and reads what they return like the service responses.
+    interfaces/replay.py has a backend which answers from recorded episodes
+    instead
+
+    The services, the state stream and the camera of the robot are looked up
+    in its namespace, for instance /j2n6s300/step and
+    /j2n6s300/camera/color/image_raw. The root namespace '' has the names
+    of a single arm, /step and /camera/color/image_raw
+    """
+    def __init__(self, namespace='', frame_buffer=30, persistent=True):
+        """
+        frame_buffer: number of camera frames kept for OBSERVE
+        persistent: keep the connections to the services open between calls
+        """
+        self.namespace = namespace
+        self.persistent = persistent
+        self.image_source = resolve(namespace, 'camera/color/image_raw')
+        # latest_image tuples by header stamp
+        self.frames = StampRing(frame_buffer)
+        self.image_seq = 0
+        # called with every image as latest_image returns it, on the
+        # subscriber thread
+        self.on_image = None
+        self.image_sub = rospy.Subscriber(self.image_source, Image, self.image_callback)
+
+        rospy.loginfo('setting up ros for robot {!r}'.format(namespace))
+        self.initialize = self.connect_service('initialize', initialize)
+        self.reset = self.connect_service('reset', reset)
+        self.home = self.connect_service('home', home)
+        self.get_state = self.connect_service('get_state', get_state)
+        self.step = self.connect_service('step', step)
+        self.step_batch = self.connect_service('step_batch', step_batch)
+        self.stats = self.connect_service('stats', stats)
+        rospy.loginfo('finished setting up ros')
+
+    def connect_service(self, name, service_class):
+        name = resolve(self.namespace, name)
+        rospy.wait_for_service(name)
+        rospy.loginfo('setup service: {}'.format(name))
+        if self.persistent:
+            return PersistentService(name, service_class)
+        return rospy.ServiceProxy(name, service_class)
+
+    def subscribe_state_stream(self, callback):
+        """ call callback with every message published on STATE_STREAM_TOPIC in the namespace """
+        self.state_stream_sub = rospy.Subscriber(resolve(self.namespace, STATE_STREAM_TOPIC),
+                                                 Float64MultiArray, callback, queue_size=10)
+
+    def image_callback(self, msg):
+        # keep a reference to the message data rather than copying it. Only
+        # the subscriber thread counts image_seq
+        self.image_seq += 1
+        frame = (self.image_seq, msg.header.stamp.to_sec(), msg.height, msg.width,
+                 msg.encoding, msg.data)
+        self.frames.append(frame[1], frame)
+        on_image = self.on_image
+        if on_image is not None:
+            on_image(*frame)
+
+    def latest_image(self):
+        """
+        seq, stamp, height, width, encoding and pixel buffer of the latest
+        image, None before the first one. The buffer is the message data
+        itself - it is never copied
+        """
+        latest = self.frames.latest()
+        return None if latest is None else latest[1]
+
+    def should_stop(self):
+        return rospy.is_shutdown()
+
+
+class PersistentService(object):
+    """
+    ServiceProxy keeping its connection open between calls, which saves
+    connecting to the service on every call. A persistent proxy must not be
+    called from two threads at once, so every calling thread gets its own.
+    A proxy whose call failed is dropped and the next call reconnects -
+    the failed call is not retried, it may have moved the robot
+    """
+    def __init__(self, name, service_class):
+        self.name = name
+        self.service_class = service_class
+        self.local = threading.local()
+
+    def __call__(self, *args, **kwargs):
+        proxy = getattr(self.local, 'proxy', None)
+        if proxy is None:
+            proxy = rospy.ServiceProxy(self.name, self.service_class, persistent=True)
+            self.local.proxy = proxy
+        try:
+            return proxy(*args, **kwargs)
+        except Exception:
+            self.local.proxy = None
+            proxy.close()
+            raise
+
+
+class LocalService(object):
+    """
+    calls a service handler of this process like a ServiceProxy calls the
+    service: with a request made of the arguments, positional or by field
+    name, returning the response
+    """
+    def __init__(self, handler, service_class):
+        self.handler = handler
+        self.request_class = service_class._request_class
+        self.response_class = service_class._response_class
+
+    def __call__(self, *args, **kwargs):
+        return convert_return_to_response(self.handler(self.request_class(*args, **kwargs)),
+                                          self.response_class)
+
+
+class InProcessBackend(RosBackend):
+    """
+    JacoInterface of this process, for a robot server running inside it
+    (see JacoInterface.serve). Commands call its service handlers directly
+    and its state stream is passed on without being published. The camera
+    is still subscribed to
+    """
+    def __init__(self, interface, frame_buffer=30):
+        self.interface = interface
+        super(InProcessBackend, self).__init__(rospy.get_namespace().strip('/'),
+                                               frame_buffer=frame_buffer)
+
+    def connect_service(self, name, service_class):
+        # stats goes through get_stats, which leaves out the shared event log
+        handler = self.get_stats if name == 'stats' else getattr(self.interface, name)
+        return LocalService(handler, service_class)
+
+    def get_stats(self, cmd):
+        """
+        the text of the stats response, like JacoInterface.get_stats. The
+        server and the interface share one process and event log, which
+        collect_stats already includes, so the events text is empty
+        """
+        if cmd.format == 'events':
+            return ''
+        return self.interface.get_stats(cmd)
+
+    def subscribe_state_stream(self, callback):
+        self.interface.state_stream_listeners.append(callback)
+
 
 class RobotServer():
-    def __init__(self, port=9030):
+    def __init__(self, port=9030, n_workers=4, metrics_port=None, backend=None,
+                 robots=None):
+        """
+        n_workers: number of threads making blocking ROS service calls for
+        clients. All clients are served from a single event loop
+        metrics_port: serve the metrics of the server and JacoInterface in the
+        Prometheus text format on http://127.0.0.1:metrics_port/metrics. The
+        ~metrics_port parameter overrides it
+        backend: what answers the commands, or a list of them, one per robot.
+        By default a RosBackend talking to JacoInterface for every robot. Any
+        other backend needs neither a ROS master nor the robot
+        robots: namespaces of the JacoInterfaces of the arms served, the
+        robot selector of a request indexes them. The ~robots parameter, a
+        list or comma separated names, overrides it. Default [''], one arm
+        with the global service names
+        The ~persistent_services parameter (default true) keeps the
+        connections to the services of the JacoInterfaces open
+        """
         # robot actually talks to the robot function
         self.count = 0
-        self.client_num = 0
         self.port = port
+        self.n_workers = n_workers
         self.endseq = '|>'
         self.startseq = '<|'
         # between function call and data
         self.midseq = '**'
-        rospy.init_node('robot_server')
-        self.image_lock = threading.Lock()
-        self.image_string = 'none'
-        self.image_height = 0
-        self.image_width = 0
-        self.image_encoding = 'none'
-        self.setup_ros()
+        # kill -USR1 writes the event log to event_log.<pid>.txt in the working
+        # directory, ~/.ros under roslaunch
+        EVENT_LOG.install_dump_signal()
+        self.metrics = MetricsRegistry()
+        self.metrics_port = metrics_port
+        self.loop = None
+        self.state_streams = []
+        if backend is None:
+            rospy.init_node('robot_server')
+            self.metrics_port = rospy.get_param('~metrics_port', metrics_port)
+            robots = rospy.get_param('~robots', robots) or ['']
+            if isinstance(robots, str):
+                robots = robots.split(',')
+            persistent = rospy.get_param('~persistent_services', True)
+            backend = [RosBackend(namespace.strip(), persistent=persistent)
+                       for namespace in robots]
+        self.backends = backend if isinstance(backend, list) else [backend]
+        self.robots = [getattr(b, 'namespace', '') or str(i) for i, b in enumerate(self.backends)]
+        # the first robot answers the text protocol
+        self.backend = self.backends[0]
+        # SharedMemoryPublisher of every robot, created by its first SHM_OPEN
+        self.shm = [None] * len(self.backends)
+        self.render_caches = [RenderCache() for backend in self.backends]
+        # (row, n_joint_states) of the last state stream rows by stamp, for OBSERVE
+        self.state_rings = [StampRing(256) for backend in self.backends]
+        # step the other robots of a SYNC_STEP beside the worker handling it.
+        # The threads live as long as the server, so each keeps reusing its
+        # persistent service connections
+        self.sync_executor = BoundedExecutor(n_workers * (len(self.backends) - 1),
+                                             n_workers * len(self.backends))
+        for robot, backend in enumerate(self.backends):
+            if hasattr(backend, 'subscribe_state_stream'):
+                backend.subscribe_state_stream(
+                    lambda msg, robot=robot: self.state_stream_callback(robot, msg))
+        if self.metrics_port:
+            serve_metrics(int(self.metrics_port),
+                          lambda: self.collect_stats('prometheus'))
         self.create_server()
         #rospy.spin()
 
-    def setup_ros(self):
-        self.image_sub = rospy.Subscriber("/camera/color/image_raw",Image,self.image_callback)
-
-        rospy.loginfo('setting up ros')
-        rospy.wait_for_service('/initialize')
-        self.service_init = rospy.ServiceProxy('/initialize', initialize)
-        rospy.wait_for_service('/reset')
-        self.service_reset = rospy.ServiceProxy('/reset', reset)
-        rospy.loginfo('setup service: reset')
-        rospy.wait_for_service('/home')
-        self.service_home = rospy.ServiceProxy('/home', home)
-        rospy.loginfo('setup service: home')
-        rospy.wait_for_service('/get_state')
-        self.service_get_state = rospy.ServiceProxy('/get_state', get_state)
-        rospy.loginfo('setup service: get_state')
-        rospy.wait_for_service('/step')
-        self.service_step = rospy.ServiceProxy('/step', step)
-        rospy.loginfo('setup service: step')
-        rospy.loginfo('finished setting up ros')
+    def get_backend(self, robot):
+        if robot >= len(self.backends):
+            raise ValueError('no robot {}, the server has {}'.format(robot, len(self.backends)))
+        return self.backends[robot]
 
     def get_image_string(self):
-        return self.image_data
+        image = self.backend.latest_image()
+        if image is None:
+            return 'none'
+        return image[-1]
 
-    def image_callback(self, msg):
-        self.image_data = msg.data
-        self.image_height = str(msg.height).encode('utf-8')
-        self.image_width = str(msg.width).encode('utf-8')
-        self.image_encoding = msg.encoding.encode('utf-8')
+    def get_image_frame(self, backend):
+        """
+        returns the render header and the raw pixel buffer of the latest
+        frame, which is not copied
+        """
+        image = backend.latest_image()
+        if image is None:
+            raise ValueError('no image received from {}'.format(backend.image_source))
+        seq, stamp, height, width, encoding, data = image
+        header = pack_image_header(seq, stamp, height, width, encoding, len(data))
+        return [header, memoryview(data)]
+
+    def render_frame(self, robot, spec):
+        """ reply parts of a RENDER request for the latest frame preprocessed as spec asks """
+        backend = self.get_backend(robot)
+        image = backend.latest_image()
+        if image is None:
+            raise ValueError('no image received from {}'.format(backend.image_source))
+        parts, cached = self.render_caches[robot].render(image, spec)
+        self.metrics.counter('server_renders_total', 'RENDER requests with a spec',
+                             cached=str(cached).lower()).inc()
+        # callers append to the reply
+        return list(parts)
+
+    def open_shared_memory(self, robot):
+        """
+        start writing the states and images of robot to shared memory.
+        Returns the paths of the rings for the SHM_OPEN reply
+        """
+        backend = self.get_backend(robot)
+        publisher = self.shm[robot]
+        if publisher is None:
+            publisher = SharedMemoryPublisher(self.robots[robot].strip('/').replace('/', '_'))
+            atexit.register(publisher.close)
+            self.shm[robot] = publisher
+            if hasattr(backend, 'on_image'):
+                backend.on_image = publisher.publish_image
+        return publisher.describe()
+
+    def frame_at(self, backend, stamp, interpolate=False):
+        """
+        the frame of backend nearest to stamp, or blended from the frames
+        around it. Returns the frame and whether it was blended
+        """
+        frames = getattr(backend, 'frames', None)
+        if frames is None:
+            # backends without a frame ring only have their latest frame
+            frame = backend.latest_image()
+        else:
+            if interpolate:
+                around = frames.around(stamp)
+                if around is not None:
+                    frame = blend_frames(around[0][1], around[1][1], stamp)
+                    if frame is not None:
+                        return frame, True
+            nearest = frames.nearest(stamp)
+            frame = None if nearest is None else nearest[1]
+        if frame is None:
+            raise ValueError('no image received from {}'.format(backend.image_source))
+        return frame, False
+
+    def observe(self, robot, payload, length):
+        """
+        reply parts of an OBSERVE request: the state nearest to the
+        requested time and the frame nearest to it, see interfaces/observation.py
+        """
+        backend = self.get_backend(robot)
+        stamp, flags = OBSERVE_REQUEST.unpack_from(payload)
+        spec = unpack_render_request(bytes(payload[OBSERVE_REQUEST.size:length]),
+                                     length - OBSERVE_REQUEST.size)
+        states = self.state_rings[robot]
+        state = states.nearest(stamp) if stamp else states.latest()
+        if state is None:
+            raise ValueError('no state received from robot {}'.format(self.robots[robot]))
+        state_stamp, (row, n_joint_states) = state
+        frame, blended = self.frame_at(backend, stamp or state_stamp,
+                                       flags & OBSERVE_INTERPOLATE)
+        skew = frame[1] - state_stamp
+        self.metrics.histogram('server_observe_skew_seconds',
+                               'seconds between the stamps of the state and the '
+                               'frame of an OBSERVE').observe(abs(skew))
+        stamp, n_states, values = split_state_row(row, n_joint_states)
+        state_payload = pack_state_push(stamp, n_states, n_joint_states, ALL_STREAM_FIELDS,
+                                        values)
+        if spec is None:
+            seq, frame_stamp, height, width, encoding, data = frame
+            image_parts = [pack_image_header(seq, frame_stamp, height, width, encoding,
+                                             len(data)), memoryview(data)]
+        elif blended:
+            image_parts = render_image(frame, spec)
+        else:
+            image_parts = self.render_caches[robot].render(frame, spec)[0]
+        return [OBSERVE_REPLY.pack(state_stamp, frame[1], skew, len(state_payload)),
+                state_payload] + image_parts
+
+    def state_stream_callback(self, robot, msg):
+        row = np.asarray(msg.data)
+        self.state_rings[robot].append(row[0], (row, msg.layout.dim[0].size))
+        shm = self.shm[robot]
+        if shm is not None:
+            shm.publish_state(msg.data, msg.layout.dim[0].size)
+        # subscriptions are only touched on the server loop
+        loop = self.loop
+        if loop is not None and self.state_streams[robot].subscriptions:
+            loop.call_soon(self.state_streams[robot].publish, msg.data,
+                           msg.layout.dim[0].size)
 
     def handle_msg(self, fn, cmd):
         fn = str(fn.upper())
         msg = 'NOTIMP'
-        rospy.loginfo("handling fn: {}".format(fn))
-        rospy.loginfo("cmd is:{}".format(cmd))
 
         if fn == 'RESET':
-            response = self.service_reset()
+            response = self.backend.reset()
             msg = str(response)
         elif fn == 'GET_STATE':
-            response = self.service_get_state()
+            # optional cmd is the trace decimation
+            trace_decimation = int(cmd) if cmd.strip() else 0
+            response = self.backend.get_state(trace_decimation)
             msg = str(response)
         elif fn == 'STEP':
             # cmd should be list of floats
             cvars = [x for x in cmd.strip().split(',')]
             ctype = cvars[0]
-            relative = int(cvars[1])
-            print("SENDING STEP RELATIVE", relative)
+            # relative is 0/1, or the STEP_RELATIVE | STEP_NOWAIT flags
+            flags = int(cvars[1])
+            relative = bool(flags & STEP_RELATIVE)
+            nowait = bool(flags & STEP_NOWAIT)
             unit = str(cvars[2])
             data = cvars[3:]
             data = [float(x) for x in data]
-            response = self.service_step(ctype, relative, unit, data)
+            TEXT_STEP_EVENT(STEP_TYPES.index(ctype) if ctype in STEP_TYPES else -1,
+                            relative, nowait, len(data))
+            response = self.backend.step(ctype, relative, unit, data, 0, nowait)
+            msg = str(response)
+        elif fn == 'STEP_BATCH':
+            # same as STEP with the number of actions before the concatenated data
+            cvars = [x for x in cmd.strip().split(',')]
+            ctype = cvars[0]
+            relative = int(cvars[1])
+            unit = str(cvars[2])
+            n_actions = int(cvars[3])
+            data = [float(x) for x in cvars[4:]]
+            response = self.backend.step_batch(ctype, relative, unit, n_actions, data)
             msg = str(response)
         elif fn == 'INIT':
-            fence_vars = [x for x in cmd.strip().split(',')]
-            fence_vars = [float(x) for x in fence_vars]
-            # min/max fence for xyz
-            assert(len(fence_vars) == 6)
-            print("setting fence", fence_vars)
-            response = self.service_init(*fence_vars)
+            # min/max fence for xyz of one or more keep-in boxes, optionally
+            # followed by ';' and keep-out boxes in the same format
+            groups = cmd.strip().split(';')
+            keep_in = [float(x) for x in groups[0].split(',')]
+            keep_out = []
+            if len(groups) > 1 and groups[1].strip():
+                keep_out = [float(x) for x in groups[1].split(',')]
+            assert(len(keep_in) >= 6 and not len(keep_in) % 6 and not len(keep_out) % 6)
+            FENCE_EVENT(len(keep_in) // 6, len(keep_out) // 6)
+            response = self.init_fence(keep_in, keep_out)
             msg = str(response)
         elif fn == 'END':
             # this is just used for the local server and won't be sent to jaco
             # TODO maybe it should be used to stop ros processes and shutdown ....
             msg = 'ENDED'
         elif fn == 'HOME':
-            response = self.service_home()
+            response = self.backend.home()
             msg = str(response)
         elif fn == 'RENDER':
             msg = self.get_image_string()
             return self.startseq+msg+self.endseq
+        elif fn == 'STATS':
+            # optional cmd is the format, json or prometheus
+            msg = self.collect_stats(cmd.strip() or 'json')
         else:
             msg = 'NOTIMP'
         ret_msg = self.startseq+'ACK'+fn+self.midseq+msg+self.endseq
         ret_msg = ret_msg.encode()
         return ret_msg
 
+    def collect_stats(self, fmt='json'):
+        """
+        metrics, or event logs, of this server and of JacoInterface as text in
+        fmt. With several robots the metrics of each JacoInterface have a
+        robot label, or in json are under its name
+        """
+        if fmt not in STATS_FORMATS:
+            raise ValueError('unknown stats format {}'.format(fmt))
+        # the ROS backend answers for JacoInterface
+        jaco = [backend.stats(fmt).text for backend in self.backends]
+        if fmt == 'prometheus':
+            if len(jaco) > 1:
+                return self.metrics.prometheus_text() + merge_prometheus_texts(
+                    [({'robot': name}, text) for name, text in zip(self.robots, jaco)])
+            return self.metrics.prometheus_text() + jaco[0]
+        if fmt == 'events':
+            if len(jaco) > 1:
+                return '# robot_server\n' + EVENT_LOG.text() + ''.join(
+                    '# jaco {}\n'.format(name) + text for name, text in zip(self.robots, jaco))
+            return '# robot_server\n' + EVENT_LOG.text() + '# jaco\n' + jaco[0]
+        if len(jaco) > 1:
+            jaco = dict((name, json.loads(text)) for name, text in zip(self.robots, jaco))
+        else:
+            jaco = json.loads(jaco[0])
+        return json.dumps({'server': self.metrics.snapshot(), 'jaco': jaco})
+
+    def init_fence(self, keep_in, keep_out, backend=None):
+        """
+        keep_in: flat list of at least one [min_x, max_x, min_y, max_y, min_z, max_z] box
+        keep_out: flat list of keep-out boxes in the same format
+        """
+        backend = backend or self.backend
+        # ROS requests are made of arguments or keywords, never both
+        fence = dict(zip(FENCE_FIELDS, keep_in[:6]))
+        return backend.initialize(keep_in=keep_in[6:], keep_out=keep_out, **fence)
+
+    def call_service(self, timing, service, *args):
+        """
+        call a ROS service proxy, or the backend method standing in for it.
+        If timing is a dict the seconds the call took, and those
+        JacoInterface reported for a step, are stored in it
+        """
+        if timing is None:
+            return service(*args)
+        start = time.time()
+        response = service(*args)
+        timing['service'] = time.time() - start
+        step_timing = getattr(response, 'step_timing', ())
+        if len(step_timing) == 2:
+            timing['command'], timing['state'] = step_timing
+        return response
+
+    def handle_frame(self, fn, payload, length, timing=None, robot=0,
+                     version=PROTOCOL_VERSION):
+        """
+        binary protocol version of handle_msg - payload is the preallocated
+        receive buffer holding length bytes. Returns the list of buffers that
+        make up the reply payload. timing: optional dict filled in by
+        call_service. robot: index of the backend answering the request.
+        version: protocol version of the request, states are packed in its
+        layout
+        """
+        name = FN_NAMES.get(fn)
+        backend = self.get_backend(robot)
+        if name == 'RESET':
+            return [pack_state(self.call_service(timing, backend.reset), version)]
+        elif name == 'GET_STATE':
+            trace_decimation = 0
+            if length >= GET_STATE_REQUEST.size:
+                trace_decimation, = GET_STATE_REQUEST.unpack_from(payload)
+            return [pack_state(self.call_service(timing, backend.get_state,
+                                                 trace_decimation), version)]
+        elif name == 'STEP':
+            ctype, relative, unit, data, trace_decimation, nowait = unpack_step(payload, length)
+            return [pack_state(self.call_service(timing, backend.step, ctype,
+                                                 relative, unit, data.tolist(),
+                                                 trace_decimation, nowait), version)]
+        elif name == 'SYNC_STEP':
+            return [self.sync_step(payload, length, timing, version)]
+        elif name == 'STEP_BATCH':
+            ctype, relative, unit, n_actions, data = unpack_step_batch(payload, length)
+            return [pack_batch_states(self.call_service(
+                timing, backend.step_batch, ctype, relative, unit, n_actions,
+                data.tolist()))]
+        elif name == 'INIT':
+            keep_in, keep_out = unpack_fence(payload, length)
+            assert(len(keep_in) >= 1)
+            return [pack_state(self.init_fence(keep_in.ravel().tolist(),
+                                               keep_out.ravel().tolist(), backend),
+                               version)]
+        elif name == 'HOME':
+            response = self.call_service(timing, backend.home)
+            return [HOME_REPLY.pack(response.success)]
+        elif name == 'RENDER':
+            spec = unpack_render_request(payload, length)
+            if spec is None:
+                return self.get_image_frame(backend)
+            return self.render_frame(robot, spec)
+        elif name == 'STATS':
+            fmt = bytes(payload[:length]).decode('utf-8') or 'json'
+            return [self.collect_stats(fmt).encode('utf-8')]
+        elif name == 'ROBOTS':
+            return [json.dumps(self.robots).encode('utf-8')]
+        elif name == 'OBSERVE':
+            return self.observe(robot, payload, length)
+        elif name == 'SHM_OPEN':
+            return [json.dumps(self.open_shared_memory(robot)).encode('utf-8')]
+        elif name == 'END':
+            return [b'']
+        raise NotImplementedError('NOTIMP fn code {}'.format(fn))
+
+    def sync_step(self, payload, length, timing=None, version=PROTOCOL_VERSION):
+        """
+        start the step of every robot of a SYNC_STEP request at once, each
+        on its own thread of sync_executor, and pack their states once all are done. A failed
+        step fails the whole request after the others finished
+        """
+        steps = unpack_sync(payload, length)
+        robots = [robot for robot, step_payload in steps]
+        if len(set(robots)) != len(robots):
+            raise ValueError('robots {} are stepped more than once'.format(robots))
+        backends = [self.get_backend(robot) for robot in robots]
+        results = [None] * len(steps)
+        finished = [0.0] * len(steps)
+
+        def run(i):
+            ctype, relative, unit, data, trace_decimation, nowait = unpack_step(
+                steps[i][1], len(steps[i][1]))
+            try:
+                results[i] = backends[i].step(ctype, relative, unit, data.tolist(),
+                                              trace_decimation, nowait)
+            except Exception as e:
+                results[i] = e
+            finished[i] = time.time()
+        start = time.time()
+        done = [threading.Event() for i in range(1, len(steps))]
+        for i, event in enumerate(done, 1):
+            # run catches the errors of the step, so done has none to handle
+            self.sync_executor.submit(run, (i,),
+                                      lambda result, error, event=event: event.set())
+        if steps:
+            run(0)
+        for event in done:
+            event.wait()
+        seconds = time.time() - start
+        skew = max(finished) - min(finished) if steps else 0.0
+        self.metrics.histogram('server_sync_skew_seconds',
+                               'seconds between the first and the last robot '
+                               'finishing a SYNC_STEP').observe(skew)
+        SYNC_STEP_EVENT(len(steps), seconds, skew)
+        if timing is not None:
+            timing['service'] = seconds
+        for robot, result in zip(robots, results):
+            if isinstance(result, Exception):
+                raise ValueError('robot {}: {}'.format(robot, result))
+        return pack_sync([(robot, pack_state(result, version))
+                          for robot, result in zip(robots, results)])
+
     def create_server(self):
         print('starting server at %s'%self.port)
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         # 0.0.0.0 will accept from any address - makes this work on docker 
-        self.server_socket.bind(('0.0.0.0', self.port))
-        self.server_socket.listen(5)
-        self.server_socket.settimeout(180)
-        self.connected = False
-        while True:
-            try:
-                c, addr = self.server_socket.accept()
-                thread.start_new_thread(self.chat_with_client, (c,addr))
-                self.client_num +=1 
-            except Exception as e:
-                print(e)
-                self.disconnect()
-                sys.exit()
-
-    def disconnect(self):
-        if self.connected:
-            self.server_socket.close()
-            self.connected = False
-
-    def chat_with_client(self, connection, client_address):
-        print('connected to client:{} at {}'.format(self.client_num, client_address))
-        connected = True
-        while connected:
-            try:
-                # every message needs a response before it will send a new
-                # message
-                # TODO - will need to handle large messages eventually, but
-                # leave this for now
-                rx_data = connection.recv(100000)
-                if rx_data:
-                    rx_data = rx_data.decode().strip()
-                    print("rx", rx_data)
-                    if rx_data.endswith(self.endseq):
-                        fn, cmd = rx_data[len(self.startseq):-len(self.endseq):].split(self.midseq)
-                        ret_msg = self.handle_msg(fn, cmd)
-                        connection.sendall(ret_msg)
-                        if fn.upper() == 'END':
-                            connected = False
-                    else:
-                        print(rx_data, 'does not end with', self.endseq)
-  
-                else:
-                    time.sleep(.1)
-            except Exception as e:
-                print('EXCEPTION: {}'.format(e))
-                self.disconnect()
-                sys.exit()
-        connection.close()
- 
-                    
+        loop = ServerLoop(self, self.port, host='0.0.0.0', n_workers=self.n_workers)
+        # state_stream_callback reads the streams once the loop is set
+        self.state_streams = [StateStream(loop) for backend in self.backends]
+        self.loop = loop
+        self.metrics.gauge('server_connections', 'connected clients',
+                           fn=lambda: len(self.loop.connections))
+        self.loop.serve_forever(should_stop=self.backend.should_stop)
+
+    def parse_text(self, rx_data):
+        """ returns fn, cmd of a '<|fn**cmd|>' text message """
+        rx_data = rx_data.decode().strip()
+        fn, cmd = rx_data[len(self.startseq):-len(self.endseq):].split(self.midseq)
+        return fn, cmd
+
+    def request_name(self, conn, request):
+        if conn.binary:
+            return FN_NAMES.get(request[0], str(request[0]))
+        return self.parse_text(request)[0].upper()
+
+    def text_fn(self, request):
+        """ function name of a text request, without failing on malformed ones """
+        text = request.decode('utf-8', 'replace').strip()
+        if text.startswith(self.startseq):
+            text = text[len(self.startseq):]
+        return text.split(self.midseq)[0].split(self.endseq)[0].upper()
+
+    def metric_fn(self, fn):
+        """
+        fn label of the metrics of a request. Names come from the client, so
+        unknown ones share one label instead of adding a series each
+        """
+        return fn if fn in FN_CODES else 'unknown'
+
+    def is_inline(self, conn, request):
+        """ requests which never wait on a ROS service are answered on the server loop """
+        name = self.request_name(conn, request)
+        if name == 'RENDER':
+            # preprocessing and compressing a frame would stall the loop
+            return not conn.binary or not len(request[3])
+        return name in ('END', 'SUBSCRIBE', 'UNSUBSCRIBE', 'ROBOTS', 'SHM_OPEN')
+
+    def is_ordered(self, conn, request):
+        """ requests which command the robot run in the order their client sent them """
+        if not conn.binary:
+            return True
+        return FN_NAMES.get(request[0]) in ('INIT', 'RESET', 'STEP', 'STEP_BATCH', 'HOME',
+                                            'SYNC_STEP')
+
+    def handle_request(self, conn, request):
+        """ returns the list of buffers to send back for a text or binary request """
+        fn = self.request_name(conn, request)
+        label = self.metric_fn(fn)
+        protocol = 'binary' if conn.binary else 'text'
+        self.metrics.counter('server_requests_total', 'requests received',
+                             fn=label, protocol=protocol).inc()
+        start = time.time()
+        parts = self.serve_request(conn, request)
+        seconds = time.time() - start
+        self.metrics.histogram('server_request_seconds', 'seconds to handle a request',
+                               fn=label, protocol=protocol).observe(seconds)
+        REQUEST_EVENT(FN_CODES.get(fn, 0), conn.binary, seconds)
+        return parts
+
+    def serve_request(self, conn, request):
+        if not conn.binary:
+            fn, cmd = self.parse_text(request)
+            if fn.upper() == 'END':
+                conn.closing = True
+            return [self.handle_msg(fn, cmd)]
+        fn, flags, request_id, payload, robot = request
+        reply_flags = FLAG_REPLY
+        if fn == FN_CODES['END']:
+            conn.closing = True
+        if fn == FN_CODES['SUBSCRIBE']:
+            # pushes are sent as SUBSCRIBE frames with FLAG_PUSH and this request_id
+            self.get_backend(robot)  # raises for an unknown robot
+            self.state_streams[robot].subscribe(conn, request_id, payload)
+            parts = [b'']
+        elif fn == FN_CODES['UNSUBSCRIBE']:
+            sub_id, = UNSUBSCRIBE_REQUEST.unpack_from(payload)
+            if not any(stream.unsubscribe(conn, sub_id) for stream in self.state_streams):
+                raise KeyError('no subscription {}'.format(sub_id))
+            parts = [b'']
+        elif flags & FLAG_TIMING:
+            start = time.time()
+            timing = {}
+            parts = self.handle_frame(fn, payload, len(payload), timing, robot, conn.version)
+            timing['handle'] = time.time() - start
+            parts.append(pack_timing(timing))
+            reply_flags |= FLAG_TIMING
+        else:
+            parts = self.handle_frame(fn, payload, len(payload), robot=robot,
+                                      version=conn.version)
+        reply_length = sum(len(part) for part in parts)
+        return [pack_header(fn, reply_length, reply_flags, request_id, robot,
+                            conn.version)] + parts
+
+    def handle_error(self, conn, request, error):
+        """ report a failed request to its client instead of closing the connection """
+        rospy.logerr('client {} request failed: {}'.format(conn.number, error))
+        # the request may be malformed, so it is not parsed again
+        fn = FN_NAMES.get(request[0], str(request[0])) if conn.binary else self.text_fn(request)
+        self.metrics.counter('server_request_errors_total', 'requests which failed',
+                             fn=self.metric_fn(fn)).inc()
+        if not conn.binary:
+            ret_msg = self.startseq+'ACK'+fn+self.midseq+'ERROR: {}'.format(error)+self.endseq
+            return [ret_msg.encode()]
+        fn, flags, request_id, payload, robot = request
+        msg = str(error).encode('utf-8')
+        return [pack_header(fn, len(msg), FLAG_REPLY | FLAG_ERROR, request_id, robot,
+                            conn.version), msg]
+
+    def on_connect(self, conn):
+        print('connected to client:{} at {}'.format(conn.number, conn.address))
+
+    def on_disconnect(self, conn, reason):
+        for stream in self.state_streams:
+            stream.drop_connection(conn)
+        print('disconnected client:{} at {}: {}'.format(conn.number, conn.address, reason))
+
 
 if __name__ == '__main__':
     from IPython import embed
@@ -0,0 +1,410 @@
+"""
+Single threaded select() loop serving every RobotServer client.
+
+Sockets are non-blocking and each connection keeps its own read and write
+buffers, so a slow or broken client only ever affects itself. Requests which
+block on ROS services are handed to a bounded pool of worker threads and their
+replies are passed back to the loop through a wakeup socket.
+"""
+import errno
+import select
+import socket
+import threading
+import traceback
+from collections import deque
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from ros_interface.interfaces.protocol import HEADER, MAGIC, PROTOCOL_VERSION, unpack_header
+from ros_interface.interfaces.protocol import ProtocolError
+
+RETRY_ERRNOS = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+
+class BoundedExecutor():
+    """
+    fixed number of worker threads fed from a bounded queue. try_submit never
+    blocks - it returns False when the queue is full and the caller retries
+    """
+    def __init__(self, n_workers=4, max_pending=16):
+        self.tasks = queue.Queue(maxsize=max_pending)
+        self.workers = []
+        for i in range(n_workers):
+            worker = threading.Thread(target=self.work,
+                                      name='robot_server_worker_%d' % i)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def try_submit(self, fn, args, done):
+        """ run fn(*args) on a worker, then call done(result, error) there """
+        try:
+            self.tasks.put_nowait((fn, args, done))
+        except queue.Full:
+            return False
+        return True
+
+    def submit(self, fn, args, done):
+        """ like try_submit, but waits for room in the queue """
+        self.tasks.put((fn, args, done))
+
+    def work(self):
+        while True:
+            fn, args, done = self.tasks.get()
+            try:
+                result = fn(*args)
+            except Exception as e:
+                done(None, e)
+            else:
+                done(result, None)
+
+
+class Connection():
+    """
+    one client socket with its read/write buffers and request state.
+    max_request_bytes: longest request accepted, and how much is read ahead
+    of the requests being handled
+    """
+    def __init__(self, sock, address, number, chunk_size=1 << 16,
+                 max_request_bytes=16 << 20):
+        self.sock = sock
+        self.address = address
+        self.number = number
+        self.max_request_bytes = max_request_bytes
+        self.rbuf = bytearray()
+        self.chunk = bytearray(chunk_size)
+        self.chunk_view = memoryview(self.chunk)
+        self.wbuf = deque()
+        self.wbuf_bytes = 0
+        # decided by the first bytes the client sends
+        self.binary = None
+        # protocol version of the binary requests, replies use the same
+        self.version = PROTOCOL_VERSION
+        # request parsed but waiting for a free executor slot
+        self.pending = None
+        # number of requests of this connection being handled by workers
+        self.in_flight = 0
+        # an ordered request (one which commands the robot) is in flight
+        self.ordered_busy = False
+        # close as soon as the write buffer has drained
+        self.closing = False
+        self.closed = False
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def read(self):
+        """
+        read everything available, or until the read buffer is full. returns
+        False once the peer closed
+        """
+        while True:
+            try:
+                nbytes = self.sock.recv_into(self.chunk_view)
+            except socket.error as e:
+                if e.args[0] in RETRY_ERRNOS:
+                    return True
+                raise
+            if not nbytes:
+                return False
+            self.rbuf += self.chunk_view[:nbytes]
+            if nbytes < len(self.chunk) or self.rbuf_full():
+                return True
+
+    def rbuf_full(self):
+        """ the loop stops reading until the buffered requests were handled """
+        return len(self.rbuf) > self.max_request_bytes
+
+    def next_request(self, endseq):
+        """
+        pop the next complete request from the read buffer, or None. Binary
+        requests are (fn, flags, request_id, payload, robot), text requests
+        are the raw message string. Raises ProtocolError for a request longer
+        than max_request_bytes
+        """
+        if self.pending is not None:
+            request, self.pending = self.pending, None
+            return request
+        if self.binary is None:
+            if len(self.rbuf) < len(MAGIC):
+                return None
+            self.binary = bytes(self.rbuf[:len(MAGIC)]) == MAGIC
+        if self.binary:
+            if len(self.rbuf) < HEADER.size:
+                return None
+            fn, flags, request_id, length, robot = unpack_header(self.rbuf)
+            self.version = self.rbuf[2]
+            end = HEADER.size + length
+            if end > self.max_request_bytes:
+                raise ProtocolError('request of {} bytes is longer than {}'.format(
+                    end, self.max_request_bytes))
+            if len(self.rbuf) < end:
+                return None
+            payload = self.rbuf[HEADER.size:end]
+            del self.rbuf[:end]
+            return fn, flags, request_id, payload, robot
+        end = self.rbuf.find(endseq)
+        if end < 0:
+            if self.rbuf_full():
+                raise ProtocolError('no end of the text request in {} bytes'.format(
+                    len(self.rbuf)))
+            return None
+        end += len(endseq)
+        text = bytes(self.rbuf[:end])
+        del self.rbuf[:end]
+        return text
+
+    def write(self, parts):
+        for part in parts:
+            if len(part):
+                self.wbuf.append(memoryview(part))
+                self.wbuf_bytes += len(part)
+
+    def flush(self):
+        """ send as much of the write buffer as the socket accepts """
+        while self.wbuf:
+            part = self.wbuf[0]
+            try:
+                nbytes = self.sock.send(part)
+            except socket.error as e:
+                if e.args[0] in RETRY_ERRNOS:
+                    return
+                raise
+            self.wbuf_bytes -= nbytes
+            if nbytes < len(part):
+                self.wbuf[0] = part[nbytes:]
+                return
+            self.wbuf.popleft()
+
+
+class ServerLoop():
+    """
+    handler must implement:
+        handle_request(conn, request) -> list of reply buffers
+        handle_error(conn, request, error) -> list of reply buffers. Also
+            called for requests which could not even be classified, so it
+            must not fail on a malformed request
+        is_inline(conn, request) -> True if the request never blocks and can
+            be answered on the loop thread
+        is_ordered(conn, request) -> True if the request must not overlap
+            other ordered requests of the same connection
+        on_connect(conn), on_disconnect(conn, reason)
+
+    Text clients wait for each reply, so their requests are handled one at a
+    time. Binary clients tag requests with ids and may have up to
+    max_in_flight of them handled at once, with ordered requests (robot
+    commands) still run one after the other in the order they were sent.
+
+    A client sending a request longer than max_request_bytes is dropped.
+    """
+    def __init__(self, handler, port, host='0.0.0.0', n_workers=4,
+                 max_pending=16, max_write_buffer=64 << 20, poll_secs=.5,
+                 endseq=b'|>', max_in_flight=8, max_request_bytes=16 << 20):
+        self.handler = handler
+        self.max_in_flight = max_in_flight
+        self.max_request_bytes = max_request_bytes
+        self.endseq = endseq
+        self.max_write_buffer = max_write_buffer
+        self.poll_secs = poll_secs
+        self.executor = BoundedExecutor(n_workers, max_pending)
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server_socket.bind((host, port))
+        self.server_socket.listen(16)
+        self.server_socket.setblocking(False)
+        # workers write a byte here to wake up select when a reply is ready
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
+        self.wakeup_r.setblocking(False)
+        self.wakeup_w.setblocking(False)
+        self.completed = deque()
+        self.callbacks = deque()
+        # call_soon callbacks which raised
+        self.callback_errors = 0
+        self.connections = {}
+        self.client_num = 0
+        self.running = False
+
+    def serve_forever(self, should_stop=None):
+        self.running = True
+        while self.running and not (should_stop and should_stop()):
+            conns = list(self.connections.values())
+            readers = [self.server_socket, self.wakeup_r]
+            readers += [c for c in conns if not c.closing and not c.rbuf_full()]
+            writers = [c for c in conns if c.wbuf]
+            try:
+                readable, writable, _ = select.select(readers, writers, [],
+                                                      self.poll_secs)
+            except (select.error, socket.error) as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for sock in readable:
+                if sock is self.server_socket:
+                    self.accept()
+                elif sock is self.wakeup_r:
+                    self.drain_wakeup()
+                elif not sock.closed:
+                    self.read(sock)
+            self.process_completed()
+            for conn in writable:
+                if not conn.closed:
+                    self.flush(conn)
+            for conn in list(self.connections.values()):
+                self.dispatch(conn)
+                if conn.closing and not conn.wbuf and not conn.in_flight:
+                    self.drop(conn, 'closed')
+        self.close()
+
+    def stop(self):
+        self.running = False
+        self.wakeup()
+
+    def close(self):
+        for conn in list(self.connections.values()):
+            self.drop(conn, 'server stopped')
+        self.server_socket.close()
+
+    def accept(self):
+        while True:
+            try:
+                sock, address = self.server_socket.accept()
+            except socket.error as e:
+                if e.args[0] in RETRY_ERRNOS:
+                    return
+                raise
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.client_num += 1
+            conn = Connection(sock, address, self.client_num,
+                              max_request_bytes=self.max_request_bytes)
+            self.connections[conn.fileno()] = conn
+            self.handler.on_connect(conn)
+
+    def read(self, conn):
+        try:
+            if not conn.read():
+                conn.closing = True
+        except Exception as e:
+            self.drop(conn, e)
+
+    def flush(self, conn):
+        try:
+            conn.flush()
+        except Exception as e:
+            self.drop(conn, e)
+
+    def drop(self, conn, reason):
+        if conn.closed:
+            return
+        conn.closed = True
+        self.connections.pop(conn.fileno(), None)
+        try:
+            conn.sock.close()
+        except socket.error:
+            pass
+        self.handler.on_disconnect(conn, reason)
+
+    def dispatch(self, conn):
+        """ start the buffered requests of conn which are allowed to run now """
+        while not conn.closed:
+            if not conn.binary and conn.in_flight:
+                return
+            try:
+                request = conn.next_request(self.endseq)
+            except Exception as e:
+                self.drop(conn, e)
+                return
+            if request is None:
+                return
+            try:
+                inline = self.handler.is_inline(conn, request)
+                ordered = not inline and self.handler.is_ordered(conn, request)
+            except Exception as e:
+                # a malformed request only fails itself
+                self.fail(conn, request, e)
+                continue
+            if inline:
+                self.run_inline(conn, request)
+                continue
+            if ((ordered and conn.ordered_busy) or
+                    conn.in_flight >= self.max_in_flight or
+                    not self.executor.try_submit(
+                        self.handler.handle_request, (conn, request),
+                        self.make_done(conn, request, ordered))):
+                # keep it (and everything after it) until there is room
+                conn.pending = request
+                return
+            conn.in_flight += 1
+            if ordered:
+                conn.ordered_busy = True
+
+    def run_inline(self, conn, request):
+        try:
+            parts = self.handler.handle_request(conn, request)
+        except Exception as e:
+            self.fail(conn, request, e)
+            return
+        self.reply(conn, parts)
+
+    def fail(self, conn, request, error):
+        """ reply with the error of a request, or drop conn if even that fails """
+        try:
+            parts = self.handler.handle_error(conn, request, error)
+        except Exception as e:
+            self.drop(conn, e)
+            return
+        self.reply(conn, parts)
+
+    def make_done(self, conn, request, ordered):
+        def done(parts, error):
+            self.completed.append((conn, request, ordered, parts, error))
+            self.wakeup()
+        return done
+
+    def call_soon(self, fn, *args):
+        """ run fn(*args) on the loop thread. Safe to call from any thread """
+        self.callbacks.append((fn, args))
+        self.wakeup()
+
+    def wakeup(self):
+        try:
+            self.wakeup_w.send(b'x')
+        except socket.error:
+            # the buffer is full, so the loop is already going to wake up
+            pass
+
+    def drain_wakeup(self):
+        try:
+            while self.wakeup_r.recv(4096):
+                pass
+        except socket.error:
+            pass
+
+    def process_completed(self):
+        while self.callbacks:
+            fn, args = self.callbacks.popleft()
+            try:
+                fn(*args)
+            except Exception:
+                # one bad callback, e.g. a malformed state row, must not stop the loop
+                self.callback_errors += 1
+                traceback.print_exc()
+        while self.completed:
+            conn, request, ordered, parts, error = self.completed.popleft()
+            conn.in_flight -= 1
+            if ordered:
+                conn.ordered_busy = False
+            if conn.closed:
+                continue
+            if error is not None:
+                self.fail(conn, request, error)
+                continue
+            self.reply(conn, parts)
+
+    def reply(self, conn, parts):
+        conn.write(parts)
+        self.flush(conn)
+        if conn.wbuf_bytes > self.max_write_buffer:
+            self.drop(conn, 'client is not reading replies')
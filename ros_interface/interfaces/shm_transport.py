@@ -0,0 +1,241 @@
+"""
+Shared memory rings for clients on the same host as the robot server.
+
+After a SHM_OPEN request the server writes every state row of the robot
+and every camera frame into a ring of slots in a file under /dev/shm, and a
+client on the same host maps the files and reads the latest state or frame
+straight from memory, without a request, a copy or the socket:
+
+    observer = rc.open_shared_memory()
+    state = observer.state()            # views into the ring, no copy
+    frame, info = observer.image()
+
+A ring is a RING_HEADER followed by n_slots slots of slot_size bytes. Each
+slot starts with a SLOT_HEADER of the sequence number the writer started
+and finished writing it with and the length of its payload. The writer sets
+begin, writes the payload, sets end and then the latest sequence number of
+the ring header. A reader takes the slot of the latest sequence number,
+uses its payload if end is that number, and checks begin again afterwards:
+if begin changed the slot was overwritten while it was read. Views returned
+without copy stay valid until the writer wraps around the ring, which
+ShmRing.valid(seq) tells.
+
+State payloads are in the STREAM_HEADER format of pushed states with every
+STREAM_FIELD, image payloads are an IMAGE_HEADER followed by the pixels, as
+in RENDER replies.
+
+multiprocessing.shared_memory is python 3 only and the server runs on
+python 2 as well, so the rings are plain files in /dev/shm mapped with mmap.
+"""
+import mmap
+import os
+import struct
+import time
+
+import numpy as np
+
+from ros_interface.interfaces.protocol import ALL_STREAM_FIELDS, IMAGE_HEADER
+from ros_interface.interfaces.protocol import pack_image_header, pack_state_push
+from ros_interface.interfaces.protocol import unpack_state_push, unpack_image_header
+from ros_interface.interfaces.protocol import image_array
+from ros_interface.interfaces.state_stream import split_state_row
+
+SHM_DIRECTORY = '/dev/shm'
+SHM_MAGIC = b'RISM'
+SHM_VERSION = 1
+# magic, version, n_slots, slot_size, latest sequence number
+RING_HEADER = struct.Struct('<4sIIIQ')
+# begin and end sequence number and number of payload bytes of a slot
+SLOT_HEADER = struct.Struct('<QQQ')
+# enough for the stream rows of any kinova arm
+STATE_SLOT_SIZE = 4096
+
+
+class ShmRing(object):
+    def __init__(self, path, n_slots=None, slot_size=None):
+        """
+        map the ring at path. With n_slots and slot_size (payload bytes of a
+        slot) a new ring is created there, otherwise an existing one is opened
+        """
+        self.path = path
+        if n_slots is not None:
+            self.slot_size = SLOT_HEADER.size + slot_size
+            size = RING_HEADER.size + n_slots * self.slot_size
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+            try:
+                os.ftruncate(fd, size)
+                self.mm = mmap.mmap(fd, size)
+            finally:
+                os.close(fd)
+            RING_HEADER.pack_into(self.mm, 0, SHM_MAGIC, SHM_VERSION, n_slots,
+                                  self.slot_size, 0)
+        else:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                self.mm = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+            finally:
+                os.close(fd)
+            magic, version, n_slots, self.slot_size, latest = RING_HEADER.unpack_from(self.mm)
+            if magic != SHM_MAGIC or version != SHM_VERSION:
+                raise ValueError('{} is not a version {} ring'.format(path, SHM_VERSION))
+        self.n_slots = n_slots
+        self.payload_size = self.slot_size - SLOT_HEADER.size
+        self.seq = self.latest()
+
+    def slot_offset(self, seq):
+        return RING_HEADER.size + ((seq - 1) % self.n_slots) * self.slot_size
+
+    def latest(self):
+        """ sequence number of the newest complete slot, 0 before the first """
+        return struct.unpack_from('<Q', self.mm, RING_HEADER.size - 8)[0]
+
+    def write(self, parts):
+        """ write the concatenation of parts into the next slot. Returns its sequence number """
+        nbytes = sum(len(part) for part in parts)
+        if nbytes > self.payload_size:
+            raise ValueError('{} bytes do not fit in slots of {}'.format(nbytes, self.payload_size))
+        seq = self.seq + 1
+        offset = self.slot_offset(seq)
+        SLOT_HEADER.pack_into(self.mm, offset, seq, 0, nbytes)
+        position = offset + SLOT_HEADER.size
+        for part in parts:
+            self.mm[position:position + len(part)] = part
+            position += len(part)
+        struct.pack_into('<Q', self.mm, offset + 8, seq)
+        struct.pack_into('<Q', self.mm, RING_HEADER.size - 8, seq)
+        self.seq = seq
+        return seq
+
+    def read(self, tries=3):
+        """
+        seq and a uint8 view of the payload of the newest slot, or None
+        before the first write
+        """
+        for i in range(tries):
+            seq = self.latest()
+            if not seq:
+                return None
+            offset = self.slot_offset(seq)
+            begin, end, nbytes = SLOT_HEADER.unpack_from(self.mm, offset)
+            if begin != seq or end != seq:
+                # overwritten since latest was read
+                continue
+            view = np.frombuffer(self.mm, dtype=np.uint8, count=nbytes,
+                                 offset=offset + SLOT_HEADER.size)
+            if self.valid(seq):
+                return seq, view
+        raise RuntimeError('{} is written faster than it can be read'.format(self.path))
+
+    def valid(self, seq):
+        """ whether the slot of seq still holds it """
+        return SLOT_HEADER.unpack_from(self.mm, self.slot_offset(seq))[0] == seq
+
+    def close(self, unlink=False):
+        self.mm.close()
+        if unlink:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+
+class SharedMemoryPublisher(object):
+    """
+    server side of one robot: writes its state rows and camera frames into
+    rings. Each ring has a single writer - the ROS callback of its topic
+    """
+    def __init__(self, name, directory=SHM_DIRECTORY, state_slots=1024, image_slots=4):
+        prefix = os.path.join(directory, 'ros_interface_{}_{}'.format(os.getpid(), name))
+        self.state_path = prefix + '_state'
+        self.image_path = prefix + '_image'
+        self.image_slots = image_slots
+        self.states = ShmRing(self.state_path, state_slots, STATE_SLOT_SIZE)
+        # created by the first frame, which tells the slot size
+        self.images = None
+        self.dropped = 0
+
+    def describe(self):
+        return {'state': self.state_path, 'image': self.image_path}
+
+    def publish_state(self, row, n_joint_states):
+        stamp, n_states, values = split_state_row(np.asarray(row), n_joint_states)
+        self.states.write([pack_state_push(stamp, n_states, n_joint_states,
+                                           ALL_STREAM_FIELDS, values)])
+
+    def publish_image(self, seq, stamp, height, width, encoding, data):
+        if self.images is None:
+            self.images = ShmRing(self.image_path, self.image_slots,
+                                  IMAGE_HEADER.size + len(data))
+        if IMAGE_HEADER.size + len(data) > self.images.payload_size:
+            # the camera changed resolution, clients keep the old size
+            self.dropped += 1
+            return
+        self.images.write([pack_image_header(seq, stamp, height, width, encoding, len(data)),
+                           data])
+
+    def close(self):
+        self.states.close(unlink=True)
+        if self.images is not None:
+            self.images.close(unlink=True)
+
+
+class SharedMemoryObserver(object):
+    """
+    client side, see the module docstring. Only works on the host of the
+    server - the rings are files there
+    """
+    def __init__(self, description):
+        """ description: the SHM_OPEN reply, paths of the rings """
+        self.description = description
+        self.states = ShmRing(description['state'])
+        self.images = None
+
+    def state(self, copy=False):
+        """
+        the latest state as pushed states are (see unpack_state_push) with
+        its ring sequence number as 'seq', or None before the first. Without
+        copy the arrays are views into the ring
+        """
+        slot = self.states.read()
+        if slot is None:
+            return None
+        seq, view = slot
+        if copy:
+            view = view.copy()
+        state = unpack_state_push(view, len(view))
+        state['seq'] = seq
+        return state
+
+    def wait_state(self, after_seq, timeout=1.0, poll=0.0001):
+        """ the first state newer than after_seq, None after timeout seconds """
+        deadline = time.time() + timeout
+        while self.states.latest() <= after_seq:
+            if time.time() > deadline:
+                return None
+            time.sleep(poll)
+        return self.state()
+
+    def image(self, copy=False):
+        """
+        (height, width, channels) array and info of the latest frame, None
+        before the first. Without copy the array is a view into the ring
+        """
+        if self.images is None:
+            if not os.path.exists(self.description['image']):
+                return None
+            self.images = ShmRing(self.description['image'])
+        slot = self.images.read()
+        if slot is None:
+            return None
+        seq, view = slot
+        info = unpack_image_header(view)
+        info['ring_seq'] = seq
+        pixels = view[IMAGE_HEADER.size:IMAGE_HEADER.size + info['nbytes']]
+        if copy:
+            pixels = pixels.copy()
+        return image_array(pixels, info), info
+
+    def close(self):
+        self.states.close()
+        if self.images is not None:
+            self.images.close()
@@ -0,0 +1,103 @@
+"""
+Pushes robot state to subscribed clients over their open connection.
+
+JacoRobot publishes every joint state update as one compact float64 row on
+STATE_STREAM_TOPIC in its namespace:
+
+    [stamp, n_states, joint_pos, joint_vel, joint_effort, tool_pos (7), finger_pos (3)]
+
+RobotServer receives every row - it keeps them for OBSERVE and the shared
+memory rings - and, while clients are subscribed, hands each row to
+StateStream.publish on its server loop. That serialises it once per
+requested field mask and queues it on every client whose rate and
+decimation say it is due.
+"""
+import numpy as np
+
+from ros_interface.interfaces.protocol import FN_CODES, FLAG_PUSH
+from ros_interface.interfaces.protocol import SUBSCRIBE_REQUEST, pack_header
+from ros_interface.interfaces.protocol import pack_state_push, stream_field_sizes
+
+STATE_STREAM_TOPIC = 'state_stream'
+
+
+def split_state_row(row, n_joint_states):
+    """ returns stamp, n_states and views of each STREAM_FIELD of a state row """
+    values = []
+    offset = 2
+    for size in stream_field_sizes(n_joint_states):
+        values.append(row[offset:offset + size])
+        offset += size
+    return row[0], int(row[1]), values
+
+
+class Subscription():
+    def __init__(self, conn, request_id, rate, decimation, mask):
+        self.conn = conn
+        self.request_id = request_id
+        self.min_interval = 1.0 / rate if rate > 0 else 0.0
+        self.decimation = max(1, decimation)
+        self.mask = mask
+        self.count = 0
+        self.last_stamp = None
+        self.sent = 0
+        self.dropped = 0
+
+    def due(self, stamp):
+        self.count += 1
+        if self.count % self.decimation:
+            return False
+        if self.last_stamp is not None and stamp - self.last_stamp < self.min_interval:
+            return False
+        self.last_stamp = stamp
+        return True
+
+
+class StateStream():
+    """
+    subscriptions of all connections. Every method runs on the server loop
+    thread so no locking is needed.
+    max_backlog: skip pushes to a client while it has more than this many
+    bytes waiting to be sent, rather than queueing without bound
+    """
+    def __init__(self, loop, max_backlog=1 << 20):
+        self.loop = loop
+        self.max_backlog = max_backlog
+        self.subscriptions = {}
+
+    def subscribe(self, conn, request_id, payload):
+        rate, decimation, mask = SUBSCRIBE_REQUEST.unpack_from(payload)
+        sub = Subscription(conn, request_id, rate, decimation, mask)
+        self.subscriptions[(conn.number, request_id)] = sub
+        return sub
+
+    def unsubscribe(self, conn, request_id):
+        return self.subscriptions.pop((conn.number, request_id), None) is not None
+
+    def drop_connection(self, conn):
+        for key in [k for k in self.subscriptions if k[0] == conn.number]:
+            del self.subscriptions[key]
+
+    def publish(self, row, n_joint_states):
+        if not self.subscriptions:
+            return
+        stamp, n_states, values = split_state_row(np.asarray(row), n_joint_states)
+        packed = {}
+        for key, sub in list(self.subscriptions.items()):
+            if sub.conn.closed:
+                del self.subscriptions[key]
+                continue
+            if not sub.due(stamp):
+                continue
+            if sub.conn.wbuf_bytes > self.max_backlog:
+                sub.dropped += 1
+                continue
+            payload = packed.get(sub.mask)
+            if payload is None:
+                payload = pack_state_push(stamp, n_states, n_joint_states,
+                                          sub.mask, values)
+                packed[sub.mask] = payload
+            header = pack_header(FN_CODES['SUBSCRIBE'], len(payload), FLAG_PUSH,
+                                 sub.request_id, version=sub.conn.version)
+            self.loop.reply(sub.conn, [header, payload])
+            sub.sent += 1
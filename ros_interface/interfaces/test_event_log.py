@@ -0,0 +1,69 @@
+import signal
+
+import pytest
+
+from ros_interface.interfaces.event_log import EventLog, MAX_FIELDS
+
+
+def test_events_are_formatted_when_read():
+    log = EventLog()
+    step = log.event('step', ('type', 'relative', 'n_data'), type=('VEL', 'ANGLE'))
+    home = log.event('home')
+    step(1, True, 7)
+    home()
+    step(5, 0, 0.25)
+    lines = log.lines()
+    assert [line.split(' ', 1)[1] for line in lines] == [
+        'step type=ANGLE relative=1 n_data=7',
+        'home',
+        # out of range of its table, the index is shown as a number
+        'step type=5 relative=0 n_data=0.25']
+    assert float(lines[0].split(' ')[0]) > 0
+    assert log.text().endswith('\n')
+
+
+def test_declaring_again_returns_the_first_event():
+    log = EventLog()
+    first = log.event('step', ('a',))
+    assert log.event('step', ('b',)) is first
+    with pytest.raises(ValueError):
+        log.event('wide', ['f%d' % i for i in range(MAX_FIELDS + 1)])
+
+
+def test_ring_keeps_the_latest_records_in_order():
+    log = EventLog(capacity=4)
+    tick = log.event('tick', ('i',))
+    for i in range(10):
+        tick(i)
+    records = log.records()
+    assert records['values'][:, 0].tolist() == [6, 7, 8, 9]
+    assert log.records(last=2)['values'][:, 0].tolist() == [8, 9]
+    assert [line.split(' ', 1)[1] for line in log.lines(last=1)] == ['tick i=9']
+
+
+def test_extra_values_are_named_by_position_and_truncated():
+    log = EventLog()
+    event = log.event('values', ('a',))
+    event(*range(MAX_FIELDS + 2))
+    record = log.records()[0]
+    assert record['n_values'] == MAX_FIELDS
+    assert log.lines()[0].split(' ', 1)[1] == 'values a=0 ' + ' '.join(
+        '{}={}'.format(i, i) for i in range(1, MAX_FIELDS))
+
+
+def test_dump_to_a_file_and_on_signal(tmp_path):
+    log = EventLog()
+    log.event('start')()
+    path = str(tmp_path / 'events.txt')
+    log.dump(path)
+    with open(path) as f:
+        assert f.read() == log.text()
+    signal_path = str(tmp_path / 'signal.txt')
+    previous = signal.getsignal(signal.SIGUSR1)
+    try:
+        assert log.install_dump_signal(signal_path) == signal_path
+        signal.raise_signal(signal.SIGUSR1)
+    finally:
+        signal.signal(signal.SIGUSR1, previous)
+    with open(signal_path) as f:
+        assert f.read().endswith('start\n')
@@ -0,0 +1,85 @@
+import json
+
+import pytest
+
+from ros_interface.interfaces.metrics import MetricsRegistry, RateMeter, merge_prometheus_texts
+
+
+def test_metrics_are_found_by_name_and_labels():
+    metrics = MetricsRegistry()
+    step = metrics.counter('requests_total', 'requests', fn='STEP')
+    assert metrics.counter('requests_total', fn='STEP') is step
+    assert metrics.counter('requests_total', fn='RESET') is not step
+    with pytest.raises(ValueError):
+        metrics.gauge('requests_total')
+
+
+def test_prometheus_text():
+    metrics = MetricsRegistry()
+    metrics.counter('requests_total', 'requests received', fn='STEP').inc(3)
+    metrics.gauge('queue_depth', 'queued', fn=lambda: 2)
+    metrics.gauge('name', 'escaped', label='a"b\\c').set(1.5)
+    histogram = metrics.histogram('step_seconds', 'step duration', buckets=(0.1, 1.0),
+                                  type='VEL')
+    for value in (0.05, 0.5, 0.5, 5.0):
+        histogram.observe(value)
+    assert metrics.prometheus_text() == '\n'.join([
+        '# HELP name escaped',
+        '# TYPE name gauge',
+        'name{label="a\\"b\\\\c"} 1.5',
+        '# HELP queue_depth queued',
+        '# TYPE queue_depth gauge',
+        'queue_depth 2.0',
+        '# HELP requests_total requests received',
+        '# TYPE requests_total counter',
+        'requests_total{fn="STEP"} 3.0',
+        '# HELP step_seconds step duration',
+        '# TYPE step_seconds histogram',
+        'step_seconds_bucket{type="VEL",le="0.1"} 1',
+        'step_seconds_bucket{type="VEL",le="1.0"} 3',
+        'step_seconds_bucket{type="VEL",le="+Inf"} 4',
+        'step_seconds_sum{type="VEL"} 6.05',
+        'step_seconds_count{type="VEL"} 4',
+    ]) + '\n'
+
+
+def test_snapshot_is_json_with_quantiles():
+    metrics = MetricsRegistry()
+    histogram = metrics.histogram('seconds', buckets=(1, 2, 4))
+    for value in (0.5,) * 50 + (1.5,) * 45 + (3,) * 4 + (10,):
+        histogram.observe(value)
+    snapshot = json.loads(json.dumps(metrics.snapshot()))
+    assert snapshot['seconds']['bounds'] == [1, 2, 4]
+    sample = snapshot['seconds']['samples'][0]
+    assert sample['count'] == 100 and sample['max'] == 10
+    assert sample['buckets'] == [50, 45, 4, 1]
+    assert (sample['p50'], sample['p95'], sample['p99']) == (1, 2, 4)
+
+
+def test_merged_texts_keep_families_together():
+    server = MetricsRegistry()
+    server.counter('requests_total', 'requests', fn='STEP').inc()
+    robot = MetricsRegistry()
+    robot.counter('requests_total', 'requests', fn='STEP').inc(2)
+    robot.gauge('temperature', 'celsius').set(40)
+    text = merge_prometheus_texts([({}, server.prometheus_text()),
+                                   ({'robot': 'left'}, robot.prometheus_text())])
+    assert text == '\n'.join([
+        '# HELP requests_total requests',
+        '# TYPE requests_total counter',
+        'requests_total{fn="STEP"} 1.0',
+        'requests_total{fn="STEP",robot="left"} 2.0',
+        '# HELP temperature celsius',
+        '# TYPE temperature gauge',
+        'temperature{robot="left"} 40.0',
+    ]) + '\n'
+
+
+def test_rate_meter():
+    metrics = MetricsRegistry()
+    meter = RateMeter(metrics, 'joint_states', smoothing=0.5, topic='a')
+    for now in (0.0, 0.01, 0.02, 0.03):
+        meter.tick(now)
+    assert metrics.counter('joint_states_total', topic='a').get() == 4
+    assert metrics.histogram('joint_states_interval_seconds', topic='a').count == 3
+    assert metrics.gauge('joint_states_rate_hz', topic='a').get() == pytest.approx(100)
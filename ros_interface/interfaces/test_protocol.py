@@ -0,0 +1,172 @@
+import struct
+
+import numpy as np
+import pytest
+
+from ros_interface.interfaces import protocol
+from ros_interface.interfaces.protocol import FN_CODES, FLAG_REPLY, FLAG_TIMING, ProtocolError
+
+
+class Response(object):
+    """ a service response, as the packers read it """
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+
+def test_header_round_trip():
+    header = protocol.pack_header(FN_CODES['STEP'], 1234, FLAG_REPLY | FLAG_TIMING, 77, 2)
+    assert len(header) == protocol.HEADER.size
+    assert protocol.unpack_header(header) == (FN_CODES['STEP'], FLAG_REPLY | FLAG_TIMING,
+                                              77, 1234, 2)
+
+
+def test_header_rejects_bad_magic_and_version():
+    header = bytearray(protocol.pack_header(FN_CODES['STEP'], 0))
+    with pytest.raises(ProtocolError):
+        protocol.unpack_header(b'XX' + bytes(header[2:]))
+    header[2] = 99
+    with pytest.raises(ProtocolError):
+        protocol.unpack_header(header)
+
+
+def test_timing_round_trip():
+    timing = protocol.unpack_timing(protocol.pack_timing({'handle': 1.5, 'state': .25}))
+    assert timing == {'handle': 1.5, 'service': 0.0, 'command': 0.0, 'state': .25}
+
+
+def test_fence_round_trip():
+    keep_in = [[-1, 1, -1, 1, 0, 1], [-2, 2, -2, 2, 0, 2]]
+    keep_out = [[0, .1, 0, .1, 0, .1]]
+    payload = protocol.pack_fence(keep_in, keep_out)
+    unpacked_in, unpacked_out = protocol.unpack_fence(payload, len(payload))
+    assert unpacked_in.tolist() == keep_in
+    assert unpacked_out.tolist() == keep_out
+
+
+def test_single_box_fence_is_just_its_floats():
+    payload = protocol.pack_fence([-1, 1, -1, 1, 0, 1])
+    assert len(payload) == protocol.FENCE_BOX_SIZE * 8
+    keep_in, keep_out = protocol.unpack_fence(payload, len(payload))
+    assert keep_in.tolist() == [[-1, 1, -1, 1, 0, 1]]
+    assert keep_out.shape == (0, protocol.FENCE_BOX_SIZE)
+
+
+def test_fence_with_wrong_box_count_is_rejected():
+    payload = protocol.FENCE_HEADER.pack(2, 1) + np.zeros(12).tobytes()
+    with pytest.raises(ProtocolError):
+        protocol.unpack_fence(payload, len(payload))
+
+
+def test_step_round_trip():
+    data = [0.1 * i for i in range(7)]
+    payload = protocol.pack_step('ANGLE', True, 'rad', data, trace_decimation=3, nowait=True)
+    ctype, relative, unit, unpacked, trace_decimation, nowait = protocol.unpack_step(
+        payload, len(payload))
+    assert (ctype, relative, unit, trace_decimation, nowait) == ('ANGLE', True, 'rad', 3, True)
+    assert unpacked.tolist() == data
+
+
+def test_step_batch_round_trip():
+    actions = np.arange(21, dtype=float).reshape(3, 7)
+    payload = protocol.pack_step_batch('VEL', False, 'deg', actions)
+    ctype, relative, unit, n_actions, data = protocol.unpack_step_batch(payload, len(payload))
+    assert (ctype, relative, unit, n_actions) == ('VEL', False, 'deg', 3)
+    assert data.reshape(n_actions, -1).tolist() == actions.tolist()
+    with pytest.raises(ValueError):
+        protocol.pack_step_batch('VEL', False, 'deg', actions[0])
+
+
+def test_sync_round_trip():
+    entries = [(0, b'abc'), (3, b''), (1, b'defgh')]
+    payload = protocol.pack_sync(entries)
+    assert [(robot, bytes(data)) for robot, data in
+            protocol.unpack_sync(payload, len(payload))] == entries
+    with pytest.raises(ProtocolError):
+        protocol.unpack_sync(payload, len(payload) - 1)
+
+
+def test_state_round_trip():
+    response = Response(success=True, msg=u'moved °', n_states=12, time_offset=[0.5],
+                        joint_pos=np.arange(7.0), joint_vel=np.ones(7), joint_effort=[],
+                        tool_pos=np.arange(7.0) / 10, finger_pos=[1, 2, 3],
+                        tracking_error=[])
+    state = protocol.unpack_state(protocol.pack_state(response))
+    assert state['success'] and state['msg'] == response.msg and state['n_states'] == 12
+    for name in protocol.STATE_FIELDS:
+        assert state[name].tolist() == np.asarray(getattr(response, name), float).tolist()
+
+
+def test_version_1_state_leaves_out_tracking_error():
+    response = Response(success=True, msg='', n_states=1, time_offset=[0.5],
+                        joint_pos=np.arange(7.0), joint_vel=np.ones(7), joint_effort=[],
+                        tool_pos=np.arange(7.0), finger_pos=[1, 2, 3],
+                        tracking_error=[0.1, 0.2])
+    payload = protocol.pack_state(response, 1)
+    # the header and fields a version 1 client expects, and nothing after them
+    counts = struct.unpack_from('<?xHq6I', payload)[3:]
+    assert counts == (1, 7, 7, 0, 7, 3)
+    assert len(payload) == struct.calcsize('<?xHq6I') + 8 * sum(counts)
+    state = protocol.unpack_state(payload, version=1)
+    assert 'tracking_error' not in state
+    assert state['finger_pos'].tolist() == [1, 2, 3]
+
+
+def test_state_trace_has_a_row_per_sample():
+    response = Response(success=True, msg='', n_states=2, time_offset=[0.0, 0.01],
+                        joint_pos=np.arange(14.0), joint_vel=np.arange(14.0),
+                        joint_effort=np.arange(14.0), tool_pos=np.arange(14.0),
+                        finger_pos=np.arange(6.0), tracking_error=[])
+    state = protocol.unpack_state(protocol.pack_state(response))
+    assert state['joint_pos'].shape == (2, 7)
+    assert state['finger_pos'].tolist() == [[0, 1, 2], [3, 4, 5]]
+
+
+def test_batch_states_round_trip():
+    n_joint_states = 9
+    width = 3 + 3 * n_joint_states + 7 + 3
+    states = np.arange(2 * width, dtype=float).reshape(2, width)
+    response = Response(success=False, msg='fence', n_actions=2,
+                        n_joint_states=n_joint_states, states=states.ravel())
+    payload = protocol.pack_batch_states(response)
+    batch = protocol.unpack_batch_states(payload, len(payload))
+    assert batch['msg'] == 'fence' and batch['n_actions'] == 2
+    assert batch['states'].tolist() == states.tolist()
+    # success is the column of every action
+    assert batch['success'].tolist() == states[:, 0].tolist()
+    assert batch['time_offset'].tolist() == states[:, 2].tolist()
+    assert batch['joint_pos'].tolist() == states[:, 3:12].tolist()
+    assert batch['finger_pos'].tolist() == states[:, -3:].tolist()
+
+
+def test_state_push_round_trip_of_some_fields():
+    values = [np.arange(9.0), np.ones(9), np.zeros(9), np.arange(7.0), np.arange(3.0)]
+    mask = protocol.stream_field_mask(['joint_pos', 'finger_pos'])
+    payload = protocol.pack_state_push(12.5, 4, 9, mask, values)
+    state = protocol.unpack_state_push(payload, len(payload))
+    assert sorted(state) == ['finger_pos', 'joint_pos', 'n_states', 'stamp']
+    assert state['stamp'] == 12.5 and state['n_states'] == 4
+    assert state['joint_pos'].tolist() == values[0].tolist()
+    assert state['finger_pos'].tolist() == values[4].tolist()
+
+
+def test_image_header_and_array():
+    pixels = np.arange(2 * 3 * 3, dtype=np.uint8)
+    header = protocol.pack_image_header(7, 1.25, 2, 3, 'rgb8', pixels.nbytes)
+    info = protocol.unpack_image_header(header)
+    assert info == {'seq': 7, 'stamp': 1.25, 'height': 2, 'width': 3, 'encoding': 'rgb8',
+                    'nbytes': pixels.nbytes}
+    image = protocol.image_array(pixels, info)
+    assert image.shape == (2, 3, 3)
+    assert np.shares_memory(image, pixels)
+
+
+def test_render_request_round_trip():
+    payload = protocol.pack_render_request(crop=(1, 2, 30, 40), size=(84, 84), gray=True,
+                                           compression='zlib', quality=6)
+    spec = protocol.unpack_render_request(payload, len(payload))
+    assert spec == (1, 2, 30, 40, 84, 84, protocol.RENDER_GRAY,
+                    protocol.RENDER_COMPRESSIONS.index('zlib'), 6)
+    assert protocol.unpack_render_request(b'', 0) is None
+    bad = protocol.RENDER_REQUEST.pack(0, 0, 0, 0, 0, 0, 0, 99, 0)
+    with pytest.raises(ProtocolError):
+        protocol.unpack_render_request(bad, len(bad))
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+from ros_interface.interfaces.protocol import split_batch_states
+from ros_interface.interfaces.replay import ReplayBackend
+from ros_interface.robots.episode_store import EpisodeRecorder, EpisodeReader, list_episodes
+
+N_JOINTS = 9
+
+
+def record(root, with_states=True):
+    recorder = EpisodeRecorder(str(root))
+    recorder.start_episode()
+    recorder.record_command('RESET', count_start=0, count_end=0)
+    for count in range(1, 5):
+        if with_states:
+            recorder.record_state(count, float(count), float(count), np.full(N_JOINTS, count),
+                                  np.zeros(N_JOINTS), np.zeros(N_JOINTS), np.zeros(7),
+                                  np.zeros(3))
+        recorder.record_command('STEP', 'ANGLE', 'deg', data=[count] * 7,
+                                count_start=count - 1, count_end=count)
+    recorder.close(timeout=5)
+    return list_episodes(str(root))[0]
+
+
+def test_episode_info_has_the_number_of_joint_states(tmp_path):
+    assert EpisodeReader(record(tmp_path)).info['n_joint_states'] == N_JOINTS
+
+
+def test_step_batch_replies_with_the_recorded_states(tmp_path):
+    backend = ReplayBackend([record(tmp_path)])
+    backend.reset()
+    response = backend.step_batch('ANGLE', False, 'deg', 2, [1] * 7 + [2] * 7)
+    assert response.success and response.n_actions == 2
+    assert response.n_joint_states == N_JOINTS
+    states = split_batch_states(np.reshape(response.states, (2, -1)), N_JOINTS)
+    assert states['joint_pos'].tolist() == [[1] * N_JOINTS, [2] * N_JOINTS]
+
+
+def test_step_batch_of_an_episode_without_states_fails_clearly(tmp_path):
+    backend = ReplayBackend([record(tmp_path, with_states=False)])
+    backend.reset()
+    with pytest.raises(ValueError, match='no recorded states'):
+        backend.step_batch('ANGLE', False, 'deg', 1, [1] * 7)
+    # single steps still replay, with empty states
+    assert backend.step('ANGLE', False, 'deg', [1] * 7).joint_pos == []
@@ -0,0 +1,105 @@
+import json
+import socket
+import threading
+import time
+
+import pytest
+
+from ros_interface.interfaces.protocol import FN_CODES, FLAG_PUSH, FLAG_REPLY, HEADER
+from ros_interface.interfaces.protocol import pack_header, unpack_header
+from ros_interface.interfaces.robot_client import PipelinedRobotCommunicator, RobotCommunicator
+
+
+class FakeServer(object):
+    """ accepts one binary client and answers its requests with script(sock, header) """
+    def __init__(self, script):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(1)
+        self.port = self.listener.getsockname()[1]
+        self.script = script
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def serve(self):
+        sock, address = self.listener.accept()
+        with sock:
+            while True:
+                header = b''
+                while len(header) < HEADER.size:
+                    chunk = sock.recv(HEADER.size - len(header))
+                    if not chunk:
+                        return
+                    header += chunk
+                fn, flags, request_id, length, robot = unpack_header(header)
+                if length:
+                    sock.recv(length, socket.MSG_WAITALL)
+                if not self.script(sock, fn, request_id):
+                    return
+
+
+def reply(sock, fn, request_id, payload=b'', flags=FLAG_REPLY):
+    sock.sendall(pack_header(fn, len(payload), flags, request_id) + payload)
+
+
+def reply_json(sock, fn, request_id, value):
+    reply(sock, fn, request_id, json.dumps(value).encode('utf-8'))
+
+
+def test_reader_survives_push_errors_and_unknown_replies():
+    def script(sock, fn, request_id):
+        if fn == FN_CODES['SUBSCRIBE']:
+            reply(sock, fn, request_id)
+            # a push the client can not unpack and a reply nobody waits for
+            reply(sock, fn, request_id, b'\x00' * 3, FLAG_PUSH | FLAG_REPLY)
+            reply_json(sock, FN_CODES['ROBOTS'], request_id + 100, ['nobody'])
+        else:
+            reply_json(sock, fn, request_id, ['jaco'])
+        return True
+    server = FakeServer(script)
+    rc = PipelinedRobotCommunicator(port=server.port)
+    pushes = []
+    rc.subscribe(pushes.append)
+    assert rc.submit_robots().result(timeout=2) == ['jaco']
+    assert rc.reader_thread.is_alive()
+    assert rc.error is None
+
+
+def test_broken_stream_fails_waiting_and_new_requests():
+    def script(sock, fn, request_id):
+        # close without replying
+        return False
+    server = FakeServer(script)
+    rc = PipelinedRobotCommunicator(port=server.port)
+    future = rc.submit_robots()
+    with pytest.raises(EOFError):
+        future.result(timeout=2)
+    rc.reader_thread.join(2)
+    with pytest.raises(RuntimeError):
+        rc.submit_robots()
+
+
+def test_text_reply_with_the_end_sequence_split_across_reads():
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+
+    def serve():
+        sock, address = listener.accept()
+        with sock:
+            sock.recv(1024)
+            sock.sendall(b'<|True**state|')
+            time.sleep(.1)
+            sock.sendall(b'>')
+            sock.recv(1)
+    thread = threading.Thread(target=serve)
+    thread.daemon = True
+    thread.start()
+    client = RobotCommunicator(port=listener.getsockname()[1])
+    try:
+        client.tcp_socket.settimeout(2)
+        assert client.send('GET_STATE', '') == '<|True**state|>'
+    finally:
+        client.tcp_socket.close()
+        listener.close()
@@ -0,0 +1,252 @@
+import threading
+
+import numpy as np
+import pytest
+
+from ros_interface.interfaces.protocol import FN_CODES, pack_fence, unpack_state
+from ros_interface.interfaces.protocol import pack_step, pack_sync, unpack_sync
+
+KEEP_IN = [[-1, 1, -1, 1, 0, 1], [-2, 2, -2, 2, 0, 2]]
+KEEP_OUT = [[0, 0.1, 0, 0.1, 0, 0.1]]
+
+
+class FakeInterface(object):
+    """ the initialize handler of JacoInterface """
+    def __init__(self):
+        self.requests = []
+
+    def initialize(self, cmd):
+        self.requests.append(cmd)
+        return (True, 'successfully initialized', [], 1, [0.0], [0.0] * 7, [0.0] * 7,
+                [0.0] * 7, [0.0] * 7, [0.0] * 3)
+
+
+def make_server(robot_server, backend):
+    """ a RobotServer answering with backend, without its event loop """
+    server = robot_server.RobotServer.__new__(robot_server.RobotServer)
+    server.backends = [backend]
+    server.backend = backend
+    return server
+
+
+class Backend(object):
+    def __init__(self, initialize):
+        self.initialize = initialize
+
+
+def init(server):
+    payload = pack_fence(KEEP_IN, KEEP_OUT)
+    parts = server.handle_frame(FN_CODES['INIT'], payload, len(payload))
+    return unpack_state(b''.join(parts))
+
+
+def check_request(request):
+    assert [request.fence_min_x, request.fence_max_x, request.fence_min_y,
+            request.fence_max_y, request.fence_min_z, request.fence_max_z] == KEEP_IN[0]
+    assert list(request.keep_in) == KEEP_IN[1]
+    assert list(request.keep_out) == KEEP_OUT[0]
+
+
+def test_init_through_local_service(robot_server):
+    interface = FakeInterface()
+    service = robot_server.LocalService(interface.initialize,
+                                        robot_server.initialize)
+    state = init(make_server(robot_server, Backend(service)))
+    assert state['success']
+    assert state['msg'] == 'successfully initialized'
+    check_request(interface.requests[0])
+
+
+def test_init_through_persistent_service(robot_server, monkeypatch):
+    interface = FakeInterface()
+    proxies = []
+
+    class FakeProxy(object):
+        """ rospy.ServiceProxy: the request is made of arguments or keywords """
+        def __init__(self, name, service_class, persistent=False):
+            assert persistent
+            self.service = robot_server.LocalService(interface.initialize, service_class)
+            self.closed = False
+            proxies.append(self)
+
+        def __call__(self, *args, **kwargs):
+            if args and kwargs:
+                raise TypeError('arguments or keywords, but not both')
+            return self.service(*args, **kwargs)
+
+        def close(self):
+            self.closed = True
+
+    monkeypatch.setattr(robot_server.rospy, 'ServiceProxy', FakeProxy)
+    service = robot_server.PersistentService('/initialize', robot_server.initialize)
+    server = make_server(robot_server, Backend(service))
+    assert init(server)['success']
+    assert init(server)['success']
+    # one connection, kept open across calls
+    assert len(proxies) == 1 and not proxies[0].closed
+    check_request(interface.requests[1])
+
+
+def test_persistent_service_reconnects_after_failure(robot_server, monkeypatch):
+    proxies = []
+
+    class FailingProxy(object):
+        def __init__(self, name, service_class, persistent=False):
+            self.closed = False
+            proxies.append(self)
+
+        def __call__(self, *args, **kwargs):
+            if len(proxies) == 1:
+                raise IOError('connection lost')
+            return kwargs
+
+        def close(self):
+            self.closed = True
+
+    monkeypatch.setattr(robot_server.rospy, 'ServiceProxy', FailingProxy)
+    service = robot_server.PersistentService('/home', robot_server.home)
+    with pytest.raises(IOError):
+        service()
+    assert proxies[0].closed
+    # not retried, the next call connects again
+    assert service(x=1) == {'x': 1}
+    assert len(proxies) == 2
+
+
+def test_init_fence_from_text_fence(robot_server):
+    interface = FakeInterface()
+    service = robot_server.LocalService(interface.initialize, robot_server.initialize)
+    server = make_server(robot_server, Backend(service))
+    server.init_fence(np.ravel(KEEP_IN).tolist(), np.ravel(KEEP_OUT).tolist())
+    check_request(interface.requests[0])
+
+
+class Conn(object):
+    binary = False
+    number = 1
+
+
+def test_error_reply_of_malformed_text_request(robot_server):
+    server = make_server(robot_server, None)
+    server.startseq, server.midseq, server.endseq = '<|', '**', '|>'
+    server.metrics = robot_server.MetricsRegistry()
+    request = b'<|RESET|>'
+    with pytest.raises(ValueError):
+        server.is_inline(Conn(), request)
+    reply = server.handle_error(Conn(), request, ValueError('malformed'))
+    assert reply == [b'<|ACKRESET**ERROR: malformed|>']
+
+
+class BinaryConn(object):
+    binary = True
+    number = 2
+    version = 2
+
+
+def test_unknown_functions_share_one_error_label(robot_server):
+    server = make_server(robot_server, None)
+    server.startseq, server.midseq, server.endseq = '<|', '**', '|>'
+    server.metrics = robot_server.MetricsRegistry()
+    error = ValueError('malformed')
+    server.handle_error(Conn(), b'<|RESET|>', error)
+    for name in ('BOGUS', 'NONSENSE'):
+        server.handle_error(Conn(), '<|{}**|>'.format(name).encode(), error)
+    server.handle_error(BinaryConn(), (200, 0, 1, b'', 0), error)
+    samples = server.metrics.snapshot()['server_request_errors_total']['samples']
+    counts = dict((sample['labels']['fn'], sample['value']) for sample in samples)
+    assert counts == {'RESET': 1, 'unknown': 3}
+
+
+class StepBackend(object):
+    """ records the thread of every step """
+    def __init__(self, robot_server, threads):
+        self.response = robot_server.step._response_class
+        self.threads = threads
+
+    def step(self, ctype, relative, unit, data, trace_decimation, nowait):
+        self.threads.add(threading.current_thread())
+        return self.response(success=True, msg='stepped', n_states=1, time_offset=[0.0],
+                             joint_pos=data)
+
+
+def test_sync_step_reuses_its_threads(robot_server):
+    threads = set()
+    backends = [StepBackend(robot_server, threads) for i in range(3)]
+    server = make_server(robot_server, backends[0])
+    server.backends = backends
+    server.metrics = robot_server.MetricsRegistry()
+    server.sync_executor = robot_server.BoundedExecutor(2, 3)
+    payload = pack_sync([(robot, pack_step('ANGLE', False, 'deg', [robot] * 7))
+                         for robot in range(3)])
+    for i in range(10):
+        reply = server.sync_step(payload, len(payload))
+        states = unpack_sync(reply, len(reply))
+        assert [robot for robot, state in states] == [0, 1, 2]
+        assert unpack_state(states[2][1])['joint_pos'].tolist() == [2.0] * 7
+    # the worker handling the request and the two threads of the pool
+    assert len(threads) <= 3
+
+
+class StateRow(object):
+    """ Float64MultiArray of a state stream row """
+    class Dimension(object):
+        size = 1
+
+    class Layout(object):
+        pass
+
+    def __init__(self, stamp):
+        self.data = [stamp, 1, 0.0, 0.0, 0.0] + [0.0] * 10
+        self.layout = self.Layout()
+        self.layout.dim = [self.Dimension()]
+
+
+class Loop(object):
+    def __init__(self):
+        self.calls = []
+
+    def call_soon(self, fn, *args):
+        self.calls.append(args)
+
+
+def test_state_rows_are_kept_and_only_pushed_to_subscribers(robot_server):
+    server = make_server(robot_server, None)
+    server.state_rings = [robot_server.StampRing(4)]
+    server.shm = [None]
+    server.loop = Loop()
+    server.state_streams = [robot_server.StateStream(server.loop)]
+    server.state_stream_callback(0, StateRow(1.0))
+    assert server.state_rings[0].latest()[0] == 1.0
+    assert server.loop.calls == []
+    server.state_streams[0].subscriptions[(1, 1)] = object()
+    server.state_stream_callback(0, StateRow(2.0))
+    assert server.state_rings[0].latest()[0] == 2.0
+    assert len(server.loop.calls) == 1
+
+
+class FakeJacoInterface(FakeInterface):
+    """ the handlers of JacoInterface an InProcessBackend calls """
+    def __init__(self):
+        FakeInterface.__init__(self)
+        self.state_stream_listeners = []
+
+    def get_stats(self, cmd):
+        return 'stats as ' + cmd.format
+
+    def __getattr__(self, name):
+        if name in ('reset', 'home', 'get_state', 'step', 'step_batch'):
+            return lambda cmd: None
+        raise AttributeError(name)
+
+
+def test_in_process_backend_calls_the_interface(robot_server):
+    interface = FakeJacoInterface()
+    backend = robot_server.InProcessBackend(interface)
+    assert backend.initialize(keep_in=[], keep_out=[]).success
+    assert backend.stats('json').text == 'stats as json'
+    assert backend.stats('prometheus').text == 'stats as prometheus'
+    # the shared event log is not repeated
+    assert backend.stats('events').text == ''
+    callback = object()
+    backend.subscribe_state_stream(callback)
+    assert interface.state_stream_listeners == [callback]
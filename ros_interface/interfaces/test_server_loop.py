@@ -0,0 +1,317 @@
+import socket
+import threading
+import time
+
+import pytest
+
+from ros_interface.interfaces.protocol import FLAG_REPLY, FrameReader, ProtocolError, pack_header
+from ros_interface.interfaces.server_loop import ServerLoop
+
+
+class TextHandler(object):
+    """ answers <|fn**cmd|> with <|ACKfn**cmd|>, like RobotServer does its text requests """
+    def __init__(self):
+        self.errors = []
+
+    def parse(self, request):
+        fn, cmd = request.decode()[2:-2].split('**')
+        return fn, cmd
+
+    def handle_request(self, conn, request):
+        fn, cmd = self.parse(request)
+        return [('<|ACK' + fn + '**' + cmd + '|>').encode()]
+
+    def handle_error(self, conn, request, error):
+        self.errors.append(error)
+        return [b'<|ERROR**' + str(error).encode() + b'|>']
+
+    def is_inline(self, conn, request):
+        return self.parse(request)[0] == 'ECHO'
+
+    def is_ordered(self, conn, request):
+        return True
+
+    def on_connect(self, conn):
+        pass
+
+    def on_disconnect(self, conn, reason):
+        pass
+
+
+@pytest.fixture
+def serving():
+    """ a ServerLoop on a free port running in a thread, with handler """
+    def serve(handler):
+        loop = ServerLoop(handler, 0, host='127.0.0.1', poll_secs=.05)
+        thread = threading.Thread(target=loop.serve_forever)
+        thread.daemon = True
+        thread.start()
+        loops.append((loop, thread))
+        return loop
+    loops = []
+    yield serve
+    for loop, thread in loops:
+        loop.stop()
+        thread.join(2)
+
+
+def connect(loop):
+    sock = socket.create_connection(loop.server_socket.getsockname(), timeout=2)
+    return sock
+
+
+def receive(sock, n_replies):
+    data = b''
+    while data.count(b'|>') < n_replies:
+        chunk = sock.recv(4096)
+        assert chunk, 'connection closed'
+        data += chunk
+    return data
+
+
+def test_malformed_text_request_is_answered_with_an_error(serving):
+    handler = TextHandler()
+    loop = serving(handler)
+    sock = connect(loop)
+    sock.sendall(b'<|RESET|><|ECHO**1|>')
+    replies = receive(sock, 2)
+    assert replies.startswith(b'<|ERROR**')
+    assert replies.endswith(b'<|ACKECHO**1|>')
+    assert len(handler.errors) == 1
+    # the loop keeps serving other clients
+    other = connect(loop)
+    other.sendall(b'<|ECHO**2|>')
+    assert receive(other, 1) == b'<|ACKECHO**2|>'
+
+
+def test_failing_error_reply_drops_only_its_connection(serving):
+    class Handler(TextHandler):
+        def handle_error(self, conn, request, error):
+            raise ValueError('can not report ' + repr(request))
+    loop = serving(Handler())
+    sock = connect(loop)
+    sock.sendall(b'<|RESET|>')
+    assert sock.recv(4096) == b''
+    other = connect(loop)
+    other.sendall(b'<|ECHO**2|>')
+    assert receive(other, 1) == b'<|ACKECHO**2|>'
+
+
+def test_failing_callback_does_not_stop_the_loop(serving):
+    loop = serving(TextHandler())
+    ran = threading.Event()
+
+    def fail():
+        raise ValueError('bad state row')
+    loop.call_soon(fail)
+    loop.call_soon(ran.set)
+    assert ran.wait(2)
+    assert loop.callback_errors == 1
+    sock = connect(loop)
+    sock.sendall(b'<|ECHO**1|>')
+    assert receive(sock, 1) == b'<|ACKECHO**1|>'
+
+
+class BinaryHandler(TextHandler):
+    """
+    replies to binary requests with their payload. Requests with fn 1 are
+    ordered, fn 2 waits for release, fn 3 runs inline
+    """
+    def __init__(self, n_release=0):
+        TextHandler.__init__(self)
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+        self.ordered_running = 0
+        self.max_ordered_running = 0
+        self.started = []
+        self.release = threading.Semaphore(n_release)
+
+    def handle_request(self, conn, request):
+        fn, flags, request_id, payload, robot = request
+        ordered = self.is_ordered(conn, request)
+        with self.lock:
+            self.started.append(request_id)
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+            self.ordered_running += ordered
+            self.max_ordered_running = max(self.max_ordered_running, self.ordered_running)
+        if fn == 2:
+            self.release.acquire()
+        else:
+            time.sleep(0.01)
+        with self.lock:
+            self.running -= 1
+            self.ordered_running -= ordered
+        return [pack_header(fn, len(payload), FLAG_REPLY, request_id), bytes(payload)]
+
+    def is_inline(self, conn, request):
+        return request[0] == 3
+
+    def is_ordered(self, conn, request):
+        return request[0] == 1
+
+
+def send(sock, fn, request_id, payload=b''):
+    sock.sendall(pack_header(fn, len(payload), 0, request_id) + payload)
+
+
+def receive_frames(sock, n_frames):
+    """ (fn, request_id, payload) of the next n_frames replies """
+    reader = FrameReader(sock)
+    frames = []
+    for i in range(n_frames):
+        fn, flags, request_id, length, robot = reader.read_frame()
+        frames.append((fn, request_id, bytes(reader.payload[:length])))
+    return frames
+
+
+def test_ordered_requests_run_one_at_a_time_in_order(serving):
+    handler = BinaryHandler()
+    loop = serving(handler)
+    sock = connect(loop)
+    for request_id in range(1, 9):
+        send(sock, 1, request_id, str(request_id).encode())
+    frames = receive_frames(sock, 8)
+    assert [request_id for fn, request_id, payload in frames] == list(range(1, 9))
+    assert [payload for fn, request_id, payload in frames] == [
+        str(i).encode() for i in range(1, 9)]
+    assert handler.max_ordered_running == 1
+
+
+def test_unordered_requests_overlap_an_ordered_one(serving):
+    handler = BinaryHandler()
+    loop = serving(handler)
+    sock = connect(loop)
+    # the blocked request holds a worker while the others run
+    send(sock, 2, 1)
+    send(sock, 1, 2)
+    send(sock, 0, 3)
+    send(sock, 3, 4)
+    frames = receive_frames(sock, 3)
+    assert sorted(request_id for fn, request_id, payload in frames) == [2, 3, 4]
+    handler.release.release()
+    assert receive_frames(sock, 1)[0][1] == 1
+    assert handler.max_running >= 2
+
+
+def test_in_flight_requests_are_bounded(serving):
+    handler = BinaryHandler()
+    loop = serving(handler)
+    loop.max_in_flight = 2
+    sock = connect(loop)
+    for request_id in range(1, 6):
+        send(sock, 2, request_id)
+    deadline = time.time() + 2
+    while len(handler.started) < 2 and time.time() < deadline:
+        time.sleep(0.01)
+    time.sleep(0.05)
+    # the rest waits in the read buffer of the connection
+    assert handler.started == [1, 2]
+    for i in range(5):
+        handler.release.release()
+    frames = receive_frames(sock, 5)
+    assert sorted(request_id for fn, request_id, payload in frames) == [1, 2, 3, 4, 5]
+    assert handler.max_running == 2
+
+
+def test_full_executor_keeps_requests_pending(serving):
+    handler = BinaryHandler()
+    loop = serving(handler)
+    sock = connect(loop)
+    # more blocked requests than workers and queue slots of the executor
+    n_requests = 4 + 16 + 4
+    loop.max_in_flight = n_requests
+    for request_id in range(1, n_requests + 1):
+        send(sock, 2, request_id)
+    deadline = time.time() + 2
+    while len(handler.started) < 4 and time.time() < deadline:
+        time.sleep(0.01)
+    for i in range(n_requests):
+        handler.release.release()
+    frames = receive_frames(sock, n_requests)
+    assert sorted(request_id for fn, request_id, payload in frames) == list(
+        range(1, n_requests + 1))
+    assert handler.max_running <= 4
+
+
+def test_client_which_does_not_read_is_dropped(serving):
+    class Handler(BinaryHandler):
+        def __init__(self):
+            BinaryHandler.__init__(self)
+            self.disconnected = threading.Event()
+
+        def handle_request(self, conn, request):
+            return [b'x' * (1 << 20)]
+
+        def on_disconnect(self, conn, reason):
+            self.disconnected.set()
+    handler = Handler()
+    loop = serving(handler)
+    loop.max_write_buffer = 1 << 20
+    sock = connect(loop)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    try:
+        for request_id in range(64):
+            send(sock, 3, request_id)
+    except socket.error:
+        # reset by the server, which dropped the connection already
+        pass
+    assert handler.disconnected.wait(5)
+
+
+class DropHandler(BinaryHandler):
+    """ records why its connections were dropped """
+    def __init__(self, n_release=0):
+        BinaryHandler.__init__(self, n_release)
+        self.reasons = []
+        self.disconnected = threading.Event()
+
+    def on_disconnect(self, conn, reason):
+        self.reasons.append(reason)
+        self.disconnected.set()
+
+
+@pytest.mark.parametrize('request_bytes', [
+    # a text request which never ends
+    b'<|STEP**' + b'0' * 8192,
+    # a binary header announcing a payload longer than the limit
+    pack_header(1, 1 << 30, 0, 1),
+], ids=['text', 'binary'])
+def test_client_sending_too_long_a_request_is_dropped(serving, request_bytes):
+    handler = DropHandler()
+    loop = serving(handler)
+    loop.max_request_bytes = 4096
+    sock = connect(loop)
+    sock.sendall(request_bytes)
+    assert handler.disconnected.wait(5)
+    assert isinstance(handler.reasons[0], ProtocolError)
+    assert handler.started == []
+    other = connect(loop)
+    send(other, 3, 7, b'ok')
+    assert receive_frames(other, 1) == [(3, 7, b'ok')]
+
+
+def test_read_buffer_is_bounded_while_requests_wait(serving):
+    handler = DropHandler()
+    loop = serving(handler)
+    loop.max_request_bytes = 4096
+    sock = connect(loop)
+    n_requests = 256
+    payload = b'p' * 1024
+    sender = threading.Thread(target=lambda: [send(sock, 2, request_id, payload)
+                                              for request_id in range(n_requests)])
+    sender.daemon = True
+    sender.start()
+    deadline = time.time() + 2
+    while len(handler.started) < loop.max_in_flight and time.time() < deadline:
+        time.sleep(.01)
+    # the loop stops reading once the buffer holds more than the limit
+    time.sleep(.2)
+    conn, = loop.connections.values()
+    assert len(conn.rbuf) <= loop.max_request_bytes + len(conn.chunk)
+    for i in range(n_requests):
+        handler.release.release()
+    frames = receive_frames(sock, n_requests)
+    assert sorted(request_id for fn, request_id, data in frames) == list(range(n_requests))
+    assert not handler.disconnected.is_set()
@@ -0,0 +1,140 @@
+"""
+Client driving several arms at once.
+
+VectorRobotCommunicator holds one PipelinedRobotCommunicator per arm - arms
+of different robot servers, several arms of one multi-robot server, or both.
+Every call submits its request to all arms before it waits on any reply, so
+a step of N arms takes about as long as the slowest arm rather than the sum
+of all of them:
+
+    vc = VectorRobotCommunicator.from_server('127.0.0.1', 9030)
+    vc.initialize(fence)
+    vc.reset()
+    states = vc.step('VEL', False, 'deg', actions)   # actions[N, action_len]
+    states['joint_pos']                              # (N, n_joint_states)
+
+Replies are stacked into arrays with one row per arm. Arms with fewer joint
+states (a 6 dof arm next to a 7 dof one) or fewer trace samples are padded
+with NaN. Each arm is waited on for at most timeout seconds. An arm which
+failed or timed out has success False, its error as msg and NaN states, and
+its index and error are in the 'errors' dict of the result.
+"""
+import time
+from concurrent.futures import TimeoutError
+
+import numpy as np
+
+from ros_interface.interfaces.protocol import STATE_FIELDS
+from ros_interface.interfaces.robot_client import PipelinedRobotCommunicator
+
+
+def stack_padded(arrays):
+    """ stack arrays of the same number of dimensions, padding each with NaN to the largest """
+    arrays = [np.asarray(a, dtype=np.float64) for a in arrays]
+    ndim = max(a.ndim for a in arrays)
+    arrays = [a.reshape(a.shape + (1,) * (ndim - a.ndim)) if a.size else
+              np.zeros((0,) * ndim) for a in arrays]
+    shape = tuple(max(a.shape[d] for a in arrays) for d in range(ndim))
+    out = np.full((len(arrays),) + shape, np.nan)
+    for i, a in enumerate(arrays):
+        out[(i,) + tuple(slice(0, n) for n in a.shape)] = a
+    return out
+
+
+def stack_states(states, errors):
+    """
+    stack the state dicts of every arm. states[i] is None for the arms in
+    errors
+    """
+    ok = [s for s in states if s is not None]
+    stacked = {
+        'success': np.array([s is not None and bool(s['success']) for s in states]),
+        'msg': [errors[i] if s is None else s['msg'] for i, s in enumerate(states)],
+        'n_states': np.array([0 if s is None else s['n_states'] for s in states]),
+        'errors': errors,
+    }
+    for name in STATE_FIELDS:
+        if not ok:
+            stacked[name] = np.full((len(states), 0), np.nan)
+            continue
+        empty = np.full(np.asarray(ok[0][name]).shape, np.nan)
+        stacked[name] = stack_padded([empty if s is None else s[name] for s in states])
+    return stacked
+
+
+class VectorRobotCommunicator(object):
+    def __init__(self, targets, timeout=10.0):
+        """
+        targets: (host, port, robot) of every arm. robot is the index or
+        name of the arm on a multi-robot server
+        timeout: default seconds to wait for the reply of each arm
+        """
+        self.targets = list(targets)
+        self.timeout = timeout
+        self.clients = [PipelinedRobotCommunicator(robot_ip=host, port=port, robot=robot)
+                        for host, port, robot in self.targets]
+
+    @classmethod
+    def from_server(cls, host='127.0.0.1', port=9030, timeout=10.0):
+        """ every arm of one robot server, each over its own connection """
+        probe = PipelinedRobotCommunicator(robot_ip=host, port=port)
+        robots = probe.robots()
+        probe.disconnect()
+        return cls([(host, port, robot) for robot in range(len(robots))], timeout=timeout)
+
+    def __len__(self):
+        return len(self.clients)
+
+    def gather(self, futures, timeout=None):
+        """
+        wait for the future of every arm, at most timeout seconds from now.
+        Returns the results, None for arms which failed, and {arm: error}
+        """
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.time() + timeout
+        results = []
+        errors = {}
+        for i, future in enumerate(futures):
+            try:
+                results.append(future.result(max(0.0, deadline - time.time())))
+            except TimeoutError:
+                results.append(None)
+                errors[i] = 'no reply within {}s'.format(timeout)
+            except Exception as e:
+                results.append(None)
+                errors[i] = str(e)
+        return results, errors
+
+    def map_states(self, submit, timeout=None):
+        """ submit(client, i) on every arm and stack the states of the replies """
+        futures = [submit(client, i) for i, client in enumerate(self.clients)]
+        return stack_states(*self.gather(futures, timeout))
+
+    def initialize(self, fence, keep_out=None, timeout=None):
+        return self.map_states(lambda c, i: c.submit_initialize(fence, keep_out), timeout)
+
+    def reset(self, timeout=None):
+        return self.map_states(lambda c, i: c.submit_reset(), timeout)
+
+    def step(self, ctype, relative, unit, actions, trace_decimation=0, nowait=False,
+             timeout=None):
+        """
+        actions: one row of step data per arm, an (N, action_len) array or a
+        list of arrays when the arms have different numbers of joints
+        """
+        if len(actions) != len(self.clients):
+            raise ValueError('{} actions for {} arms'.format(len(actions), len(self.clients)))
+        return self.map_states(lambda c, i: c.submit_step(
+            ctype, relative, unit, actions[i], trace_decimation, nowait), timeout)
+
+    def get_state(self, trace_decimation=0, timeout=None):
+        return self.map_states(lambda c, i: c.submit_get_state(trace_decimation), timeout)
+
+    def home(self, timeout=None):
+        """ success of homing every arm, False for arms which failed """
+        results, errors = self.gather([c.submit_home() for c in self.clients], timeout)
+        return np.array([bool(r) for r in results])
+
+    def disconnect(self):
+        for client in self.clients:
+            client.disconnect()
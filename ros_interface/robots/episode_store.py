@@ -0,0 +1,390 @@
+#! /usr/bin/env python
+"""
+Append-only, memory mapped, column per field store of recorded episodes.
+
+    <root>/episode_000001/episode.json     start/end time, robot info and
+                                           n_joint_states of the states
+                         /states/          one row per joint state sample
+                         /commands/        one row per command and its result
+                         /command_data/    float64 data of the commands
+                         /messages/        utf-8 bytes of the result msgs
+
+Every table directory holds schema.json, a `rows` file with the number of
+committed rows, and for each field one file per chunk of chunk_rows rows
+(<field>.<chunk>). Chunk files are allocated at their full size and filled in
+place, and `rows` is only advanced once a row is completely written, so
+EpisodeReader can read an episode while it is still being recorded.
+
+Rows of the commands table are the step index of an episode: each has the
+state sample counts received while it ran, count_start < count <= count_end,
+and offsets of its data and msg.
+
+EpisodeRecorder does all file work on its own thread. Its record_* methods
+only put a tuple on a queue and never block - when the writer falls behind
+the queue is full and records are dropped and counted instead.
+"""
+import glob
+import json
+import os
+import threading
+import time
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import numpy as np
+
+from ros_interface.interfaces.protocol import STEP_TYPES, STEP_UNITS
+
+COMMANDS = ('STEP', 'STEP_BATCH', 'RESET', 'HOME', 'INIT')
+COMMAND_FIELDS = [('time', '<f8', ()), ('command', 'u1', ()), ('type', 'i1', ()),
+                  ('unit', 'i1', ()), ('relative', '?', ()), ('nowait', '?', ()),
+                  ('success', '?', ()), ('seconds', '<f8', ()),
+                  ('count_start', '<i8', ()), ('count_end', '<i8', ()),
+                  ('data_start', '<i8', ()), ('data_len', '<i8', ()),
+                  ('msg_start', '<i8', ()), ('msg_len', '<i8', ())]
+
+
+def state_fields(n_joint_states):
+    return [('count', '<i8', ()), ('stamp', '<f8', ()), ('received', '<f8', ()),
+            ('joint_pos', '<f8', (n_joint_states,)),
+            ('joint_vel', '<f8', (n_joint_states,)),
+            ('joint_effort', '<f8', (n_joint_states,)),
+            ('tool_pose', '<f8', (7,)), ('finger_pose', '<f8', (3,))]
+
+
+class ColumnTable(object):
+    def __init__(self, path, fields=None, chunk_rows=4096):
+        """
+        open the table at path, or create it when fields is given.
+        fields: list of (name, dtype, shape) of a row
+        """
+        self.path = path
+        schema_path = os.path.join(path, 'schema.json')
+        if fields is not None:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            with open(schema_path, 'w') as f:
+                json.dump({'chunk_rows': chunk_rows,
+                           'fields': [[n, d, list(s)] for n, d, s in fields]}, f)
+            with open(os.path.join(path, 'rows'), 'wb') as f:
+                f.write(np.zeros(1, dtype='<i8').tobytes())
+            mode = 'r+'
+        else:
+            with open(schema_path) as f:
+                schema = json.load(f)
+            chunk_rows = schema['chunk_rows']
+            fields = [(n, d, tuple(s)) for n, d, s in schema['fields']]
+            mode = 'r'
+        self.writable = mode == 'r+'
+        self.chunk_rows = chunk_rows
+        self.fields = [(str(n), np.dtype(d), tuple(s)) for n, d, s in fields]
+        self.rows_map = np.memmap(os.path.join(path, 'rows'), dtype='<i8',
+                                  mode=mode, shape=(1,))
+        # name -> list of chunk memmaps
+        self.chunks = dict((name, []) for name, dtype, shape in self.fields)
+
+    def rows(self):
+        return int(self.rows_map[0])
+
+    def chunk(self, name, dtype, shape, index):
+        chunks = self.chunks[name]
+        while len(chunks) <= index:
+            path = os.path.join(self.path, '{}.{:05d}'.format(name, len(chunks)))
+            chunk_shape = (self.chunk_rows,) + shape
+            if self.writable:
+                chunks.append(np.memmap(path, dtype=dtype, mode='w+', shape=chunk_shape))
+            else:
+                chunks.append(np.memmap(path, dtype=dtype, mode='r', shape=chunk_shape))
+        return chunks[index]
+
+    def append(self, values):
+        """ write one row, values maps field names to values """
+        n = self.rows()
+        index, row = divmod(n, self.chunk_rows)
+        for name, dtype, shape in self.fields:
+            self.chunk(name, dtype, shape, index)[row] = values[name]
+        self.rows_map[0] = n + 1
+        return n
+
+    def extend(self, name, values):
+        """
+        append the rows of values to the single field table name. Returns the
+        row of the first one
+        """
+        start = self.rows()
+        values = np.asarray(values)
+        dtype, shape = [(d, s) for n, d, s in self.fields if n == name][0]
+        done = 0
+        while done < len(values):
+            index, row = divmod(start + done, self.chunk_rows)
+            take = min(len(values) - done, self.chunk_rows - row)
+            self.chunk(name, dtype, shape, index)[row:row + take] = values[done:done + take]
+            done += take
+        self.rows_map[0] = start + len(values)
+        return start
+
+    def column(self, name, start=0, stop=None):
+        """ copy of rows [start, stop) of a field, stop defaults to the committed rows """
+        rows = self.rows()
+        stop = rows if stop is None else min(stop, rows)
+        dtype, shape = [(d, s) for n, d, s in self.fields if n == name][0]
+        parts = []
+        i = start
+        while i < stop:
+            index, row = divmod(i, self.chunk_rows)
+            take = min(stop - i, self.chunk_rows - row)
+            parts.append(np.array(self.chunk(name, dtype, shape, index)[row:row + take]))
+            i += take
+        if not parts:
+            return np.zeros((0,) + shape, dtype=dtype)
+        return np.concatenate(parts)
+
+    def searchsorted(self, name, values, side='left'):
+        """
+        np.searchsorted of values in the committed rows of the sorted scalar
+        field name. Searches the chunk memmaps in place - only the first
+        row of every chunk and the pages the bisection touches are read
+        """
+        values = np.atleast_1d(values)
+        rows = self.rows()
+        if not rows:
+            return np.zeros(len(values), dtype=np.int64)
+        dtype, shape = [(d, s) for n, d, s in self.fields if n == name][0]
+        chunks = [self.chunk(name, dtype, shape, index)
+                  for index in range((rows - 1) // self.chunk_rows + 1)]
+        firsts = np.array([chunk[0] for chunk in chunks])
+        found = np.empty(len(values), dtype=np.int64)
+        for i, value in enumerate(values):
+            # the last chunk which starts before value holds its row, or
+            # ends right before it
+            index = max(0, int(np.searchsorted(firsts, value, side=side)) - 1)
+            stop = min(self.chunk_rows, rows - index * self.chunk_rows)
+            found[i] = index * self.chunk_rows + np.searchsorted(chunks[index][:stop], value,
+                                                                 side=side)
+        return found
+
+    def read(self, start=0, stop=None):
+        """ dict of every field over rows [start, stop) """
+        stop = self.rows() if stop is None else stop
+        return dict((name, self.column(name, start, stop))
+                    for name, dtype, shape in self.fields)
+
+    def flush(self):
+        for chunks in self.chunks.values():
+            for chunk in chunks:
+                chunk.flush()
+        self.rows_map.flush()
+
+
+class EpisodeWriter(object):
+    """ tables of one episode, only used by the recorder thread """
+    def __init__(self, path, info, chunk_rows):
+        self.path = path
+        self.chunk_rows = chunk_rows
+        self.info = dict(info)
+        os.makedirs(path)
+        self.write_info()
+        self.commands = ColumnTable(os.path.join(path, 'commands'), COMMAND_FIELDS,
+                                    chunk_rows=1024)
+        self.command_data = ColumnTable(os.path.join(path, 'command_data'),
+                                        [('value', '<f8', ())], chunk_rows=chunk_rows)
+        self.messages = ColumnTable(os.path.join(path, 'messages'),
+                                    [('byte', 'u1', ())], chunk_rows=chunk_rows)
+        # created by the first state sample, which tells the number of joints
+        self.states = None
+
+    def write_info(self):
+        with open(os.path.join(self.path, 'episode.json'), 'w') as f:
+            json.dump(self.info, f)
+
+    def write_state(self, values):
+        if self.states is None:
+            n_joint_states = len(values['joint_pos'])
+            self.states = ColumnTable(os.path.join(self.path, 'states'),
+                                      state_fields(n_joint_states),
+                                      chunk_rows=self.chunk_rows)
+            self.info['n_joint_states'] = n_joint_states
+            self.write_info()
+        self.states.append(values)
+
+    def write_command(self, values, data, msg):
+        values['data_start'] = self.command_data.extend('value', np.asarray(data, dtype='<f8'))
+        values['data_len'] = len(data)
+        msg = np.frombuffer(msg.encode('utf-8'), dtype='u1')
+        values['msg_start'] = self.messages.extend('byte', msg)
+        values['msg_len'] = len(msg)
+        self.commands.append(values)
+
+    def close(self, end_time):
+        self.info['end'] = end_time
+        self.info['n_commands'] = self.commands.rows()
+        self.info['n_states'] = self.states.rows() if self.states is not None else 0
+        for table in (self.commands, self.command_data, self.messages, self.states):
+            if table is not None:
+                table.flush()
+        self.write_info()
+
+
+class EpisodeRecorder(object):
+    def __init__(self, root, info=None, max_queue=20000, chunk_rows=4096):
+        """
+        root: directory the episode directories are created in
+        info: dict stored in the episode.json of every episode
+        max_queue: records waiting for the writer before new ones are dropped
+        """
+        self.root = root
+        if not os.path.isdir(root):
+            os.makedirs(root)
+        self.info = dict(info or {})
+        self.chunk_rows = chunk_rows
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.dropped = 0
+        self.episode = None
+        existing = [int(os.path.basename(p).split('_')[1])
+                    for p in glob.glob(os.path.join(root, 'episode_*'))]
+        self.next_episode = max(existing) + 1 if existing else 1
+        self.thread = threading.Thread(target=self.run, name='episode_recorder')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+
+    def start_episode(self, info=None):
+        """ end the current episode and record into a new one from now on """
+        self.put(('episode', time.time(), info or {}))
+
+    def record_state(self, count, stamp, received, joint_pos, joint_vel, joint_effort,
+                     tool_pose, finger_pose):
+        """ arguments must not be changed after the call - pass copies """
+        self.put(('state', count, stamp, received, joint_pos, joint_vel,
+                  joint_effort, tool_pose, finger_pose))
+
+    def record_command(self, command, cmd_type=None, unit=None, relative=False,
+                       nowait=False, data=(), success=True, msg='', seconds=0.0,
+                       count_start=0, count_end=0):
+        """
+        command: one of COMMANDS
+        count_start, count_end: state sample counts received while it ran
+        """
+        self.put(('command', time.time(), command, cmd_type, unit, relative, nowait,
+                  list(data), success, msg, seconds, count_start, count_end))
+
+    def close(self, timeout=None):
+        """ write what is queued, end the episode and stop the writer """
+        self.put(('close',))
+        self.thread.join(timeout)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            kind = item[0]
+            if kind == 'state':
+                if self.episode is not None:
+                    self.write_state(item)
+            elif kind == 'command':
+                if self.episode is None:
+                    self.open_episode(item[1], {})
+                self.write_command(item)
+            elif kind == 'episode':
+                self.open_episode(item[1], item[2])
+            elif kind == 'close':
+                self.close_episode(time.time())
+                return
+
+    def open_episode(self, start, info):
+        self.close_episode(start)
+        path = os.path.join(self.root, 'episode_{:06d}'.format(self.next_episode))
+        self.next_episode += 1
+        episode_info = dict(self.info)
+        episode_info.update(info)
+        episode_info['start'] = start
+        self.episode = EpisodeWriter(path, episode_info, self.chunk_rows)
+
+    def close_episode(self, end):
+        if self.episode is not None:
+            self.episode.close(end)
+            self.episode = None
+
+    def write_state(self, item):
+        (kind, count, stamp, received, joint_pos, joint_vel, joint_effort,
+         tool_pose, finger_pose) = item
+        self.episode.write_state({
+            'count': count, 'stamp': stamp, 'received': received,
+            'joint_pos': joint_pos, 'joint_vel': joint_vel,
+            'joint_effort': joint_effort, 'tool_pose': tool_pose,
+            'finger_pose': finger_pose})
+
+    def write_command(self, item):
+        (kind, stamp, command, cmd_type, unit, relative, nowait, data, success, msg,
+         seconds, count_start, count_end) = item
+        self.episode.write_command({
+            'time': stamp, 'command': COMMANDS.index(command),
+            'type': STEP_TYPES.index(cmd_type) if cmd_type in STEP_TYPES else -1,
+            'unit': STEP_UNITS.index(unit) if unit in STEP_UNITS else -1,
+            'relative': relative, 'nowait': nowait, 'success': success,
+            'seconds': seconds, 'count_start': count_start,
+            'count_end': count_end}, data, msg)
+
+
+class EpisodeReader(object):
+    """ read only view of one episode, which may still be being recorded """
+    def __init__(self, path):
+        self.path = path
+        self.commands = ColumnTable(os.path.join(path, 'commands'))
+        self.command_data = ColumnTable(os.path.join(path, 'command_data'))
+        self.messages = ColumnTable(os.path.join(path, 'messages'))
+        self.states = None
+
+    @property
+    def info(self):
+        with open(os.path.join(self.path, 'episode.json')) as f:
+            return json.load(f)
+
+    def state_table(self):
+        if self.states is None and os.path.exists(os.path.join(self.path, 'states', 'rows')):
+            self.states = ColumnTable(os.path.join(self.path, 'states'))
+        return self.states
+
+    def n_steps(self):
+        return self.commands.rows()
+
+    def step(self, i):
+        """
+        command row i as a dict with its name, type, unit, data and msg
+        decoded, and the state samples recorded while it ran
+        """
+        row = dict((k, v[0].item()) for k, v in self.commands.read(i, i + 1).items())
+        row['command'] = COMMANDS[row['command']]
+        row['type'] = STEP_TYPES[row['type']] if row['type'] >= 0 else None
+        row['unit'] = STEP_UNITS[row['unit']] if row['unit'] >= 0 else None
+        start = row.pop('data_start')
+        row['data'] = self.command_data.column('value', start, start + row.pop('data_len'))
+        start = row.pop('msg_start')
+        row['msg'] = self.messages.column('byte', start, start + row.pop('msg_len')
+                                          ).tobytes().decode('utf-8')
+        row['states'] = self.states_between(row['count_start'], row['count_end'])
+        return row
+
+    def states_between(self, count_start, count_end):
+        """ state samples with count_start < count <= count_end """
+        table = self.state_table()
+        if table is None:
+            return {}
+        # counts only grow, so the rows are found without reading the column
+        start, stop = table.searchsorted('count', [count_start, count_end], side='right')
+        return table.read(int(start), int(stop))
+
+    def read_states(self):
+        table = self.state_table()
+        return table.read() if table is not None else {}
+
+
+def list_episodes(root):
+    """ paths of the episodes under root, oldest first """
+    return sorted(glob.glob(os.path.join(root, 'episode_*')))
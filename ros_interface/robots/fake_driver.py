@@ -0,0 +1,281 @@
+#! /usr/bin/env python
+"""
+Stand-in for the kinova driver, so JacoInterface and the robot server can be
+run and benchmarked without the arm.
+
+Publishes /<robot_type>_driver/out/joint_state, out/tool_pose and
+out/finger_position, follows in/joint_velocity commands, and serves the
+joint angle, tool pose and finger position action servers and the home_arm
+service. Joints, tool pose and fingers each follow their target with a first
+order lag. There is no kinematics, so the tool pose only moves on tool pose
+goals.
+
+Private parameters:
+    ~robot_type: default j2s7s300
+    ~rate: feedback publish rate in Hz, default 100
+    ~time_constant: seconds of the first order lag, default 0.1
+    ~latency: seconds before a command or goal takes effect, default 0
+    ~jitter: up to this many seconds of uniformly random delay are added to
+        every feedback publish and to the latency, default 0
+
+    rosrun ros_interface fake_driver.py _rate:=200 _latency:=0.002 _jitter:=0.001
+"""
+import math
+import random
+import threading
+import time
+from collections import deque
+
+import numpy as np
+import rospy
+import actionlib
+from geometry_msgs.msg import PoseStamped
+from sensor_msgs.msg import JointState
+from kinova_msgs.msg import JointVelocity, FingerPosition
+from kinova_msgs.msg import ArmJointAnglesAction, ArmJointAnglesFeedback, ArmJointAnglesResult
+from kinova_msgs.msg import ArmPoseAction, ArmPoseFeedback, ArmPoseResult
+from kinova_msgs.msg import SetFingersPositionAction, SetFingersPositionFeedback
+from kinova_msgs.msg import SetFingersPositionResult
+from kinova_msgs.srv import HomeArm, HomeArmResponse
+
+# home joint angles in degrees and tool pose of the j2s7s300
+HOME_JOINTS = [275.0, 175.0, 0.0, 45.0, 0.0, 260.0, 0.0]
+HOME_TOOL_POSE = [0.2123, -0.2572, 0.5096, 0.6325, 0.3204, 0.3180, 0.6299]
+# the driver stops a joint velocity command which is not repeated within this
+VELOCITY_TIMEOUT = 0.05
+# a goal has been reached once every value is within these of the target
+JOINT_TOLERANCE = 0.5
+TOOL_TOLERANCE = 0.001
+FINGER_TOLERANCE = 10.0
+
+
+class FakeArm(object):
+    """ first order model of the joints, tool pose and fingers """
+    def __init__(self, n_joints, time_constant):
+        self.n_joints = n_joints
+        self.time_constant = time_constant
+        self.lock = threading.Lock()
+        self.joints = np.array(HOME_JOINTS[:n_joints])
+        self.joint_vel = np.zeros(n_joints)
+        self.joint_target = self.joints.copy()
+        self.command_vel = np.zeros(n_joints)
+        self.command_until = 0.0
+        self.tool_pose = np.array(HOME_TOOL_POSE)
+        self.tool_target = self.tool_pose.copy()
+        self.fingers = np.zeros(3)
+        self.finger_target = np.zeros(3)
+
+    def update(self, now, dt):
+        alpha = min(1.0, dt / self.time_constant)
+        with self.lock:
+            previous = self.joints
+            if now < self.command_until:
+                # velocity mode - the joint velocity lags the command
+                velocity = self.joint_vel + alpha * (self.command_vel - self.joint_vel)
+                self.joints = self.joints + velocity * dt
+                # and holds its position once the commands stop
+                self.joint_target = self.joints
+            else:
+                self.joints = self.joints + alpha * (self.joint_target - self.joints)
+            if dt > 0:
+                self.joint_vel = (self.joints - previous) / dt
+            self.tool_pose += alpha * (self.tool_target - self.tool_pose)
+            self.tool_pose[3:] /= np.linalg.norm(self.tool_pose[3:])
+            self.fingers += alpha * (self.finger_target - self.fingers)
+
+    def command_velocity(self, velocity, now):
+        with self.lock:
+            self.command_vel = np.asarray(velocity[:self.n_joints])
+            self.command_until = now + VELOCITY_TIMEOUT
+
+    def set_joint_target(self, degrees):
+        with self.lock:
+            self.command_until = 0.0
+            self.joint_target = np.asarray(degrees[:self.n_joints], dtype=np.float64)
+
+    def joint_error(self):
+        return np.abs(self.joint_target - self.joints).max()
+
+
+class FakeDriver(object):
+    def __init__(self):
+        rospy.init_node('fake_kinova_driver')
+        self.robot_type = rospy.get_param('~robot_type', 'j2s7s300')
+        self.rate = rospy.get_param('~rate', 100.0)
+        self.latency = rospy.get_param('~latency', 0.0)
+        self.jitter = rospy.get_param('~jitter', 0.0)
+        self.n_joints = int(self.robot_type[3])
+        self.arm = FakeArm(self.n_joints, rospy.get_param('~time_constant', 0.1))
+        # velocity commands waiting for their latency to pass
+        self.pending_velocities = deque()
+        prefix = '/{}_driver'.format(self.robot_type)
+        self.joint_names = ['{}_joint_{}'.format(self.robot_type, i + 1)
+                            for i in range(self.n_joints)]
+        self.joint_names += ['{}_joint_finger_{}'.format(self.robot_type, i + 1)
+                             for i in range(3)]
+
+        self.joint_state_publisher = rospy.Publisher(prefix + '/out/joint_state',
+                                                     JointState, queue_size=10)
+        self.tool_pose_publisher = rospy.Publisher(prefix + '/out/tool_pose',
+                                                   PoseStamped, queue_size=10)
+        self.finger_publisher = rospy.Publisher(prefix + '/out/finger_position',
+                                                FingerPosition, queue_size=10)
+        self.velocity_subscriber = rospy.Subscriber(prefix + '/in/joint_velocity',
+                                                    JointVelocity,
+                                                    self.receive_joint_velocity,
+                                                    queue_size=50)
+        self.home_service = rospy.Service(prefix + '/in/home_arm', HomeArm, self.home_arm)
+        self.joint_server = actionlib.SimpleActionServer(
+            prefix + '/joints_action/joint_angles', ArmJointAnglesAction,
+            execute_cb=self.execute_joint_angles, auto_start=False)
+        self.tool_server = actionlib.SimpleActionServer(
+            prefix + '/pose_action/tool_pose', ArmPoseAction,
+            execute_cb=self.execute_tool_pose, auto_start=False)
+        self.finger_server = actionlib.SimpleActionServer(
+            prefix + '/fingers_action/finger_positions', SetFingersPositionAction,
+            execute_cb=self.execute_finger_positions, auto_start=False)
+        self.joint_server.start()
+        self.tool_server.start()
+        self.finger_server.start()
+
+    def delay(self):
+        """ latency plus jitter of one command """
+        return self.latency + random.uniform(0, self.jitter)
+
+    def receive_joint_velocity(self, msg):
+        velocity = [msg.joint1, msg.joint2, msg.joint3, msg.joint4, msg.joint5,
+                    msg.joint6, msg.joint7]
+        self.pending_velocities.append((time.time() + self.delay(), velocity))
+
+    def apply_pending_velocities(self, now):
+        while self.pending_velocities and self.pending_velocities[0][0] <= now:
+            due, velocity = self.pending_velocities.popleft()
+            self.arm.command_velocity(velocity, now)
+
+    def wait_until(self, server, reached, publish_feedback):
+        """ run until reached() or the goal is preempted. returns False if preempted """
+        period = 1.0 / self.rate
+        while not rospy.is_shutdown():
+            if server.is_preempt_requested():
+                server.set_preempted()
+                return False
+            if reached():
+                return True
+            publish_feedback()
+            time.sleep(period)
+        return False
+
+    def execute_joint_angles(self, goal):
+        time.sleep(self.delay())
+        a = goal.angles
+        self.arm.set_joint_target([a.joint1, a.joint2, a.joint3, a.joint4,
+                                   a.joint5, a.joint6, a.joint7])
+        feedback = ArmJointAnglesFeedback()
+
+        def publish_feedback():
+            self.fill_angles(feedback.angles)
+            self.joint_server.publish_feedback(feedback)
+        if self.wait_until(self.joint_server,
+                           lambda: self.arm.joint_error() < JOINT_TOLERANCE,
+                           publish_feedback):
+            result = ArmJointAnglesResult()
+            self.fill_angles(result.angles)
+            self.joint_server.set_succeeded(result)
+
+    def execute_tool_pose(self, goal):
+        time.sleep(self.delay())
+        p = goal.pose.pose
+        target = [p.position.x, p.position.y, p.position.z, p.orientation.x,
+                  p.orientation.y, p.orientation.z, p.orientation.w]
+        with self.arm.lock:
+            self.arm.tool_target = np.array(target)
+        feedback = ArmPoseFeedback()
+
+        def publish_feedback():
+            feedback.pose = self.tool_pose_msg()
+            self.tool_server.publish_feedback(feedback)
+        if self.wait_until(self.tool_server,
+                           lambda: np.abs(self.arm.tool_target - self.arm.tool_pose).max() < TOOL_TOLERANCE,
+                           publish_feedback):
+            self.tool_server.set_succeeded(ArmPoseResult(pose=self.tool_pose_msg()))
+
+    def execute_finger_positions(self, goal):
+        time.sleep(self.delay())
+        f = goal.fingers
+        with self.arm.lock:
+            self.arm.finger_target = np.array([f.finger1, f.finger2, f.finger3])
+        feedback = SetFingersPositionFeedback()
+
+        def publish_feedback():
+            feedback.fingers = self.finger_msg()
+            self.finger_server.publish_feedback(feedback)
+        if self.wait_until(self.finger_server,
+                           lambda: np.abs(self.arm.finger_target - self.arm.fingers).max() < FINGER_TOLERANCE,
+                           publish_feedback):
+            self.finger_server.set_succeeded(SetFingersPositionResult(fingers=self.finger_msg()))
+
+    def home_arm(self, req):
+        time.sleep(self.delay())
+        self.arm.set_joint_target(HOME_JOINTS)
+        with self.arm.lock:
+            self.arm.tool_target = np.array(HOME_TOOL_POSE)
+        period = 1.0 / self.rate
+        while self.arm.joint_error() > JOINT_TOLERANCE and not rospy.is_shutdown():
+            time.sleep(period)
+        return HomeArmResponse('done')
+
+    def fill_angles(self, angles):
+        joints = self.arm.joints.tolist() + [0.0] * (7 - self.n_joints)
+        (angles.joint1, angles.joint2, angles.joint3, angles.joint4,
+         angles.joint5, angles.joint6, angles.joint7) = joints[:7]
+
+    def tool_pose_msg(self):
+        msg = PoseStamped()
+        msg.header.stamp = rospy.Time.now()
+        msg.header.frame_id = self.robot_type + '_link_base'
+        pose = self.arm.tool_pose
+        msg.pose.position.x, msg.pose.position.y, msg.pose.position.z = pose[:3]
+        (msg.pose.orientation.x, msg.pose.orientation.y,
+         msg.pose.orientation.z, msg.pose.orientation.w) = pose[3:]
+        return msg
+
+    def finger_msg(self):
+        return FingerPosition(*self.arm.fingers.tolist())
+
+    def publish(self):
+        stamp = rospy.Time.now()
+        joint_state = JointState()
+        joint_state.header.stamp = stamp
+        joint_state.name = self.joint_names
+        # the real driver reports joint and finger angles in radians
+        finger_radians = (self.arm.fingers / 6800.0 * math.pi / 2).tolist()
+        joint_state.position = np.radians(self.arm.joints).tolist() + finger_radians
+        joint_state.velocity = np.radians(self.arm.joint_vel).tolist() + [0.0] * 3
+        joint_state.effort = [0.0] * (self.n_joints + 3)
+        self.tool_pose_publisher.publish(self.tool_pose_msg())
+        self.finger_publisher.publish(self.finger_msg())
+        self.joint_state_publisher.publish(joint_state)
+
+    def spin(self):
+        """ publish feedback at rate against absolute deadlines """
+        period = 1.0 / self.rate
+        deadline = time.time()
+        last = deadline
+        while not rospy.is_shutdown():
+            deadline += period
+            now = time.time()
+            if deadline > now:
+                time.sleep(deadline - now)
+            elif now - deadline > period:
+                deadline = now
+            if self.jitter:
+                time.sleep(random.uniform(0, self.jitter))
+            now = time.time()
+            self.apply_pending_velocities(now)
+            self.arm.update(now, now - last)
+            last = now
+            self.publish()
+
+
+if __name__ == '__main__':
+    FakeDriver().spin()
@@ -0,0 +1,111 @@
+#! /usr/bin/env python
+"""
+Handles of goals sent to the kinova action servers.
+
+actionlib's SimpleActionClient only tracks its latest goal, so sending a new
+goal on the same client preempts the running one on the action server and
+silently drops the callbacks of the old one. GoalHandle keeps the state of
+each goal itself, so a handle always finishes - with the action server's
+result, or as superseded when a newer goal took over.
+"""
+import threading
+import time
+
+from actionlib_msgs.msg import GoalStatus
+
+# outcome names of the terminal GoalStatus states
+OUTCOMES = {GoalStatus.SUCCEEDED: 'succeeded', GoalStatus.PREEMPTED: 'preempted',
+            GoalStatus.ABORTED: 'aborted', GoalStatus.REJECTED: 'rejected',
+            GoalStatus.RECALLED: 'recalled', GoalStatus.LOST: 'lost'}
+
+
+class GoalHandle(object):
+    def __init__(self, requester, kind):
+        """
+        requester: the SimpleActionClient the goal is sent with
+        kind: 'joint', 'tool' or 'finger'
+        """
+        self.requester = requester
+        self.kind = kind
+        self.finished = threading.Event()
+        self.lock = threading.Lock()
+        # actionlib GoalStatus once finished, None while running or when superseded
+        self.state = None
+        self.result = None
+        self.feedback = None
+        self.superseded = False
+        # time.time() of send and finish
+        self.sent = None
+        self.finished_at = None
+        self.feedback_callbacks = []
+        self.done_callbacks = []
+
+    def send(self, goal):
+        self.sent = time.time()
+        self.requester.send_goal(goal, done_cb=self.on_done,
+                                 feedback_cb=self.on_feedback)
+        return self
+
+    def done(self):
+        return self.finished.is_set()
+
+    def wait(self, timeout=None):
+        """ True once the goal finished, False if timeout ran out first """
+        return self.finished.wait(timeout)
+
+    def succeeded(self):
+        return self.state == GoalStatus.SUCCEEDED
+
+    def outcome(self):
+        """ 'superseded', the name of the final GoalStatus, or 'running' """
+        if self.superseded:
+            return 'superseded'
+        if not self.done():
+            return 'running'
+        return OUTCOMES.get(self.state, 'other')
+
+    def duration(self):
+        """ seconds from send until finished, or until now while running """
+        return (self.finished_at or time.time()) - (self.sent or time.time())
+
+    def cancel(self):
+        """ ask the action server to stop the goal. wait for it to finish """
+        if not self.done():
+            self.requester.cancel_goal()
+
+    def add_feedback_callback(self, fn):
+        """ fn(handle, feedback) is called on every feedback message """
+        self.feedback_callbacks.append(fn)
+
+    def add_done_callback(self, fn):
+        """ fn(handle) is called once the goal finished, right away if it has """
+        with self.lock:
+            if not self.done():
+                self.done_callbacks.append(fn)
+                return
+        fn(self)
+
+    def on_feedback(self, feedback):
+        self.feedback = feedback
+        for fn in self.feedback_callbacks:
+            fn(self, feedback)
+
+    def on_done(self, state, result):
+        self.state = state
+        self.result = result
+        self.finish()
+
+    def supersede(self):
+        """ a newer goal took over the action client of this one """
+        self.superseded = True
+        self.finish()
+
+    def finish(self):
+        with self.lock:
+            if self.done():
+                return
+            self.finished_at = time.time()
+            self.finished.set()
+            callbacks, self.done_callbacks = self.done_callbacks, []
+        for fn in callbacks:
+            fn(self)
@@ -19,7 +19,7 @@ This is the current joint angle in degrees
 """
 
 import os
-from copy import copy
+import json
 import numpy as np
 import pid
 import time
@@ -39,6 +39,7 @@ from base import BaseConfig
 
 # ROS messages and services
 from std_msgs.msg import Float64, Header
+from std_msgs.msg import Float64MultiArray, MultiArrayLayout, MultiArrayDimension
 from geometry_msgs.msg import Pose, PoseStamped, Twist, TwistStamped
 from geometry_msgs.msg import Vector3, Point, Quaternion, Wrench, WrenchStamped
 from sensor_msgs.msg import JointState
@@ -49,11 +50,23 @@ from kinova_msgs.msg import FingerPosition, SetFingersPositionAction, SetFingers
 from kinova_msgs.msg import ArmPoseAction, ArmPoseGoal
 from kinova_msgs.srv import HomeArm, SetTorqueControlMode, SetTorqueControlParameters
 
-from utils import Quaternion2EulerXYZ, EulerXYZ2Quaternion, trim_target_pose_safety
+from utils import Quaternion2EulerXYZ, EulerXYZ2Quaternion
 from utils import convert_tool_pose, convert_joint_angles, convert_to_degrees
 from utils import convert_finger_pose
+from state_buffer import StateRingBuffer
+from state_snapshot import LatestState
+from safety import SafetyFence, FENCE_KEEP_OUT, FENCE_NAMES, describe_fence_hits
+from velocity_streamer import VelocityStreamer
+from goals import GoalHandle
+from trajectory import JointTrajectory, TrajectoryTracker
+from episode_store import EpisodeRecorder
 #from jaco_control.msg import InteractionParams
-from ros_interface.srv import initialize, reset, step, home, get_state
+from ros_interface.srv import initialize, reset, step, home, get_state, step_batch, stats
+from ros_interface.interfaces.state_stream import STATE_STREAM_TOPIC
+from ros_interface.interfaces.metrics import MetricsRegistry, RateMeter
+from ros_interface.interfaces.event_log import EVENT_LOG
+from ros_interface.interfaces.protocol import STEP_TYPES
+from ros_interface.interfaces.robot_server import RobotServer, InProcessBackend
 
 # todo - force this to load configuration from file should have safety params
 # torque, velocity limits in it
@@ -76,20 +89,48 @@ class JacoConfig(BaseConfig):
         pass
 
 
+# goal kinds which move the arm and so preempt each other
+ARM_GOALS = ('joint', 'tool')
+# longest wait for a state sample newer than a nowait step - two driver periods
+NOWAIT_STATE_SECS = .02
+
+STEP_EVENT = EVENT_LOG.event('step', ('type', 'relative', 'nowait', 'success', 'seconds'),
+                             type=STEP_TYPES)
+STATE_EVENT = EVENT_LOG.event('get_state', ('n_states', 'trace_decimation', 'success'))
+FINGER_EVENT = EVENT_LOG.event('finger_cmd', ('percent1', 'percent2', 'percent3',
+                                              'turn1', 'turn2', 'turn3', 'wait'))
+HOME_EVENT = EVENT_LOG.event('home', ('reset',))
+
+
 class JacoRobot(object):
-    def __init__(self, robot_type='j2s7s300', cfg=JacoConfig()):
-        self.state_lock = threading.Lock()
+    def __init__(self, robot_type='j2s7s300', cfg=JacoConfig(), state_buffer_size=6000):
+        # counters and histograms read by the /stats service
+        self.metrics = MetricsRegistry()
+        # rate and jitter of the driver topics
+        self.state_rates = dict((topic, RateMeter(self.metrics, 'jaco_state', topic=topic))
+                                for topic in ('joint_state', 'tool_pose', 'finger_position'))
+        # latest joint state sample, readable without blocking the callbacks
+        self.latest_state = LatestState()
+        # history of every joint state sample - 60 seconds at 100Hz by default
+        self.state_buffer = StateRingBuffer(state_buffer_size)
+        # set on every joint state sample, waited on for the first one after a step
+        self.new_state = threading.Event()
         self.reset_state()
-        self.tool_pose_lock = threading.Lock()
-        self.finger_pose_lock = threading.Lock()
+        # set by initialize. TOOL targets are clamped into it and ANGLE/VEL
+        # motion is stopped when the arm leaves it
+        self.fence = None
+        self.fence_watch_bits = None
+        self.fence_hits = 0
+        # EpisodeRecorder writing every state sample and command to disk, or None
+        self.recorder = None
 
         self.MAX_FINGER_TURNS = 6800
         #self.n_states = 0
         self.request_timeout_secs = 10
         rospy.loginfo('starting init of ros')
-        self.robot_type = robot_type
-        self.prefix = '/{}'.format(robot_type)
         rospy.init_node('jaco_stepper', anonymous=True)
+        self.robot_type = rospy.get_param('~robot_type', robot_type)
+        self.prefix = '/{}'.format(self.robot_type)
 
         # init services
         self.path_home_arm = self.prefix + '_driver/in/home_arm'
@@ -102,6 +143,24 @@ class JacoRobot(object):
         self.joint_velocity_publisher = rospy.Publisher(self.path_joint_vel,
                                                         JointVelocity,
                                                         queue_size=50)
+        # publishes VEL steps at 100Hz without blocking the step service
+        self.velocity_streamer = VelocityStreamer(self.send_joint_velocity_cmd,
+                                                  rate=100.0,
+                                                  guard=self.inside_fence)
+        for name in ('ticks', 'missed', 'jitter_mean', 'jitter_max'):
+            self.metrics.gauge('jaco_velocity_streamer_' + name,
+                               'see VelocityStreamer.stats',
+                               fn=lambda name=name: self.velocity_streamer.stats()[name])
+        # every joint state update is republished as one compact row for the
+        # robot server, which keeps the rows for OBSERVE and shared memory
+        # clients and pushes them to SUBSCRIBE clients
+        self.state_stream_publisher = rospy.Publisher(STATE_STREAM_TOPIC,
+                                                      Float64MultiArray,
+                                                      queue_size=10)
+        self.state_stream_layout = None
+        # called with every state stream message, by a robot server running
+        # in this process
+        self.state_stream_listeners = []
 
         # Callback data holders
         self.robot_joint_state = JointState()
@@ -119,6 +178,14 @@ class JacoRobot(object):
         self.tool_pose_requester = actionlib.SimpleActionClient(
             self.tool_pose_requester_path, ArmPoseAction)
 
+        # goals are sent without blocking, see send_goal
+        self.goal_requesters = {'joint': self.joint_angle_requester,
+                                'tool': self.tool_pose_requester,
+                                'finger': self.finger_pose_requester}
+        self.goal_servers_ready = set()
+        self.goal_lock = threading.Lock()
+        self.active_goals = {}
+
         rospy.loginfo("Jaco controller init successful.")
 
     def connect_to_robot(self):
@@ -180,79 +247,183 @@ class JacoRobot(object):
         rospy.loginfo("Connected to the robot")
 
     def reset_state(self):
-        self.state_lock.acquire()
-        self.n_states = 0
+        # samples counted from here on belong to the next step. The callbacks
+        # only ever read these two attributes
         self.state_start = time.time()
-        self.state = {
-            'n_states': 0,
-            'time_offset': [],
-            'joint_pos': [],
-            'joint_vel': [],
-            'joint_effort': [],
-            'tool_pose': [],
-            'finger_pose': []
-        }
-        self.state_lock.release()
+        # buffer position of the first sample of this step
+        self.state_start_count = self.state_buffer.count
 
-    def receive_joint_state(self, robot_joint_state_msg):
+    def receive_joint_state(self, robot_joint_state):
         """
         Callback for '/prefix_driver/out/joint_state'.
+        Fills the unpublished snapshot slot in place, so this neither blocks
+        readers nor allocates per message
         :param robot_joint_state: data from topic
         :type robot_joint_state JointState
         :return None
         """
-        self.state_lock.acquire()
-        robot_joint_state = copy(robot_joint_state_msg)
-        self.joint_angles = robot_joint_state_msg.position
-        self.state_lock.release()
-
-        robot_tool_pose = self.get_tool_pose()
-        tool_pose = [
-            robot_tool_pose.pose.position.x, robot_tool_pose.pose.position.y,
-            robot_tool_pose.pose.position.z,
-            robot_tool_pose.pose.orientation.x,
-            robot_tool_pose.pose.orientation.y,
-            robot_tool_pose.pose.orientation.z,
-            robot_tool_pose.pose.orientation.w
-        ]
-
-        robot_finger_pose = self.get_finger_pose()
-        finger_pose = [robot_finger_pose.finger1,
-                       robot_finger_pose.finger2,
-                       robot_finger_pose.finger3]
-
-        self.state['n_states'] += 1
-        self.state['time_offset'] = time.time() - self.state_start
-        self.state['joint_pos'] = robot_joint_state.position
-        self.state['joint_vel'] = robot_joint_state.velocity
-        self.state['joint_effort'] = robot_joint_state.effort
-        self.state['tool_pose'] = tool_pose
-        self.state['finger_pose'] = finger_pose
+        self.joint_angles = robot_joint_state.position
+        slot = self.latest_state.begin_write(len(robot_joint_state.position))
+        slot.count = self.state_buffer.count + 1
+        slot.stamp = robot_joint_state.header.stamp.to_sec()
+        slot.received = time.time()
+        slot.joint_pos[:] = robot_joint_state.position
+        slot.joint_vel[:] = robot_joint_state.velocity
+        slot.joint_effort[:] = robot_joint_state.effort
+        pose = self.robot_tool_pose.pose
+        tool_pose = slot.tool_pose
+        tool_pose[0] = pose.position.x
+        tool_pose[1] = pose.position.y
+        tool_pose[2] = pose.position.z
+        tool_pose[3] = pose.orientation.x
+        tool_pose[4] = pose.orientation.y
+        tool_pose[5] = pose.orientation.z
+        tool_pose[6] = pose.orientation.w
+        fingers = self.robot_finger_pose
+        slot.finger_pose[0] = fingers.finger1
+        slot.finger_pose[1] = fingers.finger2
+        slot.finger_pose[2] = fingers.finger3
+        self.state_buffer.append(slot.stamp, slot.received - self.state_start,
+                                 slot.joint_pos, slot.joint_vel,
+                                 slot.joint_effort, slot.tool_pose,
+                                 slot.finger_pose)
+        self.latest_state.end_write()
+        self.new_state.set()
+        self.state_rates['joint_state'].tick(slot.received)
+        if self.recorder is not None:
+            # the message fields are never changed, the slot arrays are reused
+            self.recorder.record_state(slot.count, slot.stamp, slot.received,
+                                       robot_joint_state.position,
+                                       robot_joint_state.velocity,
+                                       robot_joint_state.effort,
+                                       slot.tool_pose.copy(), slot.finger_pose.copy())
         self.joint_state_rcvd = True
+        self.watch_fence(slot.tool_pose[:3])
+        self.publish_state_stream(slot)
+
+    def publish_state_stream(self, slot):
+        """
+        publish [stamp, n_states, joint_pos, joint_vel, joint_effort, tool_pose, finger_pose]
+        The row is only skipped while nothing listens at all. A running robot
+        server always listens, as it uses every row, so this is no gate on
+        SUBSCRIBE clients - the server only does the per client work while
+        it has subscriptions
+        """
+        subscribed = self.state_stream_publisher.get_num_connections() > 0
+        if not subscribed and not self.state_stream_listeners:
+            return
+        n_joint_states = len(slot.joint_pos)
+        if self.state_stream_layout is None or self.state_stream_layout.dim[0].size != n_joint_states:
+            self.state_stream_layout = MultiArrayLayout(dim=[MultiArrayDimension(
+                label='n_joint_states', size=n_joint_states, stride=0)])
+        row = np.hstack([slot.stamp, slot.count - self.state_start_count,
+                         slot.joint_pos, slot.joint_vel, slot.joint_effort,
+                         slot.tool_pose, slot.finger_pose])
+        msg = Float64MultiArray(layout=self.state_stream_layout, data=row.tolist())
+        if subscribed:
+            self.state_stream_publisher.publish(msg)
+        for listener in self.state_stream_listeners:
+            listener(msg)
+
+    def start_fence_watch(self):
+        """
+        watch the tool position during the next ANGLE or VEL motion. Sides of
+        the fence the arm is already outside of when the motion starts are
+        allowed, so it can always be moved back in
+        """
+        self.fence_hits = 0
+        if self.fence is not None:
+            position = self.get_tool_pose().pose.position
+            self.fence_watch_bits = int(self.fence.check(
+                [position.x, position.y, position.z])[0])
+
+    def stop_fence_watch(self):
+        """ stop watching and return the fence bits hit during the motion """
+        self.fence_watch_bits = None
+        return self.fence_hits
+
+    def inside_fence(self):
+        """ False once the watched motion hit the fence """
+        return not self.fence_hits
+
+    def watch_fence(self, tool_position):
+        allowed = self.fence_watch_bits
+        if allowed is None:
+            return
+        bits = int(self.fence.check(tool_position)[0])
+        new = bits & ~allowed & ~self.fence_hits
+        if new:
+            self.fence_hits |= new
+            self.count_fence_hits(new)
+            # stops a joint angle goal, velocity steps check fence_hits
+            self.joint_angle_requester.cancel_all_goals()
+
+    def count_fence_hits(self, bits):
+        for bit, name in FENCE_NAMES:
+            if bits & bit:
+                self.metrics.counter('jaco_fence_hits_total',
+                                     'motions stopped or targets clamped by a fence side',
+                                     side=name).inc()
+
+    def get_robot_state(self, since_reset=True):
+        """
+        latest state, with n_states and time_offset counted from the last
+        reset_state. Empty if no sample arrived since then, or with
+        since_reset=False only if none arrived at all - n_states is 0 and
+        time_offset negative for a sample from before the reset
+        """
+        st = self.latest_state.read()
+        if st is None or (since_reset and st.count <= self.state_start_count):
+            return {'n_states': 0, 'time_offset': [], 'joint_pos': [],
+                    'joint_vel': [], 'joint_effort': [], 'tool_pose': [],
+                    'finger_pose': []}
+        return {
+            'n_states': max(0, st.count - self.state_start_count),
+            'time_offset': st.received - self.state_start,
+            'joint_pos': st.joint_pos.tolist(),
+            'joint_vel': st.joint_vel.tolist(),
+            'joint_effort': st.joint_effort.tolist(),
+            'tool_pose': st.tool_pose.tolist(),
+            'finger_pose': st.finger_pose.tolist()
+        }
 
-    def get_robot_state(self):
-        self.state_lock.acquire()
-        st = copy(self.state)
-        self.state_lock.release()
-        return st
+    def wait_for_state(self, nowait=False):
+        """
+        latest state once a sample arrived since the last reset_state. With
+        nowait, give up on a new sample after NOWAIT_STATE_SECS and return
+        the latest one from before the reset
+        """
+        start = time.time()
+        while True:
+            # cleared before reading, so a sample arriving after the read
+            # ends the wait below at once
+            self.new_state.clear()
+            st = self.get_robot_state()
+            if st['n_states'] > 0:
+                return st
+            if nowait and time.time() - start >= NOWAIT_STATE_SECS:
+                st = self.get_robot_state(since_reset=False)
+                if st['joint_pos']:
+                    return st
+            self.new_state.wait(NOWAIT_STATE_SECS if nowait else .1)
+
+    def get_robot_state_trace(self, decimation=1):
+        """
+        every decimation-th state sample received since the last reset_state,
+        as arrays with one row per sample
+        """
+        return self.state_buffer.trace(self.state_start_count, decimation)
 
     def get_joint_angles(self):
-        self.state_lock.acquire()
-        ja = self.joint_angles
-        self.state_lock.release()
-        return ja
+        return self.joint_angles
 
     def get_tool_pose(self):
-        self.tool_pose_lock.acquire()
-        robot_tool_pose = copy(self.robot_tool_pose)
-        self.tool_pose_lock.release()
-        return robot_tool_pose
+        # messages are never modified after they are received, so handing out
+        # the reference is safe
+        return self.robot_tool_pose
 
     def get_finger_pose(self):
-        self.finger_pose_lock.acquire()
-        robot_finger_pose = copy(self.robot_finger_pose)
-        self.finger_pose_lock.release()
-        return robot_finger_pose
+        return self.robot_finger_pose
 
     def receive_tool_pose(self, robot_tool_pose):
         """
@@ -263,9 +434,8 @@ class JacoRobot(object):
         :type robot_tool_pose kinova_msgs.msg.KinovaPose
         :return None
         """
-        self.tool_pose_lock.acquire()
         self.robot_tool_pose = robot_tool_pose
-        self.tool_pose_lock.release()
+        self.state_rates['tool_pose'].tick()
         self.tool_pose_rcvd = True
 
     def receive_finger_pose(self, robot_finger_pose):
@@ -277,23 +447,78 @@ class JacoRobot(object):
         :type robot_finger_pose kinova_msgs.msg.KinovaPose
         :return None
         """
-        self.finger_pose_lock.acquire()
         self.robot_finger_pose = robot_finger_pose
-        self.finger_pose_lock.release()
+        self.state_rates['finger_position'].tick()
         self.finger_pose_rcvd = True
 
-    def send_tool_pose_cmd(self, position, orientation_q):
-        robot_tool_pose = self.get_tool_pose()
-
-        # print("REQUESTING POSE before fence of:", position)
-        # position, result = trim_target_pose_safety(
-        #     position, self.fence_min_x, self.fence_max_x, self.fence_min_y,
-        #     self.fence_max_y, self.fence_min_z, self.fence_max_z)
-        # # based on pose_action_client.py
-        # print("REQUESTING POSE after fence of:", position)
+    def send_goal(self, kind, goal, feedback_cb=None):
+        """
+        send goal without waiting for it. A running goal of the same kind is
+        preempted, and joint and tool goals preempt each other since both
+        move the arm.
+        :kind 'joint', 'tool' or 'finger'
+        :feedback_cb optional fn(handle, feedback)
+        :return: GoalHandle
+        """
+        requester = self.goal_requesters[kind]
+        if kind not in self.goal_servers_ready:
+            requester.wait_for_server()
+            self.goal_servers_ready.add(kind)
+        handle = GoalHandle(requester, kind)
+        handle.add_done_callback(self.record_goal)
+        if feedback_cb is not None:
+            handle.add_feedback_callback(feedback_cb)
+        with self.goal_lock:
+            previous = self.active_goals.get(kind)
+            if previous is not None:
+                previous.supersede()
+            if kind in ARM_GOALS:
+                for other in ARM_GOALS:
+                    running = self.active_goals.get(other)
+                    if other != kind and running is not None:
+                        running.cancel()
+            self.active_goals[kind] = handle
+            return handle.send(goal)
+
+    def record_goal(self, handle):
+        self.metrics.histogram('jaco_goal_seconds', 'seconds from sending a goal until it finished',
+                               kind=handle.kind).observe(handle.duration())
+        self.metrics.counter('jaco_goals_total', 'finished goals by outcome',
+                             kind=handle.kind, outcome=handle.outcome()).inc()
+
+    def wait_for_goal(self, handle, finished_msg):
+        """
+        wait up to request_timeout_secs for handle
+        :return: msg, success. Only a goal the action server reports as
+            succeeded is a success, msg of any other names its outcome
+        """
+        if not handle.wait(self.request_timeout_secs):
+            self.metrics.counter('jaco_goal_timeouts_total', 'goals which were not done in time',
+                                 kind=handle.kind).inc()
+            handle.cancel()
+            return '+TIMEOUT', False
+        if handle.superseded:
+            return '+PREEMPTED', False
+        if not handle.succeeded():
+            # aborted, rejected, or preempted by a cancel for another goal
+            return '+GOAL_' + handle.outcome().upper(), False
+        return finished_msg, True
+
+    def start_tool_pose_goal(self, position, orientation_q, feedback_cb=None):
+        """
+        clamp position into the fence and start moving the tool there
+        :return: handle (None if the fence rejected the target), fence msg
+        """
         result = ''
-        # TODO - does wait_for_server belong here or when it is defined?
-        self.tool_pose_requester.wait_for_server()
+        if self.fence is not None:
+            clamped, bits = self.fence.apply(position)
+            if bits[0]:
+                self.count_fence_hits(bits[0])
+                result += describe_fence_hits(bits[0])
+                if bits[0] & FENCE_KEEP_OUT:
+                    return None, result
+                position = clamped[0].tolist()
+        # based on pose_action_client.py
         goal = ArmPoseGoal()
         goal.pose.header = Header(frame_id=(self.prefix + '_link_base'))
         goal.pose.pose.position = Point(x=position[0],
@@ -303,48 +528,29 @@ class JacoRobot(object):
                                                 y=orientation_q[1],
                                                 z=orientation_q[2],
                                                 w=orientation_q[3])
-        self.tool_pose_requester.send_goal(goal)
-        if self.tool_pose_requester.wait_for_result(
-                rospy.Duration(self.request_timeout_secs)):
-            self.tool_pose_requester.get_result()
-            result += '+TOOL_POSE_FINISHED'
-            robot_tool_pose = self.get_tool_pose()
-            this_position = [
-                robot_tool_pose.pose.position.x,
-                robot_tool_pose.pose.position.y,
-                robot_tool_pose.pose.position.z
-            ]
-            success = True
-        else:
-            self.tool_pose_requester.cancel_all_goals()
-            result += '+TIMEOUT'
-            success = False
-        return result, success
+        return self.send_goal('tool', goal, feedback_cb), result
 
-    def send_finger_pose_cmd(self, finger_positions):
-        result = ''
-        self.finger_pose_requester.wait_for_server()
+    def send_tool_pose_cmd(self, position, orientation_q):
+        handle, result = self.start_tool_pose_goal(position, orientation_q)
+        if handle is None:
+            return result, False
+        msg, success = self.wait_for_goal(handle, '+TOOL_POSE_FINISHED')
+        return result + msg, success
 
+    def start_finger_pose_goal(self, finger_positions, feedback_cb=None):
         goal = SetFingersPositionGoal()
         goal.fingers.finger1 = float(finger_positions[0])
         goal.fingers.finger2 = float(finger_positions[1])
         goal.fingers.finger3 = float(finger_positions[2])
-        self.finger_pose_requester.send_goal(goal)
-        if self.finger_pose_requester.wait_for_result(
-                rospy.Duration(self.request_timeout_secs)):
-            self.finger_pose_requester.get_result()
-            result += '+TOOL_POSE_FINISHED'
-            success = True
-        else:
-            self.finger_pose_requester.cancel_all_goals()
-            result += '+TIMEOUT'
-            success = False
-        return result, success
+        return self.send_goal('finger', goal, feedback_cb)
 
-    def send_joint_angle_cmd(self, joint_angles_degrees):
+    def send_finger_pose_cmd(self, finger_positions):
+        return self.wait_for_goal(self.start_finger_pose_goal(finger_positions),
+                                  '+TOOL_POSE_FINISHED')
+
+    def start_joint_angle_goal(self, joint_angles_degrees, feedback_cb=None):
         """
         create joint target pose to send to the controller
-        Sends the joint angle command to the action server and waits for its execution. 
         Note that the planning is done in the robot base.
         """
         joint_cmd = ArmJointAnglesGoal()
@@ -355,20 +561,16 @@ class JacoRobot(object):
         joint_cmd.angles.joint5 = joint_angles_degrees[4]
         joint_cmd.angles.joint6 = joint_angles_degrees[5]
         joint_cmd.angles.joint7 = joint_angles_degrees[6]
-        self.joint_angle_requester.send_goal(joint_cmd)
+        return self.send_goal('joint', joint_cmd, feedback_cb)
 
-        result = ''
-        if self.joint_angle_requester.wait_for_result(
-                rospy.Duration(self.request_timeout_secs)):
-            self.joint_angle_requester.get_result()
-            result += '+JOINT_ANGLE_FINISHED'
-            robot_joint_angles = self.get_joint_angles()
-            #this_position = [robot_tool_pose.pose.position.x, robot_tool_pose.pose.position.y, robot_tool_pose.pose.position.z]
-            success = True
-        else:
-            self.joint_angle_requester.cancel_all_goals()
-            result += '+TIMEOUT'
-            success = False
+    def send_joint_angle_cmd(self, joint_angles_degrees):
+        """
+        Sends the joint angle command to the action server and waits for its execution. 
+        """
+        result, success = self.wait_for_goal(
+            self.start_joint_angle_goal(joint_angles_degrees),
+            '+JOINT_ANGLE_FINISHED')
+        if not success:
             rospy.logerr("FAILED TO SEND JOINT ANGLE COMMAND: %s"%result)
         return result, success
 
@@ -408,105 +610,280 @@ class JacoRobot(object):
 
 class JacoInterface(JacoRobot):
     def __init__(self, robot_type='j2s7s300'):
-        # state passed in 6dof mujoco has 37 dimensions
-        # our 7DOF 7 major joints and 6 fingerjoints
-        self.n_joints = int(robot_type[3])
+        """
+        robot_type: overridden by the ~robot_type param. The services are
+        created in the namespace of the node, so several arms can be served
+        side by side by launching each interface in its own namespace
+        """
         super(JacoInterface, self).__init__(robot_type=robot_type,
                                             cfg=JacoConfig())
+        # state passed in 6dof mujoco has 37 dimensions
+        # our 7DOF 7 major joints and 6 fingerjoints
+        self.n_joints = int(self.robot_type[3])
         self.connect_to_robot()
+        # record every state sample and command to ~record_dir, one episode
+        # per reset. Read the episodes with episode_store.EpisodeReader
+        record_dir = rospy.get_param('~record_dir', '')
+        if record_dir:
+            self.recorder = EpisodeRecorder(record_dir, info={'robot_type': self.robot_type})
+            self.metrics.gauge('jaco_recorder_dropped', 'records dropped because the writer fell behind',
+                               fn=lambda: self.recorder.dropped)
         rospy.loginfo('initiating reset service')
         # instantiate services to be called by dm_wrapper
-        self.connect = rospy.Service('/initialize', initialize,
+        self.connect = rospy.Service('initialize', initialize,
                                      self.initialize)
-        self.server_reset = rospy.Service('/reset', reset, self.reset)
-        self.server_get_state = rospy.Service('/get_state', get_state,
+        self.server_reset = rospy.Service('reset', reset, self.reset)
+        self.server_get_state = rospy.Service('get_state', get_state,
                                               self.get_state)
-        self.server_home = rospy.Service('/home', home, self.home)
-        self.server_step = rospy.Service('/step', step, self.step)
+        self.server_home = rospy.Service('home', home, self.home)
+        self.server_step = rospy.Service('step', step, self.step)
+        self.server_step_batch = rospy.Service('step_batch', step_batch,
+                                               self.step_batch)
+        self.server_stats = rospy.Service('stats', stats, self.get_stats)
         print('waiting for client initialization')
         self.initialized = False
-        rospy.spin()
+        # kill -USR1 writes the event log to event_log.<pid>.txt in the
+        # working directory, ~/.ros under roslaunch
+        EVENT_LOG.install_dump_signal()
+        # ~server_port: run the robot server in this process on that port
+        server_port = rospy.get_param('~server_port', 0)
+        if server_port:
+            self.serve(int(server_port))
+        else:
+            rospy.spin()
+
+    def serve(self, port):
+        """
+        serve robot server clients from this process until shutdown. Their
+        commands call the service handlers directly, skipping the
+        serialisation and the connection of a ROS service call. The services
+        stay up for other ROS clients
+        """
+        RobotServer(port=port, n_workers=int(rospy.get_param('~server_workers', 4)),
+                    metrics_port=rospy.get_param('~metrics_port', None),
+                    backend=InProcessBackend(self))
 
     def initialize(self, cmd):
-        self.fence_min_x = cmd.fence_min_x
-        self.fence_max_x = cmd.fence_max_x
-        self.fence_min_y = cmd.fence_min_y
-        self.fence_max_y = cmd.fence_max_y
-        self.fence_min_z = cmd.fence_min_z
-        self.fence_max_z = cmd.fence_max_z
+        keep_in = [cmd.fence_min_x, cmd.fence_max_x, cmd.fence_min_y,
+                   cmd.fence_max_y, cmd.fence_min_z, cmd.fence_max_z]
+        self.fence = SafetyFence(keep_in + list(cmd.keep_in), cmd.keep_out)
+        self.record_command('INIT', count_start=self.state_buffer.count,
+                            data=keep_in + list(cmd.keep_in) + list(cmd.keep_out))
         self.initialized = True
         rospy.loginfo('initialized --->')
         return self.get_state(success=True, msg='successfully initialized')
 
-    def get_state(self, cmd=None, success=True, msg=''):
+    def get_state(self, cmd=None, success=True, msg='', trace_decimation=0, nowait=False):
         """ 
             :msg is not used - this returns state regardless of message passed in (for service calls)
             :success bool to indicate if a cmd was successfully executed
+            :nowait do not wait longer than NOWAIT_STATE_SECS for a state sample newer than the
+                step - the reply of a nowait step then has n_states 0 and the latest older sample
+            :trace_decimation if > 0, return every trace_decimation-th state sample received
+                since the step started instead of only the latest one. time_offset then has one
+                entry per sample and the other fields are the samples concatenated
         """
-        #st = self.get_robot_state_trace()
-        st = self.get_robot_state()
-        while st['n_states'] < 1:
-            time.sleep(.1)
-            st = self.get_robot_state()
-        print('get_state', st)
+        if cmd is not None:
+            trace_decimation = cmd.trace_decimation
+        st = self.wait_for_state(nowait)
+        STATE_EVENT(st['n_states'], trace_decimation, success)
+        if trace_decimation > 0:
+            tr = self.get_robot_state_trace(trace_decimation)
+            return success, msg, [], st['n_states'], tr['time_offset'].tolist(), \
+                tr['joint_pos'].ravel().tolist(), tr['joint_vel'].ravel().tolist(), \
+                tr['joint_effort'].ravel().tolist(), tr['tool_pose'].ravel().tolist(), \
+                tr['finger_pose'].ravel().tolist()
         return success, msg, [], st['n_states'], [st['time_offset']], st[
             'joint_pos'], st['joint_vel'], st['joint_effort'], st['tool_pose'], st['finger_pose']
 
     def step(self, cmd):
+        """
+        returns the get_state response plus the tracking error of a
+        TRAJECTORY step and the seconds spent running the command and
+        collecting the state
+        """
         if self.initialized:
             self.reset_state()
-            if cmd.type == 'VEL':
-                # velocity command for each joint in deg/sec
-                # vel command dont have time to actually get results
-                # only reset state trace when commanded
-                n = int(cmd.data[0])
-                cmd_vel_deg = convert_to_degrees(cmd.unit,
-                                                 np.array(cmd.data[1:]))
-                for i in range(n):
-                    msg, success = self.send_joint_velocity_cmd(cmd_vel_deg)
-                    time.sleep(1 / 100.)
-                return self.get_state(success=success, msg=str(msg))
-            if cmd.type == 'ANGLE':
-                # command joint position angle
-                current_joint_angles_radians = self.get_joint_angles()
-                joint_angles_degrees, joint_angles_radians = convert_joint_angles(
-                    current_joint_angles_radians, cmd.unit, cmd.relative,
-                    cmd.data)
-                msg, success = self.send_joint_angle_cmd(joint_angles_degrees)
-                success = True
-                if len(cmd.data) > self.n_joints:
-                    # there is finger command here
-                    print("finger data found")
-                    finger = cmd.data[self.n_joints:]
-                    self.build_finger_cmd(finger, is_relative=cmd.relative)
-                return self.get_state(success=success, msg=msg)
-            elif cmd.type == 'TOOL':
-                # command end effector pose in cartesian space
-                current_tool_pose = self.get_tool_pose()
-                if cmd.unit == 'mq':
-                    pose_len = 7
-                else:
-                    pose_len = 6
-
-                translation = cmd.data[:3]
-                rotation = cmd.data[3:pose_len]
-                finger = cmd.data[pose_len:]
-                position, orientation_q, orientation_rad, orientation_deg = \
-                    convert_tool_pose(current_tool_pose, cmd.unit, cmd.relative, translation, rotation)
-
-                msg, success = self.send_tool_pose_cmd(position, orientation_q)
-                self.build_finger_cmd(finger, is_relative=cmd.relative)
-               
-                return self.get_state(success=success, msg=msg)
+            self.tracking_error = []
+            start = time.time()
+            msg, success = self.run_step(cmd.type, cmd.relative, cmd.unit, cmd.data,
+                                         nowait=cmd.nowait)
+            executed = time.time()
+            state = self.get_state(success=success, msg=msg,
+                                   trace_decimation=cmd.trace_decimation,
+                                   nowait=cmd.nowait)
+            step_timing = [executed - start, time.time() - executed]
+            return state + (self.tracking_error, step_timing)
+        else:
+            return self.get_state(success=False, msg='not initialized') + ([], [])
 
+    def step_batch(self, cmd):
+        """
+        run cmd.n_actions step commands of the same type back to back and
+        return the state after each of them as one row of a flat array (see
+        srv/step_batch.srv)
+        """
+        if not self.initialized:
+            return False, 'not initialized', [], 0, 0, []
+        n_actions = int(cmd.n_actions)
+        if n_actions < 1 or len(cmd.data) % n_actions:
+            return False, 'data of length {} can not be split into {} actions'.format(
+                len(cmd.data), n_actions), [], 0, 0, []
+        actions = np.array(cmd.data).reshape(n_actions, -1)
+        rows = []
+        msgs = []
+        success = True
+        for action in actions.tolist():
+            self.reset_state()
+            msg, success = self.run_step(cmd.type, cmd.relative, cmd.unit, action,
+                                         command='STEP_BATCH')
+            msgs.append(msg)
+            st = self.wait_for_state()
+            rows.append(np.hstack([success, st['n_states'], st['time_offset'],
+                                   st['joint_pos'], st['joint_vel'], st['joint_effort'],
+                                   st['tool_pose'], st['finger_pose']]))
+            if not success:
+                break
+        states = np.vstack(rows)
+        n_joint_states = len(st['joint_pos'])
+        return success, ''.join(msgs), [], len(rows), n_joint_states, states.ravel().tolist()
+
+    def run_step(self, cmd_type, relative, unit, data, nowait=False, command='STEP'):
+        """ execute_step, counted, timed and recorded per step type """
+        start = time.time()
+        msg, success = self.execute_step(cmd_type, relative, unit, data, nowait=nowait)
+        seconds = time.time() - start
+        self.record_command(command, cmd_type=cmd_type, unit=unit, relative=relative,
+                            nowait=nowait, data=data, success=success, msg=msg,
+                            seconds=seconds)
+        self.metrics.histogram('jaco_step_seconds', 'seconds to run a step command',
+                               type=cmd_type).observe(seconds)
+        self.metrics.counter('jaco_steps_total', 'steps run', type=cmd_type).inc()
+        STEP_EVENT(STEP_TYPES.index(cmd_type) if cmd_type in STEP_TYPES else -1,
+                   relative, nowait, success, seconds)
+        if not success:
+            self.metrics.counter('jaco_step_failures_total', 'steps which did not succeed',
+                                 type=cmd_type).inc()
+        return msg, success
+
+    def execute_step(self, cmd_type, relative, unit, data, nowait=False):
+        """
+        send one step command to the robot
+        :nowait return once the command started. A running ANGLE or TOOL
+            goal is preempted by the next one instead of finishing first
+        :return: msg, success
+        """
+        if cmd_type == 'VEL':
+            # velocity command for each joint in deg/sec, streamed for n ticks
+            # of 10ms. relative extends the active velocity segment
+            n = int(data[0])
+            cmd_vel_deg = convert_to_degrees(unit, np.array(data[1:]))
+            self.start_fence_watch()
+            segment = self.velocity_streamer.set_segment(cmd_vel_deg, n,
+                                                         extend=relative)
+            if nowait:
+                return '+VEL_STARTED', True
+            self.velocity_streamer.wait(segment)
+            hits = self.stop_fence_watch()
+            if hits:
+                return '+VEL_STOPPED' + describe_fence_hits(hits), False
+            return '+VEL_FINISHED', True
+        # position commands take over from any velocity still being streamed
+        self.velocity_streamer.stop()
+        if cmd_type == 'ANGLE':
+            # command joint position angle
+            current_joint_angles_radians = self.get_joint_angles()
+            joint_angles_degrees, joint_angles_radians = convert_joint_angles(
+                current_joint_angles_radians, unit, relative, data)
+            self.start_fence_watch()
+            if nowait:
+                # the fence watch stays on until the next step
+                self.start_joint_angle_goal(joint_angles_degrees)
+                msg, success = '+JOINT_ANGLE_STARTED', True
+            else:
+                msg, success = self.send_joint_angle_cmd(joint_angles_degrees)
+                hits = self.stop_fence_watch()
+                if hits:
+                    msg += describe_fence_hits(hits)
+                    success = False
+            if len(data) > self.n_joints:
+                # there is finger command here
+                finger = data[self.n_joints:]
+                self.build_finger_cmd(finger, is_relative=relative, wait=not nowait)
+            return msg, success
+        elif cmd_type == 'TRAJECTORY':
+            return self.track_trajectory(relative, unit, data, nowait)
+        elif cmd_type == 'TOOL':
+            # command end effector pose in cartesian space
+            current_tool_pose = self.get_tool_pose()
+            if unit == 'mq':
+                pose_len = 7
+            else:
+                pose_len = 6
+
+            translation = data[:3]
+            rotation = data[3:pose_len]
+            finger = data[pose_len:]
+            position, orientation_q, orientation_rad, orientation_deg = \
+                convert_tool_pose(current_tool_pose, unit, relative, translation, rotation)
+
+            if nowait:
+                handle, msg = self.start_tool_pose_goal(position, orientation_q)
+                success = handle is not None
+                if success:
+                    msg += '+TOOL_POSE_STARTED'
             else:
-                raise (NotImplemented)
+                msg, success = self.send_tool_pose_cmd(position, orientation_q)
+            if len(finger):
+                self.build_finger_cmd(finger, is_relative=relative, wait=not nowait)
+            return msg, success
         else:
-            return self.get_state(success=False, msg='not initialized')
+            raise (NotImplemented)
 
-    def build_finger_cmd(self, fingers, is_relative):
+    def get_joint_degrees(self):
+        return np.degrees(self.get_joint_angles()[:self.n_joints])
+
+    def track_trajectory(self, relative, unit, data, nowait=False, kp=2.0):
+        """
+        follow a spline through timestamped joint waypoints with velocity
+        commands. data is rows of [time, joint positions] in 'mdeg' or 'mrad'
+        units, times in seconds from now. The current position is used as
+        the first waypoint unless there is one at time 0.
+        :return: msg, success. self.tracking_error is set to the flattened
+            (ticks, n_joints) position error in degrees once it finished
+        """
+        waypoints = np.asarray(data, dtype=np.float64).reshape(-1, 1 + self.n_joints)
+        times = waypoints[:, 0]
+        positions = waypoints[:, 1:]
+        if unit in ('rad', 'mrad'):
+            positions = np.degrees(positions)
+        current = self.get_joint_degrees()
+        if relative:
+            positions = positions + current
+        if times[0] > 0:
+            times = np.hstack([0.0, times])
+            positions = np.vstack([current, positions])
+        try:
+            trajectory = JointTrajectory(times, positions)
+        except ValueError as e:
+            return '+TRAJECTORY_REJECTED ' + str(e), False
+        tracker = TrajectoryTracker(trajectory, self.get_joint_degrees, kp=kp,
+                                    rate=1.0 / self.velocity_streamer.period)
+        self.start_fence_watch()
+        segment = self.velocity_streamer.set_segment(tracker, tracker.n_ticks)
+        if nowait:
+            return '+TRAJECTORY_STARTED', True
+        self.velocity_streamer.wait(segment)
+        self.tracking_error = tracker.tracking_error().ravel().tolist()
+        hits = self.stop_fence_watch()
+        if hits:
+            return '+TRAJECTORY_STOPPED' + describe_fence_hits(hits), False
+        return '+TRAJECTORY_FINISHED', True
+
+    def build_finger_cmd(self, fingers, is_relative, wait=True):
         """
         input: finger which is array of size 3 or 1. If 3, finger joints are controlled independently, else, the single command is repeated for all fingers
+        wait: wait for the fingers to get there, otherwise only start the goal
 
 
           
@@ -526,14 +903,13 @@ class JacoInterface(JacoRobot):
         fingers = np.clip(fingers, -1, 1)
         finger_norm = (fingers + 1) / 2.0
         target_finger_percentage = finger_norm * 100
-        print('Finger percentage ', target_finger_percentage)
         current_finger_pose = self.get_finger_pose()
         finger_turn, finger_meter, finger_percent = convert_finger_pose(current_finger_pose,
                                                     'percent', False, target_finger_percentage)
         positions_temp1 = [max(0.0, n) for n in finger_turn]
         positions_temp2 = [min(n, self.MAX_FINGER_TURNS) for n in positions_temp1]
         positions = [float(n) for n in positions_temp2]
-        print('sending target positions', positions)
+        FINGER_EVENT(*(list(target_finger_percentage) + positions + [wait]))
         #if is_relative:
         #    
         #    print('***************current finger position')
@@ -543,16 +919,47 @@ class JacoInterface(JacoRobot):
         #                                            'percent', False, finger_percentage)
         #    self.current_action = np.clip(self.current_action - self.finger_speed * np.sign(action), -1.0, 1.0)
  
-        self.send_finger_pose_cmd(positions)
+        if wait:
+            self.send_finger_pose_cmd(positions)
+        else:
+            self.start_finger_pose_goal(positions)
  
+    def get_stats(self, cmd):
+        """ the metrics as json or in the Prometheus text format, or the event log """
+        if cmd.format == 'prometheus':
+            return self.metrics.prometheus_text()
+        if cmd.format == 'events':
+            return EVENT_LOG.text()
+        return json.dumps(self.metrics.snapshot())
+
+    def record_command(self, command, count_start=None, **kwargs):
+        """
+        record a command with the state samples received since count_start,
+        by default since the last reset_state. See
+        EpisodeRecorder.record_command for kwargs
+        """
+        if self.recorder is not None:
+            if count_start is None:
+                count_start = self.state_start_count
+            self.recorder.record_command(command, count_start=count_start,
+                                         count_end=self.state_buffer.count, **kwargs)
+
     def home(self, msg=None):
-        print('calling home')
+        HOME_EVENT(False)
+        self.velocity_streamer.stop()
+        count_start = self.state_buffer.count
         self.home_robot_service()
+        self.record_command('HOME', count_start=count_start)
         return True
 
     def reset(self, msg=None):
-        print('calling reset')
+        HOME_EVENT(True)
+        self.velocity_streamer.stop()
+        if self.recorder is not None:
+            self.recorder.start_episode()
+        count_start = self.state_buffer.count
         self.home_robot_service()
+        self.record_command('RESET', count_start=count_start)
         # JRH should we set finger at beginning or does home do it?
         #self.build_finger_cmd([0.5, 0.5, 0.5], False)
         # TODO - reset should take a goto message and use the controller to go to a particular position
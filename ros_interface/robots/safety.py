@@ -0,0 +1,94 @@
+#! /usr/bin/env python
+"""
+Cartesian safety fence for the end effector.
+
+Boxes are rows of [min_x, max_x, min_y, max_y, min_z, max_z] in meters, the
+same order as the fence of srv/initialize.srv. A position is allowed when it
+is inside at least one keep-in box and inside none of the keep-out boxes.
+
+Every check works on an (N,3) array of positions in one numpy pass and
+reports an int bitmask per position, so a whole batch of targets costs about
+as much as a single one. describe_fence_hits turns a mask into the '+MAXFENCEX'
+style message the step replies carry.
+"""
+import numpy as np
+
+# result bits, one pair per axis plus one for keep-out zones
+FENCE_MIN_X = 1 << 0
+FENCE_MAX_X = 1 << 1
+FENCE_MIN_Y = 1 << 2
+FENCE_MAX_Y = 1 << 3
+FENCE_MIN_Z = 1 << 4
+FENCE_MAX_Z = 1 << 5
+FENCE_KEEP_OUT = 1 << 6
+FENCE_NAMES = ((FENCE_MIN_X, 'MINFENCEX'), (FENCE_MAX_X, 'MAXFENCEX'),
+               (FENCE_MIN_Y, 'MINFENCEY'), (FENCE_MAX_Y, 'MAXFENCEY'),
+               (FENCE_MIN_Z, 'MINFENCEZ'), (FENCE_MAX_Z, 'MAXFENCEZ'),
+               (FENCE_KEEP_OUT, 'KEEPOUT'))
+MIN_BITS = np.array([FENCE_MIN_X, FENCE_MIN_Y, FENCE_MIN_Z])
+MAX_BITS = np.array([FENCE_MAX_X, FENCE_MAX_Y, FENCE_MAX_Z])
+
+
+def as_boxes(boxes):
+    """ returns the (B,3) lower and upper corners of flat or (B,6) box rows """
+    boxes = np.asarray(boxes if boxes is not None else [], dtype=np.float64)
+    boxes = boxes.reshape(-1, 6)
+    return boxes[:, 0::2], boxes[:, 1::2]
+
+
+def describe_fence_hits(bits):
+    """ message of the fence sides in bits, '' if there are none """
+    return ''.join('+' + name for bit, name in FENCE_NAMES if bits & bit)
+
+
+class SafetyFence(object):
+    def __init__(self, keep_in, keep_out=None):
+        """
+        keep_in: one or more boxes the end effector must stay inside of
+        keep_out: boxes the end effector must never enter
+        """
+        self.keep_in_lo, self.keep_in_hi = as_boxes(keep_in)
+        self.keep_out_lo, self.keep_out_hi = as_boxes(keep_out)
+
+    def clamp_keep_in(self, positions):
+        """
+        clamp (N,3) positions into their nearest keep-in box.
+        :return: clamped positions (N,3) and keep-in result bits (N,)
+        """
+        n = positions.shape[0]
+        if not len(self.keep_in_lo):
+            return positions, np.zeros(n, dtype=np.int64)
+        p = positions[:, None, :]
+        # (N,B,3) side violations against every keep-in box
+        below = p < self.keep_in_lo
+        above = p > self.keep_in_hi
+        box_bits = below.dot(MIN_BITS) + above.dot(MAX_BITS)
+        candidates = np.minimum(np.maximum(p, self.keep_in_lo), self.keep_in_hi)
+        nearest = ((candidates - p) ** 2).sum(axis=-1).argmin(axis=1)
+        rows = np.arange(n)
+        return candidates[rows, nearest], box_bits[rows, nearest].astype(np.int64)
+
+    def keep_out_bits(self, positions):
+        """ FENCE_KEEP_OUT for each of the (N,3) positions inside a keep-out box """
+        if not len(self.keep_out_lo):
+            return 0
+        p = positions[:, None, :]
+        inside = ((p > self.keep_out_lo) & (p < self.keep_out_hi)).all(axis=-1)
+        return np.where(inside.any(axis=1), FENCE_KEEP_OUT, 0)
+
+    def apply(self, positions):
+        """
+        clamp (N,3) positions into the fence.
+        :return: clamped positions (N,3) and result bits (N,). Positions which
+            are inside a keep-out zone after clamping have FENCE_KEEP_OUT set
+            and must be rejected rather than moved to
+        """
+        positions = np.array(positions, dtype=np.float64, ndmin=2)
+        clamped, bits = self.clamp_keep_in(positions)
+        return clamped, bits | self.keep_out_bits(clamped)
+
+    def check(self, positions):
+        """ result bits (N,) of positions as they are, without clamping """
+        positions = np.array(positions, dtype=np.float64, ndmin=2)
+        clamped, bits = self.clamp_keep_in(positions)
+        return bits | self.keep_out_bits(positions)
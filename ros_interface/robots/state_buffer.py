@@ -0,0 +1,63 @@
+#! /usr/bin/env python
+"""
+Fixed capacity history of robot state samples.
+
+The arrays are allocated once, when the first sample tells us how many joint
+states the driver reports, and every later sample is written in place. At the
+100Hz feedback rate of the kinova driver the default capacity holds the last
+minute of samples.
+"""
+import threading
+import numpy as np
+
+TRACE_FIELDS = ('stamp', 'time_offset', 'joint_pos', 'joint_vel',
+                'joint_effort', 'tool_pose', 'finger_pose')
+
+
+class StateRingBuffer(object):
+    def __init__(self, capacity=6000):
+        self.capacity = capacity
+        # total number of samples ever appended
+        self.count = 0
+        self.n_joint_states = None
+        self.lock = threading.Lock()
+
+    def allocate(self, n_joint_states):
+        self.n_joint_states = n_joint_states
+        self.stamp = np.zeros(self.capacity)
+        self.time_offset = np.zeros(self.capacity)
+        self.joint_pos = np.zeros((self.capacity, n_joint_states))
+        self.joint_vel = np.zeros((self.capacity, n_joint_states))
+        self.joint_effort = np.zeros((self.capacity, n_joint_states))
+        self.tool_pose = np.zeros((self.capacity, 7))
+        self.finger_pose = np.zeros((self.capacity, 3))
+
+    def append(self, stamp, time_offset, position, velocity, effort,
+               tool_pose, finger_pose):
+        with self.lock:
+            if self.n_joint_states != len(position):
+                self.allocate(len(position))
+            i = self.count % self.capacity
+            self.stamp[i] = stamp
+            self.time_offset[i] = time_offset
+            self.joint_pos[i] = position
+            self.joint_vel[i] = velocity
+            self.joint_effort[i] = effort
+            self.tool_pose[i] = tool_pose
+            self.finger_pose[i] = finger_pose
+            self.count += 1
+
+    def trace(self, start_count, decimation=1):
+        """
+        samples appended since the buffer count was start_count, oldest first,
+        as a dict of copied arrays. Only every decimation-th sample counting
+        back from the latest is returned, so the latest is always included.
+        Samples which have already been overwritten are skipped.
+        """
+        with self.lock:
+            end = self.count
+            start = max(start_count, end - self.capacity)
+            rows = np.arange(end - 1, start - 1, -max(1, decimation))[::-1] % self.capacity
+            if self.n_joint_states is None:
+                return dict((name, np.zeros(0)) for name in TRACE_FIELDS)
+            return dict((name, getattr(self, name)[rows]) for name in TRACE_FIELDS)
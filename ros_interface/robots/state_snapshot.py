@@ -0,0 +1,86 @@
+#! /usr/bin/env python
+"""
+Latest robot state, written by the joint state callback and read by any thread
+without either side taking a lock.
+
+Two preallocated StateSnapshot slots are used as a double buffer with a
+sequence counter (a seqlock). The single writer fills the slot readers are not
+looking at, then bumps the counter to publish it. A reader copies the
+published slot and retries only if a newer update was published during the
+copy, since only then may the writer have started refilling it.
+"""
+import numpy as np
+
+SNAPSHOT_FIELDS = ('joint_pos', 'joint_vel', 'joint_effort', 'tool_pose',
+                   'finger_pose')
+
+
+class StateSnapshot(object):
+    """
+    count: number of joint state samples received before and including this one
+    stamp: ROS stamp of the joint state message in seconds
+    received: wall time the callback ran
+    """
+    __slots__ = ('count', 'stamp', 'received') + SNAPSHOT_FIELDS
+
+    def __init__(self, n_joint_states=0):
+        self.count = 0
+        self.stamp = 0.0
+        self.received = 0.0
+        self.joint_pos = np.zeros(n_joint_states)
+        self.joint_vel = np.zeros(n_joint_states)
+        self.joint_effort = np.zeros(n_joint_states)
+        self.tool_pose = np.zeros(7)
+        self.finger_pose = np.zeros(3)
+
+    def copy_to(self, other):
+        other.count = self.count
+        other.stamp = self.stamp
+        other.received = self.received
+        for name in SNAPSHOT_FIELDS:
+            src = getattr(self, name)
+            dst = getattr(other, name)
+            if dst.shape == src.shape:
+                dst[:] = src
+            else:
+                setattr(other, name, src.copy())
+        return other
+
+
+class LatestState(object):
+    def __init__(self):
+        self.slots = (StateSnapshot(), StateSnapshot())
+        # number of published updates. slots[seq & 1] is the latest
+        self.seq = 0
+
+    def begin_write(self, n_joint_states):
+        """
+        returns the slot to fill for the next update. Only one thread may
+        write
+        """
+        slot = self.slots[(self.seq + 1) & 1]
+        if len(slot.joint_pos) != n_joint_states:
+            slot.joint_pos = np.zeros(n_joint_states)
+            slot.joint_vel = np.zeros(n_joint_states)
+            slot.joint_effort = np.zeros(n_joint_states)
+        return slot
+
+    def end_write(self):
+        self.seq += 1
+
+    def read(self, out=None):
+        """
+        consistent copy of the latest snapshot, into out if given. Returns
+        None before the first update
+        """
+        if out is None:
+            out = StateSnapshot()
+        while True:
+            seq = self.seq
+            if not seq:
+                return None
+            self.slots[seq & 1].copy_to(out)
+            # the writer only starts overwriting this slot after publishing
+            # the other one
+            if self.seq == seq:
+                return out
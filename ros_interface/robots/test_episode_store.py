@@ -0,0 +1,104 @@
+import numpy as np
+
+from ros_interface.robots.episode_store import EpisodeRecorder, EpisodeReader
+from ros_interface.robots.episode_store import ColumnTable, list_episodes
+
+N_JOINTS = 9
+
+
+def record_state(recorder, count):
+    recorder.record_state(count, 100.0 + count, 200.0 + count, np.full(N_JOINTS, count),
+                          np.full(N_JOINTS, -count), np.zeros(N_JOINTS),
+                          np.arange(7.0) + count, np.ones(3) * count)
+
+
+def record_episode(root, chunk_rows=4):
+    """ 10 states and a step for every 3 of them, in chunks of chunk_rows rows """
+    recorder = EpisodeRecorder(str(root), info={'robot': 'jaco'}, chunk_rows=chunk_rows)
+    recorder.start_episode({'task': 'reach'})
+    for count in range(1, 11):
+        record_state(recorder, count)
+        if count % 3 == 0:
+            recorder.record_command('STEP', 'ANGLE', 'deg', relative=True,
+                                    data=[count] * 7, msg='step {}'.format(count),
+                                    seconds=0.5, count_start=count - 3, count_end=count)
+    recorder.record_command('HOME', success=False, msg='fence °', count_start=9,
+                            count_end=10)
+    recorder.close(timeout=5)
+    assert recorder.dropped == 0
+    return list_episodes(str(root))
+
+
+def test_episode_round_trip(tmp_path):
+    paths = record_episode(tmp_path)
+    assert len(paths) == 1
+    reader = EpisodeReader(paths[0])
+    info = reader.info
+    assert info['robot'] == 'jaco' and info['task'] == 'reach'
+    assert info['n_commands'] == 4 and info['n_states'] == 10
+    assert info['end'] >= info['start']
+    assert reader.n_steps() == 4
+    step = reader.step(1)
+    assert step['command'] == 'STEP' and step['type'] == 'ANGLE' and step['unit'] == 'deg'
+    assert step['relative'] and not step['nowait'] and step['success']
+    assert step['data'].tolist() == [6.0] * 7
+    assert step['msg'] == 'step 6'
+    assert step['states']['count'].tolist() == [4, 5, 6]
+    assert step['states']['joint_pos'].tolist() == [[c] * N_JOINTS for c in (4, 5, 6)]
+    assert step['states']['stamp'].tolist() == [104.0, 105.0, 106.0]
+    home = reader.step(3)
+    assert home['command'] == 'HOME' and home['type'] is None and home['unit'] is None
+    assert not home['success'] and home['msg'] == u'fence °'
+    assert len(home['data']) == 0
+    assert home['states']['count'].tolist() == [10]
+
+
+def test_states_span_chunks(tmp_path):
+    reader = EpisodeReader(record_episode(tmp_path, chunk_rows=4)[0])
+    states = reader.read_states()
+    assert states['count'].tolist() == list(range(1, 11))
+    assert states['tool_pose'].shape == (10, 7)
+    assert states['finger_pose'][-1].tolist() == [10.0] * 3
+    assert reader.states_between(2, 9)['count'].tolist() == list(range(3, 10))
+    assert reader.states_between(10, 20)['count'].tolist() == []
+
+
+def test_episode_without_states(tmp_path):
+    recorder = EpisodeRecorder(str(tmp_path))
+    recorder.record_command('RESET', msg='reset')
+    recorder.close(timeout=5)
+    reader = EpisodeReader(list_episodes(str(tmp_path))[0])
+    assert reader.info['n_states'] == 0
+    assert reader.step(0)['states'] == {}
+    assert reader.read_states() == {}
+
+
+def test_new_recorders_number_episodes_on(tmp_path):
+    record_episode(tmp_path)
+    record_episode(tmp_path)
+    assert [path[-14:] for path in list_episodes(str(tmp_path))] == [
+        'episode_000001', 'episode_000002']
+
+
+def test_table_is_readable_while_written(tmp_path):
+    path = str(tmp_path / 'table')
+    writer = ColumnTable(path, [('value', '<f8', (2,))], chunk_rows=3)
+    reader = ColumnTable(path)
+    assert reader.rows() == 0
+    for i in range(5):
+        writer.append({'value': [i, -i]})
+    assert reader.rows() == 5
+    assert reader.column('value', 2).tolist() == [[2, -2], [3, -3], [4, -4]]
+    writer.extend('value', np.ones((4, 2)))
+    assert reader.column('value').shape == (9, 2)
+
+
+def test_searchsorted_matches_numpy_across_chunks(tmp_path):
+    table = ColumnTable(str(tmp_path / 'counts'), [('count', '<i8', ())], chunk_rows=4)
+    assert table.searchsorted('count', [0, 5]).tolist() == [0, 0]
+    counts = np.array([1, 2, 2, 3, 5, 8, 8, 8, 8, 9, 12])
+    table.extend('count', counts)
+    values = np.arange(-1, 15)
+    for side in ('left', 'right'):
+        assert table.searchsorted('count', values, side=side).tolist() == \
+            np.searchsorted(counts, values, side=side).tolist()
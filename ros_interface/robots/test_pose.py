@@ -64,7 +64,7 @@ class TestPose():
         print('finished setting up ros')
 
     def send_position(self, position, orientation, relative):
-        return self.service_step('POSE', relative, 'mdeg', position+orientation)
+        return self.service_step('POSE', relative, 'mdeg', position+orientation, 0, False)
 
     def check_fence_extremes(self):
         step_states = []
@@ -95,7 +95,7 @@ class TestPose():
                0.281919003591,
                0.633666927579]
         relative = False
-        self.service_step('POSE', relative, 'mq', pos)
+        self.service_step('POSE', relative, 'mq', pos, 0, False)
         time.sleep(.1)
 
 
@@ -0,0 +1,65 @@
+import numpy as np
+
+from ros_interface.robots.safety import SafetyFence, describe_fence_hits
+from ros_interface.robots.safety import FENCE_MIN_X, FENCE_MAX_Y, FENCE_MAX_Z, FENCE_KEEP_OUT
+
+KEEP_IN = [[-1, 1, -1, 1, 0, 1], [2, 3, -1, 1, 0, 1]]
+KEEP_OUT = [[0.5, 0.7, -0.1, 0.1, 0, 0.2]]
+
+
+def test_positions_inside_any_keep_in_box_pass():
+    fence = SafetyFence(KEEP_IN, KEEP_OUT)
+    positions = [[0, 0, 0.5], [2.5, 0.5, 0.5], [-1, 1, 1]]
+    clamped, bits = fence.apply(positions)
+    assert bits.tolist() == [0, 0, 0]
+    assert clamped.tolist() == positions
+
+
+def test_positions_are_clamped_into_their_nearest_box():
+    fence = SafetyFence(KEEP_IN)
+    clamped, bits = fence.apply([[1.4, 0, 0.5], [1.8, 2, 1.5], [-3, 0, 0.5]])
+    assert np.allclose(clamped, [[1, 0, 0.5], [2, 1, 1], [-1, 0, 0.5]])
+    assert bits[0] != 0
+    assert bits[1] & FENCE_MAX_Y and bits[1] & FENCE_MAX_Z
+    assert bits[2] == FENCE_MIN_X
+
+
+def test_keep_out_is_reported_not_clamped():
+    fence = SafetyFence(KEEP_IN, KEEP_OUT)
+    clamped, bits = fence.apply([[0.6, 0, 0.1], [0.6, 0, 0.5]])
+    assert bits.tolist() == [FENCE_KEEP_OUT, 0]
+    assert clamped[0].tolist() == [0.6, 0, 0.1]
+
+
+def test_check_uses_the_positions_as_they_are():
+    fence = SafetyFence([[0, 1, 0, 1, 0, 1]], [[1.2, 2, 0, 1, 0, 1]])
+    # outside the keep-in box, and inside the keep-out box only before clamping
+    bits = fence.check([[1.5, 0.5, 0.5]])
+    assert bits[0] & FENCE_KEEP_OUT
+    clamped, bits = fence.apply([[1.5, 0.5, 0.5]])
+    assert not bits[0] & FENCE_KEEP_OUT
+
+
+def test_flat_boxes_and_no_fence():
+    flat = SafetyFence(np.ravel(KEEP_IN), np.ravel(KEEP_OUT))
+    boxed = SafetyFence(KEEP_IN, KEEP_OUT)
+    positions = np.random.RandomState(0).uniform(-2, 4, (50, 3))
+    assert flat.check(positions).tolist() == boxed.check(positions).tolist()
+    open_fence = SafetyFence([])
+    clamped, bits = open_fence.apply(positions)
+    assert clamped.tolist() == positions.tolist() and not bits.any()
+
+
+def test_batch_matches_one_position_at_a_time():
+    fence = SafetyFence(KEEP_IN, KEEP_OUT)
+    positions = np.random.RandomState(1).uniform(-2, 4, (100, 3))
+    clamped, bits = fence.apply(positions)
+    for position, row, bit in zip(positions, clamped, bits):
+        one_clamped, one_bits = fence.apply(position)
+        assert one_clamped[0].tolist() == row.tolist()
+        assert one_bits[0] == bit
+
+
+def test_describe_fence_hits():
+    assert describe_fence_hits(0) == ''
+    assert describe_fence_hits(FENCE_MIN_X | FENCE_KEEP_OUT) == '+MINFENCEX+KEEPOUT'
@@ -0,0 +1,56 @@
+import numpy as np
+
+from ros_interface.robots.state_buffer import StateRingBuffer, TRACE_FIELDS
+
+N_JOINTS = 9
+
+
+def append(buf, count):
+    """ sample count, with every field holding count """
+    buf.append(100.0 + count, count / 100.0, np.full(N_JOINTS, count),
+               np.full(N_JOINTS, -count), np.zeros(N_JOINTS), np.full(7, count),
+               np.full(3, count))
+
+
+def test_trace_of_an_empty_buffer():
+    trace = StateRingBuffer(4).trace(0)
+    assert sorted(trace) == sorted(TRACE_FIELDS)
+    assert all(len(values) == 0 for values in trace.values())
+
+
+def test_trace_after_wraparound_keeps_the_latest_capacity_samples():
+    buf = StateRingBuffer(4)
+    for count in range(10):
+        append(buf, count)
+    assert buf.count == 10
+    trace = buf.trace(0)
+    assert trace['stamp'].tolist() == [106.0, 107.0, 108.0, 109.0]
+    assert trace['joint_pos'].shape == (4, N_JOINTS)
+    assert trace['joint_pos'][:, 0].tolist() == [6, 7, 8, 9]
+    assert trace['finger_pose'][-1].tolist() == [9, 9, 9]
+
+
+def test_decimated_trace_counts_back_from_the_latest_sample():
+    buf = StateRingBuffer(8)
+    for count in range(12):
+        append(buf, count)
+    assert buf.trace(0, decimation=3)['joint_vel'][:, 0].tolist() == [-5, -8, -11]
+    assert buf.trace(6, decimation=2)['stamp'].tolist() == [107.0, 109.0, 111.0]
+    # a decimation of 0 returns every sample
+    assert len(buf.trace(9, decimation=0)['stamp']) == 3
+
+
+def test_trace_since_a_start_count():
+    buf = StateRingBuffer(4)
+    for count in range(3):
+        append(buf, count)
+    # what JacoRobot.reset_state keeps to trace a step
+    start_count = buf.count
+    assert len(buf.trace(start_count)['stamp']) == 0
+    for count in range(3, 6):
+        append(buf, count)
+    assert buf.trace(start_count)['time_offset'].tolist() == [.03, .04, .05]
+    # samples of the step which were already overwritten are skipped
+    for count in range(6, 8):
+        append(buf, count)
+    assert buf.trace(start_count)['stamp'].tolist() == [104.0, 105.0, 106.0, 107.0]
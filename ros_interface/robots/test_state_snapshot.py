@@ -0,0 +1,69 @@
+import sys
+import threading
+
+import numpy as np
+
+from ros_interface.robots.state_snapshot import LatestState, StateSnapshot, SNAPSHOT_FIELDS
+
+N_JOINTS = 9
+N_UPDATES = 20000
+
+
+def write(latest, count):
+    """ publish update count, with every field of the snapshot holding count """
+    slot = latest.begin_write(N_JOINTS)
+    slot.count = count
+    slot.stamp = float(count)
+    for name in SNAPSHOT_FIELDS:
+        getattr(slot, name)[:] = count
+    slot.received = float(count)
+    latest.end_write()
+
+
+def test_read_before_the_first_update():
+    assert LatestState().read() is None
+
+
+def test_reader_sees_whole_and_newest_updates_during_writes():
+    latest = LatestState()
+    write(latest, 1)
+    done = threading.Event()
+    errors = []
+
+    def writer():
+        for count in range(2, N_UPDATES + 1):
+            write(latest, count)
+        done.set()
+
+    def reader():
+        out = StateSnapshot()
+        last = 0
+        while not done.is_set():
+            published = latest.seq
+            st = latest.read(out)
+            values = [st.stamp, st.received] + [v for name in SNAPSHOT_FIELDS
+                                                for v in getattr(st, name)]
+            if any(v != st.count for v in values):
+                errors.append('mixed update {}: {}'.format(st.count, values))
+            # never older than what was published before the read started
+            if st.count < max(published, last):
+                errors.append('stale update {} after {}'.format(st.count, published))
+            last = st.count
+    switch_interval = sys.getswitchinterval()
+    # switch threads as often as possible to interleave reads and writes
+    sys.setswitchinterval(1e-6)
+    try:
+        readers = [threading.Thread(target=reader) for i in range(2)]
+        for thread in readers:
+            thread.start()
+        writer()
+        for thread in readers:
+            thread.join(10)
+    finally:
+        sys.setswitchinterval(switch_interval)
+    assert errors[:3] == []
+    st = latest.read()
+    assert st.count == latest.seq == N_UPDATES
+    assert st.joint_pos.tolist() == [N_UPDATES] * N_JOINTS
+    assert len(st.finger_pose) == 3
+    assert np.all(st.tool_pose == N_UPDATES)
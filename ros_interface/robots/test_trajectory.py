@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+
+from ros_interface.robots.trajectory import JointTrajectory, TrajectoryTracker
+
+TIMES = [1.0, 1.5, 2.5, 3.0, 4.0]
+POSITIONS = np.array([[0, 0], [1, -1], [0.5, 2], [2, 2], [1, 0]], dtype=float)
+
+
+def test_spline_passes_through_the_waypoints():
+    trajectory = JointTrajectory(TIMES, POSITIONS)
+    position, velocity = trajectory.sample(np.array(TIMES) - TIMES[0])
+    assert np.allclose(position, POSITIONS)
+    assert np.allclose(velocity, trajectory.velocities)
+
+
+def test_spline_starts_and_ends_at_rest():
+    trajectory = JointTrajectory(TIMES, POSITIONS)
+    position, velocity = trajectory.sample([0.0, trajectory.duration])
+    assert np.allclose(velocity, 0)
+    # held at the last waypoint after the end, and at the first before the start
+    position, velocity = trajectory.sample([-1.0, trajectory.duration + 1])
+    assert np.allclose(position, POSITIONS[[0, -1]])
+    assert np.allclose(velocity, 0)
+
+
+def test_velocity_is_the_derivative_of_the_position():
+    trajectory = JointTrajectory(TIMES, POSITIONS)
+    t = np.linspace(0.01, trajectory.duration - 0.01, 200)
+    dt = 1e-6
+    position, velocity = trajectory.sample(t)
+    later, _ = trajectory.sample(t + dt)
+    assert np.allclose((later - position) / dt, velocity, atol=1e-4)
+
+
+def test_acceleration_is_continuous_at_the_knots():
+    trajectory = JointTrajectory(TIMES, POSITIONS)
+    dt = 1e-5
+    for knot in np.array(TIMES[1:-1]) - TIMES[0]:
+        before = np.diff(trajectory.sample([knot - 2 * dt, knot - dt])[1], axis=0) / dt
+        after = np.diff(trajectory.sample([knot + dt, knot + 2 * dt])[1], axis=0) / dt
+        assert np.allclose(before, after, atol=1e-2)
+
+
+def test_two_waypoints_move_smoothly_between_them():
+    trajectory = JointTrajectory([0, 2], [[0.0], [1.0]])
+    position, velocity = trajectory.sample([0, 1, 2])
+    assert np.allclose(position.ravel(), [0, 0.5, 1])
+    assert np.allclose(velocity.ravel(), [0, 0.75, 0])
+
+
+def test_bad_waypoints_are_rejected():
+    with pytest.raises(ValueError):
+        JointTrajectory([0], [[0]])
+    with pytest.raises(ValueError):
+        JointTrajectory([0, 1, 1], [[0], [1], [2]])
+
+
+def test_tracker_follows_the_spline_and_ends():
+    trajectory = JointTrajectory(TIMES, POSITIONS)
+    rate = 100.0
+    measured = [POSITIONS[0].copy()]
+    tracker = TrajectoryTracker(trajectory, lambda: measured[0], kp=2.0, rate=rate)
+    commands = []
+    tick = 0
+    while True:
+        command = tracker(tick / rate)
+        if command is None:
+            break
+        commands.append(command)
+        # the arm moves exactly to the spline
+        measured[0] = trajectory.sample((tick + 1) / rate)[0]
+        tick += 1
+    assert len(commands) == tracker.n_ticks == int(np.ceil(trajectory.duration * rate)) + 1
+    assert tracker.tracking_error().shape == (tracker.n_ticks, 2)
+    assert np.allclose(tracker.tracking_error(), 0)
+
+
+def test_tracker_corrects_the_position_error():
+    trajectory = JointTrajectory([0, 1], [[0.0], [0.0]])
+    tracker = TrajectoryTracker(trajectory, lambda: np.array([0.5]), kp=3.0)
+    assert np.allclose(tracker(0.0), [-1.5])
+    assert np.allclose(tracker.tracking_error(), [[-0.5]])
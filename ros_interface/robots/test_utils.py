@@ -0,0 +1,117 @@
+import numpy as np
+
+from ros_interface.robots import utils
+
+
+def rotation_matrix(q):
+    """ rotation matrix of an x, y, z, w unit quaternion """
+    x, y, z, w = q
+    return np.array([[1 - 2 * (y * y + z * z), 2 * (x * y - z * w), 2 * (x * z + y * w)],
+                     [2 * (x * y + z * w), 1 - 2 * (x * x + z * z), 2 * (y * z - x * w)],
+                     [2 * (x * z - y * w), 2 * (y * z + x * w), 1 - 2 * (x * x + y * y)]])
+
+
+def random_quaternions(n, seed=0):
+    return utils.batch_quaternion_norm(np.random.RandomState(seed).normal(size=(n, 4)))
+
+
+def test_quaternion_norm():
+    q = utils.batch_quaternion_norm([[0, 0, 0, 2], [1, 1, 1, 1], [0, 0, 0, 0]])
+    assert np.allclose(q, [[0, 0, 0, 1], [.5, .5, .5, .5], [0, 0, 0, 0]])
+    assert utils.QuaternionNorm([0, 0, 3, 4]) == [0, 0, .6, .8]
+
+
+def test_euler_quaternion_round_trip():
+    euler = np.random.RandomState(1).uniform(-1.5, 1.5, (100, 3))
+    q = utils.batch_euler_xyz_to_quaternion(euler)
+    assert np.allclose(np.linalg.norm(q, axis=1), 1)
+    assert np.allclose(utils.batch_quaternion_to_euler_xyz(q), euler)
+
+
+def test_euler_xyz_order():
+    # XYZ angles are applied about x first, in the rotated frame of the one before
+    a, b, c = 0.3, -0.4, 0.5
+    q = utils.batch_euler_xyz_to_quaternion([a, b, c])[0]
+    qx = [np.sin(a / 2), 0, 0, np.cos(a / 2)]
+    qy = [0, np.sin(b / 2), 0, np.cos(b / 2)]
+    qz = [0, 0, np.sin(c / 2), np.cos(c / 2)]
+    composed = utils.batch_quaternion_multiply(utils.batch_quaternion_multiply(qx, qy), qz)[0]
+    assert np.allclose(rotation_matrix(q), rotation_matrix(composed))
+
+
+def test_single_rows_match_the_batch():
+    q = random_quaternions(5)
+    euler = utils.batch_quaternion_to_euler_xyz(q)
+    for row, expected in zip(q, euler):
+        assert np.allclose(utils.Quaternion2EulerXYZ(row), expected)
+        assert np.allclose(utils.EulerXYZ2Quaternion(expected),
+                           utils.batch_euler_xyz_to_quaternion(expected)[0])
+
+
+def test_quaternion_multiply_is_rotation_composition():
+    q1, q2 = random_quaternions(50, 2), random_quaternions(50, 3)
+    product = utils.batch_quaternion_multiply(q1, q2)
+    for a, b, ab in zip(q1, q2, product):
+        assert np.allclose(rotation_matrix(ab), rotation_matrix(a).dot(rotation_matrix(b)))
+    identity = utils.batch_quaternion_multiply(q1, [0, 0, 0, 1])
+    assert np.allclose(identity, q1)
+
+
+def test_relative_quaternion_is_applied_in_the_tool_frame():
+    last_q = random_quaternions(20, 4)
+    relative_q = random_quaternions(20, 5)
+    last_pose = np.hstack([np.ones((20, 3)), last_q])
+    position, q, rad, deg = utils.batch_convert_tool_pose(last_pose, 'mq', True,
+                                                          np.full((20, 3), .5), relative_q)
+    assert np.allclose(position, 1.5)
+    for last, relative, result in zip(last_q, relative_q, q):
+        assert np.allclose(rotation_matrix(result),
+                           rotation_matrix(last).dot(rotation_matrix(relative)))
+    assert np.allclose(rad, utils.batch_quaternion_to_euler_xyz(q))
+    assert np.allclose(deg, np.degrees(rad))
+
+
+def test_absolute_and_relative_euler_tool_pose():
+    last_pose = [0.1, 0.2, 0.3] + utils.EulerXYZ2Quaternion([0.1, 0.2, 0.3])
+    position, q, rad, deg = utils.batch_convert_tool_pose(last_pose, 'mdeg', False,
+                                                          [1, 2, 3], [10, 20, 30])
+    assert np.allclose(position, [[1, 2, 3]])
+    assert np.allclose(rad, np.radians([[10, 20, 30]]))
+    assert np.allclose(utils.batch_quaternion_to_euler_xyz(q), rad)
+    position, q, rad, deg = utils.batch_convert_tool_pose(last_pose, 'mrad', True,
+                                                          [1, 1, 1], [0.1, 0.1, 0.1])
+    assert np.allclose(position, [[1.1, 1.2, 1.3]])
+    assert np.allclose(rad, [[0.2, 0.3, 0.4]])
+
+
+def test_joint_angles():
+    degrees, radians = utils.batch_convert_joint_angles(np.radians([10, 20]), 'mdeg', True,
+                                                        [[1, 2], [3, 4]])
+    assert np.allclose(degrees, [[11, 22], [13, 24]])
+    assert np.allclose(radians, np.radians(degrees))
+
+
+def test_relative_joint_angles_from_a_driver_joint_state():
+    # the driver publishes the arm joints followed by the 3 fingers
+    current = np.radians([10, 20, 30, 40, 50, 60, 70, 1, 2, 3])
+    degrees, radians = utils.batch_convert_joint_angles(current, 'mdeg', True, np.ones(7))
+    assert np.allclose(degrees, [[11, 21, 31, 41, 51, 61, 71]])
+    degrees, radians = utils.convert_joint_angles(current[:9], 'mrad', True, np.zeros(6))
+    assert np.allclose(degrees, [10, 20, 30, 40, 50, 60])
+    batch = utils.batch_convert_joint_angles([current, current], 'mdeg', True, np.ones((2, 7)))
+    assert batch[0].shape == (2, 7)
+
+
+def test_finger_units():
+    turn, meter, percent = utils.batch_convert_finger_pose([0, 0, 0], 'percent', False,
+                                                           [[50, 100, 0]])
+    assert np.allclose(turn, [[utils.FINGER_MAX_TURN / 2, utils.FINGER_MAX_TURN, 0]])
+    assert np.allclose(meter, [[utils.FINGER_MAX_DIST / 2, utils.FINGER_MAX_DIST, 0]])
+    turn, meter, percent = utils.batch_convert_finger_pose(turn, 'mm', True, [[0, -1, 0]])
+    assert np.allclose(meter[0, 1], utils.FINGER_MAX_DIST - 0.001)
+    assert np.allclose(percent[0, 0], 50)
+
+
+def test_wrap_to_pi():
+    assert np.allclose(utils.wrap_to_pi([0, np.pi / 2, 3 * np.pi / 2, -3 * np.pi / 2]),
+                       [0, np.pi / 2, -np.pi / 2, np.pi / 2])
@@ -0,0 +1,58 @@
+import threading
+
+from ros_interface.robots.velocity_streamer import VelocityStreamer
+
+
+def test_stop_of_a_replaced_segment_keeps_the_new_one():
+    publishing = threading.Event()
+    release = threading.Event()
+
+    def publish(velocity):
+        publishing.set()
+        release.wait(2)
+    streamer = VelocityStreamer(publish)
+    try:
+        first = streamer.set_segment([1.0], 100)
+        assert publishing.wait(2)
+        second = streamer.set_segment([2.0], 100)
+        # what run does when the first segment ends after the second was set
+        streamer.stop(first)
+        assert streamer.busy()
+        assert not streamer.wait(second, timeout=0)
+        streamer.stop(second)
+        assert not streamer.busy()
+        assert streamer.wait(second, timeout=0)
+    finally:
+        release.set()
+        streamer.shutdown()
+
+
+def test_wait_returns_once_the_segment_is_replaced():
+    streamer = VelocityStreamer(lambda velocity: None)
+    try:
+        first = streamer.set_segment([1.0], 1000)
+        done = []
+        waiter = threading.Thread(target=lambda: done.append(streamer.wait(first, timeout=2)))
+        waiter.start()
+        second = streamer.set_segment([2.0], 1000)
+        waiter.join(2)
+        assert done == [True]
+        assert streamer.busy()
+        assert not streamer.wait(second, timeout=0)
+    finally:
+        streamer.shutdown()
+
+
+def test_callable_segment_ends_when_it_returns_none():
+    published = []
+
+    def velocity(elapsed):
+        return None if len(published) == 3 else [elapsed]
+    streamer = VelocityStreamer(published.append, rate=1000.0)
+    try:
+        segment = streamer.set_segment(velocity, 100)
+        assert streamer.wait(segment, timeout=2)
+        assert len(published) == 3
+        assert not streamer.busy()
+    finally:
+        streamer.shutdown()
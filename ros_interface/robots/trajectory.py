@@ -0,0 +1,106 @@
+#! /usr/bin/env python
+"""
+Joint space trajectories tracked with velocity commands.
+
+A TRAJECTORY step gives timestamped joint waypoints. JointTrajectory fits a
+cubic spline through them which starts and ends at rest, and
+TrajectoryTracker turns it into one joint velocity command per driver tick:
+the spline velocity as feedforward plus a proportional correction of the
+position error. The arm flows through the waypoints instead of stopping at
+each of them the way separate ANGLE goals do.
+"""
+import numpy as np
+
+
+class JointTrajectory(object):
+    def __init__(self, times, positions):
+        """
+        times: (K,) strictly increasing waypoint times in seconds
+        positions: (K,n_joints) waypoint joint positions
+        """
+        self.times = np.asarray(times, dtype=np.float64)
+        self.positions = np.asarray(positions, dtype=np.float64)
+        if self.times.ndim != 1 or len(self.times) < 2:
+            raise ValueError('a trajectory needs at least two waypoints')
+        if np.any(np.diff(self.times) <= 0):
+            raise ValueError('waypoint times must be strictly increasing')
+        self.duration = self.times[-1] - self.times[0]
+        self.velocities = self.knot_velocities()
+
+    def knot_velocities(self):
+        """
+        velocity at each waypoint of the C2 cubic spline with zero velocity
+        at both ends
+        """
+        t, p = self.times, self.positions
+        n = len(t)
+        v = np.zeros_like(p)
+        if n < 3:
+            return v
+        h = np.diff(t)
+        slope = np.diff(p, axis=0) / h[:, None]
+        # tridiagonal system for the interior knot velocities
+        a = np.zeros((n - 2, n - 2))
+        i = np.arange(n - 2)
+        a[i, i] = 2 * (h[:-1] + h[1:])
+        a[i[1:], i[:-1]] = h[2:]
+        a[i[:-1], i[1:]] = h[:-2]
+        b = 3 * (h[1:, None] * slope[:-1] + h[:-1, None] * slope[1:])
+        v[1:-1] = np.linalg.solve(a, b)
+        return v
+
+    def sample(self, t):
+        """
+        position and velocity at time t (scalar or (N,) array) after the
+        first waypoint, held at the last waypoint after the end
+        """
+        t = np.clip(np.asarray(t, dtype=np.float64) + self.times[0],
+                    self.times[0], self.times[-1])
+        i = np.clip(np.searchsorted(self.times, t, side='right') - 1,
+                    0, len(self.times) - 2)
+        h = self.times[i + 1] - self.times[i]
+        s = ((t - self.times[i]) / h)[..., None]
+        h = h[..., None]
+        s2 = s * s
+        s3 = s2 * s
+        p0, p1 = self.positions[i], self.positions[i + 1]
+        m0, m1 = self.velocities[i] * h, self.velocities[i + 1] * h
+        position = ((2 * s3 - 3 * s2 + 1) * p0 + (s3 - 2 * s2 + s) * m0 +
+                    (3 * s2 - 2 * s3) * p1 + (s3 - s2) * m1)
+        velocity = ((6 * s2 - 6 * s) * p0 + (3 * s2 - 4 * s + 1) * m0 +
+                    (6 * s - 6 * s2) * p1 + (3 * s2 - 2 * s) * m1) / h
+        return position, velocity
+
+
+class TrajectoryTracker(object):
+    """
+    velocity source for VelocityStreamer. Each call returns the command for
+    one tick and records the position error of that tick
+    """
+    def __init__(self, trajectory, get_position, kp=2.0, rate=100.0):
+        """
+        get_position: returns the measured joint positions, in the units of
+            the trajectory
+        kp: proportional gain on the position error, in 1/s
+        """
+        self.trajectory = trajectory
+        self.get_position = get_position
+        self.kp = kp
+        # one tick past the end lets the correction settle the final error
+        self.n_ticks = int(np.ceil(trajectory.duration * rate)) + 1
+        self.error = np.zeros((self.n_ticks, trajectory.positions.shape[1]))
+        self.tick = 0
+
+    def __call__(self, elapsed):
+        """ velocity command for elapsed seconds into the trajectory """
+        if self.tick >= self.n_ticks:
+            return None
+        position, velocity = self.trajectory.sample(elapsed)
+        error = position - self.get_position()
+        self.error[self.tick] = error
+        self.tick += 1
+        return velocity + self.kp * error
+
+    def tracking_error(self):
+        """ (ticks run, n_joints) position error of every tick """
+        return self.error[:self.tick]
@@ -1,6 +1,11 @@
 import math
 import numpy as np
 
+from ros_interface.interfaces.event_log import EVENT_LOG
+
+RELATIVE_TOOL_EVENT = EVENT_LOG.event('relative_tool_target', ('x', 'y', 'z'))
+JOINT_TARGET_EVENT = EVENT_LOG.event('joint_target', ['joint%d' % (i + 1) for i in range(7)])
+
 
 def convert_to_degrees(unit, angle):
     """
@@ -33,300 +38,220 @@ def wrap_to_pi(angles):
     return phases
 
 
-# from kinova demo
-def QuaternionNorm(Q_raw):
-    qx_temp, qy_temp, qz_temp, qw_temp = Q_raw[0:4]
-    qnorm = math.sqrt(qx_temp * qx_temp + qy_temp * qy_temp +
-                      qz_temp * qz_temp + qw_temp * qw_temp)
-    if np.abs(qnorm) > 0:
-        qx_ = qx_temp / qnorm
-        qy_ = qy_temp / qnorm
-        qz_ = qz_temp / qnorm
-        qw_ = qw_temp / qnorm
-        Q_normed_ = [qx_, qy_, qz_, qw_]
-    else:
-        print("unable to use 0 qnorm")
-        Q_normed_ = Q_raw[0:4]
-    return Q_normed_
-
+# Max distance for one finger in meter
+FINGER_MAX_DIST = 18.9 / 2 / 1000
+# Max thread turn for one finger
+FINGER_MAX_TURN = 6800
 
-# from kinova demo
-def Quaternion2EulerXYZ(Q_raw):
-    Q_normed = QuaternionNorm(Q_raw)
-    qx_ = Q_normed[0]
-    qy_ = Q_normed[1]
-    qz_ = Q_normed[2]
-    qw_ = Q_normed[3]
 
-    tx_ = math.atan2((2 * qw_ * qx_ - 2 * qy_ * qz_),
-                     (qw_ * qw_ - qx_ * qx_ - qy_ * qy_ + qz_ * qz_))
-    ty_ = math.asin(2 * qw_ * qy_ + 2 * qx_ * qz_)
-    tz_ = math.atan2((2 * qw_ * qz_ - 2 * qx_ * qy_),
-                     (qw_ * qw_ + qx_ * qx_ - qy_ * qy_ - qz_ * qz_))
-    EulerXYZ_ = [tx_, ty_, tz_]
-    return EulerXYZ_
+"""
+Batch kernels. Quaternions are (N,4) arrays ordered x, y, z, w, Euler angles
+are (N,3) arrays of XYZ angles in radians. A single (4,) or (3,) row is
+treated as N=1, so the same kernels serve one command or a whole recorded
+dataset.
+"""
 
 
-# from kinova demo
-def EulerXYZ2Quaternion(EulerXYZ_):
-    tx_, ty_, tz_ = EulerXYZ_[0:3]
-    sx = math.sin(0.5 * tx_)
-    cx = math.cos(0.5 * tx_)
-    sy = math.sin(0.5 * ty_)
-    cy = math.cos(0.5 * ty_)
-    sz = math.sin(0.5 * tz_)
-    cz = math.cos(0.5 * tz_)
+def batch_quaternion_norm(quaternions):
+    """
+    normalise every quaternion row. Rows with zero norm are returned unchanged
+    :rtype: np.array (N,4)
+    """
+    q = np.array(quaternions, dtype=np.float64, ndmin=2)
+    qnorm = np.sqrt(np.einsum('ij,ij->i', q, q))
+    nonzero = qnorm > 0
+    q[nonzero] /= qnorm[nonzero, None]
+    return q
 
-    qx_ = sx * cy * cz + cx * sy * sz
-    qy_ = -sx * cy * sz + cx * sy * cz
-    qz_ = sx * sy * cz + cx * cy * sz
-    qw_ = -sx * sy * sz + cx * cy * cz
 
-    Q_ = [qx_, qy_, qz_, qw_]
-    return Q_
+def batch_quaternion_to_euler_xyz(quaternions):
+    """
+    :rtype: np.array (N,3) of Euler XYZ angles in radians
+    """
+    q = batch_quaternion_norm(quaternions)
+    qx, qy, qz, qw = q.T
+    euler = np.empty((q.shape[0], 3))
+    euler[:, 0] = np.arctan2(2 * qw * qx - 2 * qy * qz,
+                             qw * qw - qx * qx - qy * qy + qz * qz)
+    # clip rounding error which would push a gimbal lock pose out of range
+    euler[:, 1] = np.arcsin(np.clip(2 * qw * qy + 2 * qx * qz, -1.0, 1.0))
+    euler[:, 2] = np.arctan2(2 * qw * qz - 2 * qx * qy,
+                             qw * qw + qx * qx - qy * qy - qz * qz)
+    return euler
+
+
+def batch_euler_xyz_to_quaternion(euler_xyz):
+    """
+    :rtype: np.array (N,4) of x, y, z, w quaternions
+    """
+    half = 0.5 * np.array(euler_xyz, dtype=np.float64, ndmin=2)[:, :3]
+    sx, sy, sz = np.sin(half).T
+    cx, cy, cz = np.cos(half).T
+    q = np.empty((half.shape[0], 4))
+    q[:, 0] = sx * cy * cz + cx * sy * sz
+    q[:, 1] = -sx * cy * sz + cx * sy * cz
+    q[:, 2] = sx * sy * cz + cx * cy * sz
+    q[:, 3] = -sx * sy * sz + cx * cy * cz
+    return q
+
+
+def batch_quaternion_multiply(q1, q2):
+    """
+    Hamilton product q1 * q2 of each row, so q2 is applied in the frame of q1
+    :rtype: np.array (N,4)
+    """
+    x1, y1, z1, w1 = np.array(q1, dtype=np.float64, ndmin=2).T
+    x2, y2, z2, w2 = np.array(q2, dtype=np.float64, ndmin=2).T
+    return np.stack([w1 * x2 + x1 * w2 + y1 * z2 - z1 * y2,
+                     w1 * y2 - x1 * z2 + y1 * w2 + z1 * x2,
+                     w1 * z2 + x1 * y2 - y1 * x2 + z1 * w2,
+                     w1 * w2 - x1 * x2 - y1 * y2 - z1 * z2], axis=-1)
 
 
-def convert_tool_pose(current_tool_pose, unit, relative, position,
-                      orientation):
+def batch_convert_tool_pose(last_pose, unit, relative, position, orientation):
     """
-    unit: describes the unit of the command - mq:quaternian, mrad:radians, or mdeg:degrees. If mq, 3 position+4 quaternians data are required, otherwise, 3 position + 3 orientation data are required
-    is_relative: bool indicative whether or not the pose command is relative to the current position or absolute
-    position: relative or absolute position and orientation values for XYZ 
+    last_pose: (N,7) or (7,) current tool pose as position xyz + quaternion xyzw
+    unit: 'mq', 'mrad' or 'mdeg', see convert_tool_pose
+    relative: if True, position is added to the last position. Relative
+        quaternions are composed with the last orientation (applied in the
+        tool frame), relative Euler angles are added to the last ones
+    position: (N,3) target or offset positions
+    orientation: (N,4) quaternions if unit is 'mq', otherwise (N,3) Euler XYZ
+    :return: position (N,3), orientation_q (N,4), orientation_rad (N,3),
+        orientation_deg (N,3)
     """
     assert unit in ['mq', 'mrad', 'mdeg']
-    if unit == 'mq':
-        assert (len(orientation) == 4)
-        "end effector pose in quaternions requires 3 position & 4 orientation values - received {}".format(
-            len(orientation))
-    else:
-        assert (len(orientation) == 3)
-        "end effector pose in rad/deg requires 3 position & 3 orientation values - received {}".format(
-            len(orientation))
-
-    last_position = [
-        current_tool_pose.pose.position.x, current_tool_pose.pose.position.y,
-        current_tool_pose.pose.position.z
-    ]
-    last_orientation_q = [
-        current_tool_pose.pose.orientation.x,
-        current_tool_pose.pose.orientation.y,
-        current_tool_pose.pose.orientation.z,
-        current_tool_pose.pose.orientation.w
-    ]
+    position = np.array(position, dtype=np.float64, ndmin=2)
+    orientation = np.array(orientation, dtype=np.float64, ndmin=2)
+    n_orientation = 4 if unit == 'mq' else 3
+    assert orientation.shape[1] == n_orientation, \
+        "end effector pose in {} requires 3 position & {} orientation values - received {}".format(
+            unit, n_orientation, orientation.shape[1])
 
     if relative:
-        # get current orientation
-        # note - in the example, they reference /driver/out/cartesian_command - so it is the last command, not the last position as we are doing here
-        # last_orientation is in radians
-        print("rev relative position", position)
-        last_orientation_rad = Quaternion2EulerXYZ(last_orientation_q)
-        position = [last_position[i] + position[i] for i in range(3)]
+        last_pose = np.array(last_pose, dtype=np.float64, ndmin=2)
+        position = last_pose[:, :3] + position
+        last_orientation_q = last_pose[:, 3:7]
     if unit == 'mq':
         if relative:
-            # current orientation is mq
-            orientation_rad = [
-                last_orientation_rad[i] + Quaternion2EulerXYZ(orientation)[i]
-                for i in range(3)
-            ]
-            orientation_q = EulerXYZ2Quaternion(orientation_rad)
+            orientation_q = batch_quaternion_multiply(last_orientation_q,
+                                                      orientation)
         else:
             orientation_q = orientation
-        orientation_rad = Quaternion2EulerXYZ(orientation_q)
-        orientation_deg = [math.degrees(orientation_rad[i]) for i in range(3)]
-    if unit == 'mrad':
-        if relative:
-            orientation_rad = [
-                last_orientation_rad[i] + orientation[i] for i in range(3)
-            ]
-        else:
+        orientation_rad = batch_quaternion_to_euler_xyz(orientation_q)
+        orientation_deg = np.degrees(orientation_rad)
+    else:
+        if unit == 'mrad':
             orientation_rad = orientation
-        orientation_q = EulerXYZ2Quaternion(orientation_rad)
-        orientation_deg = [math.degrees(orientation_rad[i]) for i in range(3)]
-    if unit == 'mdeg':
-        if relative:
-            orientation_deg = [
-                math.degrees(last_orientation_rad[i]) + orientation[i]
-                for i in range(3)
-            ]
         else:
-            orientation_deg = orientation
-        orientation_rad = [math.radians(orientation_deg[i]) for i in range(3)]
-        orientation_q = EulerXYZ2Quaternion(orientation_rad)
+            orientation_rad = np.radians(orientation)
+        if relative:
+            orientation_rad = batch_quaternion_to_euler_xyz(last_orientation_q) + orientation_rad
+        orientation_q = batch_euler_xyz_to_quaternion(orientation_rad)
+        orientation_deg = np.degrees(orientation_rad)
     return position, orientation_q, orientation_rad, orientation_deg
 
 
-def convert_joint_angles(current_joint_angle_radians, unit, relative,
-                         target_joint_position):
+def batch_convert_joint_angles(current_joint_angle_radians, unit, relative,
+                               target_joint_position):
     """
-    unit: describes the unit of the command - must be 'deg' or 'rad' 
-    is_relative: bool indicative whether or not the pose command is relative to the current position or absolute
-    target_joint_position: relative or absolute joint position in degrees or radians. TODO size of input
+    current_joint_angle_radians: (N,n) or (n,) with n >= n_joints, such as
+        the driver joint state of the arm joints followed by the fingers.
+        Only the first n_joints are used
+    unit: 'mdeg' or 'mrad'
+    target_joint_position: (N,n_joints) relative or absolute joint positions
+    :return: target joint degrees (N,n_joints), target joint radians (N,n_joints)
     """
-
     assert unit in ['mdeg', 'mrad']
-    # current joint estimate is in degrees
-    if relative:
-        current_joint_angle_degrees = [
-            np.rad2deg(current_joint_angle_radians[i])
-            for i in range(len(current_joint_angle_radians))
-        ]
+    target = np.array(target_joint_position, dtype=np.float64, ndmin=2)
     if unit == 'mdeg':
-        # get absolute value
-        if relative:
-            target_joint_degree = [
-                target_joint_position[i] + current_joint_angle_degrees[i]
-                for i in range(len(target_joint_position))
-            ]
-        else:
-            target_joint_degree = target_joint_position
-        target_joint_radian = list(map(math.radians, target_joint_degree))
-    elif unit == 'mrad':
-        if relative:
-            # get absolute value
-            target_joint_degree = [
-                math.degrees(target_joint_position[i]) +
-                current_joint_angle_degrees[i]
-                for i in range(len(target_joint_position))
-            ]
-        else:
-            target_joint_degree = list(map(math.degrees,
-                                           target_joint_position))
-        target_joint_radian = list(map(math.radians, target_joint_degree))
-    print(target_joint_radian)
-    return target_joint_degree, target_joint_radian
-
-
-def convert_finger_pose(current_finger_pose, unit, relative, finger_value):
-
+        target_joint_degree = target
+    else:
+        target_joint_degree = np.degrees(target)
+    if relative:
+        current = np.array(current_joint_angle_radians, dtype=np.float64, ndmin=2)
+        target_joint_degree = target_joint_degree + np.degrees(current[:, :target.shape[1]])
+    return target_joint_degree, np.radians(target_joint_degree)
 
-    current_finger_pose = [current_finger_pose.finger1,
-                           current_finger_pose.finger2,
-                           current_finger_pose.finger3]
 
-    # Max distance for one finger in meter
-    finger_maxDist = 18.9 / 2 / 1000
-    # Max thread turn for one finger
-    finger_maxTurn = 6800
+def batch_convert_finger_pose(current_finger_turn, unit, relative,
+                              finger_value):
+    """
+    current_finger_turn: (N,3) or (3,) current finger positions in turns
+    unit: 'turn', 'mm' or 'percent'
+    finger_value: (N,3) relative or absolute finger commands
+    :return: finger turn, meter and percent, each (N,3)
+    """
+    finger_value = np.array(finger_value, dtype=np.float64, ndmin=2)
     # transform between units
     if unit == 'turn':
-        # get absolute value
-        if relative:
-            finger_turn_absolute_ = [
-                finger_value[i] + current_finger_pose[i]
-                for i in range(0, len(finger_value))
-            ]
-        else:
-            finger_turn_absolute_ = finger_value
-
-        finger_turn_ = finger_turn_absolute_
-        finger_meter_ = [
-            x * finger_maxDist / finger_maxTurn for x in finger_turn_
-        ]
-        finger_percent_ = [x / finger_maxTurn * 100.0 for x in finger_turn_]
-
+        finger_turn = finger_value
     elif unit == 'mm':
-        # get absolute value
-        finger_turn_command = [
-            x / 1000 * finger_maxTurn / finger_maxDist for x in finger_value
-        ]
-        if relative:
-            finger_turn_absolute_ = [
-                finger_turn_command[i] + current_finger_pose[i]
-                for i in range(0, len(finger_value))
-            ]
-        else:
-            finger_turn_absolute_ = finger_turn_command
-
-        finger_turn = finger_turn_absolute_
-        finger_meter = [
-            x * finger_maxDist / finger_maxTurn for x in finger_turn
-        ]
-        finger_percent = [x / finger_maxTurn * 100.0 for x in finger_turn]
+        finger_turn = finger_value / 1000 * FINGER_MAX_TURN / FINGER_MAX_DIST
     elif unit == 'percent':
-        # get absolute value
-        finger_turn_command = [
-            x / 100.0 * finger_maxTurn for x in finger_value
-        ]
-        if relative:
-            finger_turn_absolute_ = [
-                finger_turn_command[i] + current_finger_pose[i]
-                for i in range(0, len(finger_value))
-            ]
-        else:
-            finger_turn_absolute_ = finger_turn_command
-
-        finger_turn = finger_turn_absolute_
-        finger_meter = [
-            x * finger_maxDist / finger_maxTurn for x in finger_turn
-        ]
-        finger_percent = [x / finger_maxTurn * 100.0 for x in finger_turn]
+        finger_turn = finger_value / 100.0 * FINGER_MAX_TURN
     else:
         raise Exception("Finger value have to be in turn, mm or percent")
-
+    if relative:
+        finger_turn = finger_turn + np.array(current_finger_turn,
+                                             dtype=np.float64, ndmin=2)
+    finger_meter = finger_turn * FINGER_MAX_DIST / FINGER_MAX_TURN
+    finger_percent = finger_turn / FINGER_MAX_TURN * 100.0
     return finger_turn, finger_meter, finger_percent
 
 
-def trim_target_pose_safety(position, minx, maxx, miny, maxy, minz, maxz):
+# from kinova demo
+def QuaternionNorm(Q_raw):
+    if not np.any(Q_raw[0:4]):
+        print("unable to use 0 qnorm")
+    return batch_quaternion_norm(Q_raw[0:4])[0].tolist()
+
+
+# from kinova demo
+def Quaternion2EulerXYZ(Q_raw):
+    return batch_quaternion_to_euler_xyz(Q_raw[0:4])[0].tolist()
+
+
+# from kinova demo
+def EulerXYZ2Quaternion(EulerXYZ_):
+    return batch_euler_xyz_to_quaternion(EulerXYZ_[0:3])[0].tolist()
+
+
+def convert_tool_pose(current_tool_pose, unit, relative, position,
+                      orientation):
     """
-    take in a position list [x,y,z] and ensure it doesn't violate the defined fence
+    unit: describes the unit of the command - mq:quaternian, mrad:radians, or mdeg:degrees. If mq, 3 position+4 quaternians data are required, otherwise, 3 position + 3 orientation data are required
+    is_relative: bool indicative whether or not the pose command is relative to the current position or absolute
+    position: relative or absolute position and orientation values for XYZ 
     """
-    x, y, z = position
-    fence_result = ''
-    if maxx < x:
-        print('HIT FENCE: maxx of {} is < x of {}'.format(maxx, x))
-        x = maxx
-        fence_result += '+MAXFENCEX'
-    if x < minx:
-        print('HIT FENCE: x of {} < miny {}'.format(x, minx))
-        x = minx
-        fence_result += '+MINFENCEX'
-    if maxy < y:
-        print('HIT FENCE: maxy of {} is < y {}'.format(maxy, y))
-        y = maxy
-        fence_result += '+MAXFENCEY'
-    if y < miny:
-        print('HIT FENCE: y of {} is  miny of {}'.format(y, miny))
-        y = miny
-        fence_result += 'MINFENCEY'
-    if maxz < z:
-        print('HIT FENCE: maxz of {} is < z of {}'.format(maxz, z))
-        z = maxz
-        fence_result += 'MAXFENCEZ'
-    if z < minz:
-        print('HIT FENCE: z of {} < minz of {}'.format(z, minz))
-        z = minz
-        fence_result += 'MINFENCEZ'
-    return [x, y, z], fence_result
-
-
-def trim_target_pose_safety(position, minx, maxx, miny, maxy, minz, maxz):
+    pose = current_tool_pose.pose
+    last_pose = [pose.position.x, pose.position.y, pose.position.z,
+                 pose.orientation.x, pose.orientation.y, pose.orientation.z,
+                 pose.orientation.w]
+    if relative:
+        RELATIVE_TOOL_EVENT(*position[:3])
+    converted = batch_convert_tool_pose(last_pose, unit, relative, position,
+                                        orientation)
+    return [c[0].tolist() for c in converted]
+
+
+def convert_joint_angles(current_joint_angle_radians, unit, relative,
+                         target_joint_position):
     """
-    take in a position list [x,y,z] and ensure it doesn't violate the defined fence
+    unit: describes the unit of the command - must be 'deg' or 'rad' 
+    is_relative: bool indicative whether or not the pose command is relative to the current position or absolute
+    target_joint_position: relative or absolute joint position in degrees or radians. TODO size of input
     """
-    x, y, z = position
-    fence_result = ''
-    if maxx < x:
-        print('HIT FENCE: maxx of {} is < x of {}'.format(maxx, x))
-        x = maxx
-        fence_result += '+MAXFENCEX'
-    if x < minx:
-        print('HIT FENCE: x of {} < miny {}'.format(x, minx))
-        x = minx
-        fence_result += '+MINFENCEX'
-    if maxy < y:
-        print('HIT FENCE: maxy of {} is < y {}'.format(maxy, y))
-        y = maxy
-        fence_result += '+MAXFENCEY'
-    if y < miny:
-        print('HIT FENCE: y of {} is  miny of {}'.format(y, miny))
-        y = miny
-        fence_result += 'MINFENCEY'
-    if maxz < z:
-        print('HIT FENCE: maxz of {} is < z of {}'.format(maxz, z))
-        z = maxz
-        fence_result += 'MAXFENCEZ'
-    if z < minz:
-        print('HIT FENCE: z of {} < minz of {}'.format(z, minz))
-        z = minz
-        fence_result += 'MINFENCEZ'
-    return [x, y, z], fence_result
+    target_joint_degree, target_joint_radian = batch_convert_joint_angles(
+        current_joint_angle_radians, unit, relative, target_joint_position)
+    JOINT_TARGET_EVENT(*target_joint_radian[0])
+    return target_joint_degree[0].tolist(), target_joint_radian[0].tolist()
+
+
+def convert_finger_pose(current_finger_pose, unit, relative, finger_value):
+    current_finger_turn = [current_finger_pose.finger1,
+                           current_finger_pose.finger2,
+                           current_finger_pose.finger3]
+    converted = batch_convert_finger_pose(current_finger_turn, unit, relative,
+                                          finger_value)
+    return [c[0].tolist() for c in converted]
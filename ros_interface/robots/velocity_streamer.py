@@ -0,0 +1,166 @@
+#! /usr/bin/env python
+"""
+Fixed rate joint velocity command stream.
+
+The kinova driver only keeps moving while it receives a velocity command
+every 10ms, so a VEL step is a segment of n ticks of the same velocity.
+VelocityStreamer publishes the active segment from its own thread against
+absolute deadlines (deadline k is start + k * period), so the time a publish
+takes never accumulates into drift and step services return immediately.
+
+The velocity of a segment may also be a callable, which is called on every
+tick with the seconds since the segment started and returns the velocity to
+publish, or None to end the segment early. TrajectoryTracker is one.
+"""
+import threading
+import time
+
+# time.monotonic does not exist on python 2
+monotonic = getattr(time, 'monotonic', time.time)
+
+
+class VelocityStreamer(object):
+    def __init__(self, publish, rate=100.0, guard=None):
+        """
+        publish: called with the velocity on every tick of a segment
+        rate: ticks per second
+        guard: optional callable checked before every publish. The active
+            segment is stopped as soon as it returns False
+        """
+        self.publish = publish
+        self.period = 1.0 / rate
+        self.guard = guard
+        self.condition = threading.Condition()
+        self.velocity = None
+        self.remaining = 0
+        # id of the latest segment and of the latest one which has finished
+        self.segment = 0
+        self.finished = 0
+        # counters - see stats
+        self.ticks = 0
+        self.missed = 0
+        self.jitter_sum = 0.0
+        self.jitter_max = 0.0
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='velocity_streamer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def set_segment(self, velocity, n_ticks, extend=False):
+        """
+        publish velocity for the next n_ticks ticks, replacing the active
+        segment. If extend, the ticks left of the active segment are added.
+        velocity may be a callable, see the module docstring
+        :return: segment id to pass to wait
+        """
+        with self.condition:
+            self.velocity = velocity
+            self.remaining = n_ticks + (self.remaining if extend else 0)
+            # the replaced segment is over, its waiters return
+            self.finished = self.segment
+            self.segment += 1
+            if not self.remaining:
+                self.finished = self.segment
+            self.condition.notify_all()
+            return self.segment
+
+    def stop(self, segment=None):
+        """
+        end the active segment without publishing the rest of it. With
+        segment, only if that is still the active one
+        """
+        with self.condition:
+            if segment is not None and segment != self.segment:
+                # already replaced by a newer segment, which keeps running
+                return
+            self.remaining = 0
+            self.finished = self.segment
+            self.condition.notify_all()
+
+    def wait(self, segment, timeout=None):
+        """ block until segment finished or was replaced. False on timeout """
+        deadline = None if timeout is None else monotonic() + timeout
+        with self.condition:
+            while self.finished < segment:
+                if deadline is None:
+                    self.condition.wait()
+                else:
+                    left = deadline - monotonic()
+                    if left <= 0:
+                        return False
+                    self.condition.wait(left)
+        return True
+
+    def busy(self):
+        return self.remaining > 0
+
+    def shutdown(self):
+        self.running = False
+        self.stop()
+
+    def stats(self):
+        """
+        ticks: velocity commands published
+        missed: deadlines which had already passed by more than a period,
+            the schedule is restarted from now after those
+        jitter_mean, jitter_max: seconds between a deadline and the publish
+        """
+        return {'ticks': self.ticks, 'missed': self.missed,
+                'jitter_mean': self.jitter_sum / max(1, self.ticks),
+                'jitter_max': self.jitter_max}
+
+    def wait_for_segment(self):
+        """ block until there is a segment to publish. False once shut down """
+        with self.condition:
+            while self.running and not self.remaining:
+                self.condition.wait()
+            return self.running
+
+    def take_tick(self):
+        """
+        velocity and id of the segment of the next tick, velocity is None if
+        the segment ended
+        """
+        with self.condition:
+            if not self.remaining:
+                return None, self.segment
+            self.remaining -= 1
+            if not self.remaining:
+                self.finished = self.segment
+                self.condition.notify_all()
+            return self.velocity, self.segment
+
+    def run(self):
+        deadline = None
+        segment_start = None
+        current = None
+        while self.wait_for_segment():
+            now = monotonic()
+            if deadline is None or now - deadline > self.period:
+                # first tick of a new stream, or we fell a whole period
+                # behind - restart the schedule rather than bursting to
+                # catch up
+                if deadline is not None:
+                    self.missed += 1
+                deadline = now
+            elif deadline > now:
+                time.sleep(deadline - now)
+            velocity, segment = self.take_tick()
+            if segment != current:
+                current = segment
+                segment_start = deadline
+            if callable(velocity):
+                velocity = velocity(deadline - segment_start)
+            if velocity is None or (self.guard is not None and not self.guard()):
+                self.stop(segment)
+                deadline = None
+                continue
+            self.publish(velocity)
+            late = monotonic() - deadline
+            self.ticks += 1
+            self.jitter_sum += late
+            self.jitter_max = max(self.jitter_max, late)
+            deadline += self.period
+            if not self.remaining:
+                # idle until the next segment, which starts a new schedule
+                deadline = None